@@ -1,41 +1,226 @@
 #!/usr/bin/env python3
 
-# Usage: analyze-log.py <log_file>
+# Usage: analyze-log.py [--jobs N] [--chunk-size MB] <log_file>
 # Example: analyze-log.py out
 #
 # This script analyzes the log file generated by "./dev lint" or "./dev test".
+#
+# The log is memory-mapped and split into chunks on newline boundaries, then
+# the chunks are scanned in a process pool with bytes regexes. The results of
+# the chunks are merged in order, so the report is the same as the one of
+# log_analyzer.py, with the byte offset of every matching line.
+#
+# A compressed log (".gz" or ".zst", see framed_log.py) is split on the
+# boundaries of its frames instead, and each process only decompresses the
+# frames of its chunk. The offsets are the offsets in the uncompressed log.
+
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+import log_analyzer
+
+import framed_log
+
+KEYWORDS = [
+    "--- FAIL",
+    "ERROR",
+    "FAILED TO BUILD",
+]
+
+# Count the number of errors and warnings along with the test summary
+COUNTERS = {
+    "Errors": (b"error", re.IGNORECASE),
+    "Warnings": (b"warning", re.IGNORECASE),
+}
+
+# The bytes version of log_analyzer.DURATION_PATTERN, anchored to the lines
+DURATION_PATTERN = (
+    rb"^[^\S\n]*(?P<test_name>\S+)[^\n]+(?P<status>PASSED|FAILED) in (?P<duration>\d+\.\d)s",
+    re.MULTILINE,
+)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def chunk_boundaries(log_file: str, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Split the file into (start, end) chunks of about chunk_size bytes, each
+    ending right after a newline (or at the end of the file).
+
+    A compressed log is split on the boundaries of its frames, which end
+    after a newline unless a line is longer than a frame.
+    """
+    if framed_log.codec_of(log_file):
+        boundaries = []
+        for start, end in framed_log.FramedLogReader(log_file).frames():
+            if boundaries and end - boundaries[-1][0] <= chunk_size:
+                boundaries[-1] = (boundaries[-1][0], end)
+            else:
+                boundaries.append((start, end))
+        return boundaries
+
+    size = os.path.getsize(log_file)
+    if size == 0:
+        return []
+
+    boundaries = []
+    with open(log_file, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = min(start + chunk_size, size)
+                if end < size:
+                    newline = mm.find(b"\n", end - 1)
+                    end = size if newline == -1 else newline + 1
+                boundaries.append((start, end))
+                start = end
+    return boundaries
+
+
+def line_bounds(data, position: int, start: int, end: int) -> tuple[int, int]:
+    """
+    Return the (start, end) of the line containing position, end excluding the newline.
+    """
+    line_start = data.rfind(b"\n", start, position) + 1
+    if line_start == 0:
+        line_start = start
+    line_end = data.find(b"\n", position, end)
+    if line_end == -1:
+        line_end = end
+    return line_start, line_end
+
+
+def scan_chunk(log_file: str, start: int, end: int) -> dict:
+    """
+    Scan the lines in [start, end) of the log.
+
+    Return the keyword lines with their offsets, the counts and the test
+    durations found in the chunk.
+    """
+    if framed_log.codec_of(log_file):
+        data = framed_log.FramedLogReader(log_file).read(start, end - start)
+        return scan_buffer(data, 0, len(data), base_offset=start)
+
+    with open(log_file, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return scan_buffer(mm, start, end)
+
+
+def scan_buffer(data, start: int, end: int, base_offset: int = 0) -> dict:
+    """
+    Scan the lines in [start, end) of a buffer, see scan_chunk(). The offsets
+    of the lines are shifted by base_offset.
+    """
+    keyword_pattern = re.compile(
+        b"|".join(
+            re.escape(keyword.encode())
+            for keyword in KEYWORDS + [log_analyzer.NO_STATUS]
+        )
+    )
+    counter_patterns = {
+        name: re.compile(pattern, flags) for name, (pattern, flags) in COUNTERS.items()
+    }
+    duration_pattern = re.compile(*DURATION_PATTERN)
+
+    # the first lines of each keyword, the others are only counted
+    keyword_lines = {keyword: [] for keyword in KEYWORDS}
+    keyword_counts = {keyword: 0 for keyword in KEYWORDS}
+    no_status_count = 0
+    counts = {name: 0 for name in COUNTERS}
+    results = []
+
+    # each line is handled once, even if it contains several keywords
+    last_line_end = -1
+    for match in keyword_pattern.finditer(data, start, end):
+        if match.start() <= last_line_end:
+            continue
+        line_start, line_end = line_bounds(data, match.start(), start, end)
+        last_line_end = line_end
+
+        line = data[line_start:line_end].decode(errors="replace") + "\n"
+        for keyword in KEYWORDS:
+            if keyword in line:
+                keyword_counts[keyword] += 1
+                if len(keyword_lines[keyword]) < log_analyzer.MAX_KEYWORD_LINES:
+                    keyword_lines[keyword].append((base_offset + line_start, line))
+        if log_analyzer.NO_STATUS in line:
+            no_status_count += 1
 
-# TODO
+    for name, pattern in counter_patterns.items():
+        last_line_end = -1
+        for match in pattern.finditer(data, start, end):
+            if match.start() <= last_line_end:
+                continue
+            _, last_line_end = line_bounds(data, match.start(), start, end)
+            counts[name] += 1
 
+    for match in duration_pattern.finditer(data, start, end):
+        results.append(
+            (
+                match.group("test_name").decode(errors="replace"),
+                float(match.group("duration")),
+                match.group("status") == b"PASSED",
+            )
+        )
 
-def analyze_log(log_file):
-    with open(log_file, "r") as file:
-        lines = file.readlines()
+    return {
+        "keyword_lines": keyword_lines,
+        "keyword_counts": keyword_counts,
+        "no_status_count": no_status_count,
+        "counts": counts,
+        "results": results,
+    }
 
-    # analyze lint errors
 
+def analyze_log(log_file, jobs=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    counters = {
+        name: re.compile(pattern, flags) for name, (pattern, flags) in COUNTERS.items()
+    }
+    analyzer = log_analyzer.TestLogAnalyzer(KEYWORDS, counters=counters)
 
-    # Count the number of errors
-    error_count = 0
-    for line in lines:
-        if "error" in line.lower():
-            error_count += 1
+    boundaries = chunk_boundaries(log_file, chunk_size)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunk_results = executor.map(
+            scan_chunk,
+            [log_file] * len(boundaries),
+            [start for start, _ in boundaries],
+            [end for _, end in boundaries],
+        )
 
-    # Count the number of warnings
-    warning_count = 0
-    for line in lines:
-        if "warning" in line.lower():
-            warning_count += 1
+        # merge the results in the order of the chunks
+        for chunk in chunk_results:
+            for keyword, lines in chunk["keyword_lines"].items():
+                for offset, line in lines:
+                    analyzer.add_keyword_line(keyword, offset, line)
+                # the lines of the chunk which weren't kept
+                analyzer.keyword_counts[keyword] += chunk["keyword_counts"][keyword] - len(lines)
+            analyzer.no_status_count += chunk["no_status_count"]
+            for name, count in chunk["counts"].items():
+                analyzer.counts[name] += count
+            for test_name, duration, passed in chunk["results"]:
+                analyzer.add_result(test_name, duration, passed)
 
-    print(f"Errors: {error_count}")
-    print(f"Warnings: {warning_count}")
+    analyzer.report(log_file, show_offsets=True)
+    return analyzer
 
 
 if __name__ == "__main__":
-    import sys
+    import argparse
 
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <log_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='Analyze the log file generated by "./dev lint" or "./dev test".'
+    )
+    parser.add_argument("log_file")
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=None, help="number of processes, default: number of CPUs"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=64, help="size of the chunks in MB, default: 64"
+    )
+    args = parser.parse_args()
 
-    log_file = sys.argv[1]
\ No newline at end of file
+    analyze_log(args.log_file, jobs=args.jobs, chunk_size=args.chunk_size * 1024 * 1024)
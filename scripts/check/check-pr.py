@@ -1,32 +1,80 @@
 #!/usr/bin/env python3
 
-# Usage: check-pr.py <pr_number>
+# Usage: check-pr.py [--jobs N] [--github-api URL] <pr_number> ...
 # Example: check-pr.py 127584
+# Example: check-pr.py --jobs 2 127584 127601 127622
 #
 # This script pull a PR from cockroachdb/cockroach and run the following checks:
 # - ./dev gen
 # - ./dev lint
 # - ./dev test
+#
+# The PR is checked out in a reusable worktree (see worktree_pool.py) rather
+# than a fresh clone, so only the new objects are fetched and Bazel starts warm.
+#
+# With several PRs, the PRs are checked concurrently (at most --jobs at a time,
+# and only while there is enough free disk space), the metadata of the PRs is
+# fetched with a pooled HTTP session, and a combined summary table is printed
+# at the end. The GitHub API endpoint can be set with --github-api or the
+# GITHUB_API environment variable, e.g. to point at a local stub server.
+#
+# The metadata of the PRs (including the changed files, which select the
+# tests to run) is cached and revalidated with conditional requests, see
+# github_metadata.py.
+#
+# The results of every check (steps, tests and error lines) are stored in a
+# SQLite database, see check_results.py to query them.
 
 import os
-import re
 import sys
 import subprocess
 import shutil
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+import check_results
+import duration_history
+import github_metadata
+import import_graph
+import live_analysis
+import log_analyzer
+import worktree_pool
+
+import command_runner
+import framed_log
 
-REPO_URL = "https://github.com/cockroachdb/cockroach.git"
 # use HDD to prevent SSD wear
 WORK_DIR_BASE = "/media/xiaochen/large/ci/cockroach/pr-"
 BAZEL_CONFIG = os.path.expanduser("~/code/cockroach/.bazelrc.user")
 
+# Every check runs its own Bazel server, limit the number of concurrent checks
+# to the number of CPUs divided by this
+CPUS_PER_CHECK = 16
+# Don't start a check while the work dir disk has less free space than this
+MIN_FREE_DISK = 50 * 1024 * 1024 * 1024
+
+
+# Write the logs of the steps compressed, they can be read with zcat (or
+# zstdcat) and framed_log.py, see framed_log.py
+COMPRESS_LOGS = False
 
 # Skip the actual command execution, only analyze the logs
 DRY_RUN = True
 
+TEST_KEYWORDS = [
+    "ERROR",
+    "FAILED TO BUILD",
+]
 
-def run_command(command, log_file) -> int:
+# Abort "./dev test" as soon as one of these patterns shows up in its output,
+# e.g. "FAILED TO BUILD". The log is analyzed while the tests are running either way.
+FATAL_PATTERNS = []
+
+
+def run_command(command, log_file, cwd=None) -> int:
     """
     Run a command and write the output (stdout and stderr) to a log file, return the exit code.
 
@@ -36,150 +84,294 @@ def run_command(command, log_file) -> int:
         print(f"DRY_RUN: {command}")
         return 0
 
-    start_time = time.time()
     print(f"running command: {command}, log file: {log_file}")
-    with open(log_file, "w") as file:
-        process = subprocess.Popen(
-            command, shell=True, stdout=file, stderr=subprocess.STDOUT
-        )
-        process.communicate()
-    duration = time.time() - start_time
-    print(f"command finished in {duration:.2f} seconds.")
-    return process.returncode
+    result = command_runner.run_command(command, log_path=log_file, cwd=cwd)
+    print(f"command finished in {result.duration:.2f} seconds.")
+    return result.exit_code
 
 
-def get_pr_title(pr_number):
-    url = f"https://api.github.com/repos/cockroachdb/cockroach/pulls/{pr_number}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json().get("title", "Unknown PR")
-    else:
-        print(f"Failed to fetch PR title: {response.status_code}")
-        sys.exit(1)
+def wait_for_disk_space(path: str):
+    while shutil.disk_usage(path).free < MIN_FREE_DISK:
+        print(f"less than {MIN_FREE_DISK // 1024 ** 3}GB free on {path}, waiting...")
+        time.sleep(60)
 
 
-def main(pr_number):
+def main(pr: github_metadata.PullRequest, quiet=False) -> dict:
+    """
+    Check a PR, return its result (see check_pr()).
+
+    If quiet is True, the test report is only written to the log dir, so the
+    reports of concurrent checks don't interleave.
+    """
+    start_time = time.time()
+    pr_number = pr.number
+
     # Step 1: Show the title of the PR
-    pr_title = get_pr_title(pr_number)
-    print(f"PR #{pr_number}: {pr_title}")
+    print(f"PR #{pr_number}: {pr.title}")
 
-    # Step 2: Clone the repo at the PR to a temp directory
     work_dir = f"{WORK_DIR_BASE}{pr_number}"
-    code_dir = f"{work_dir}/code"
     log_dir = f"{work_dir}/log"
 
     if not DRY_RUN:
-        if os.path.exists(work_dir):
-            shutil.rmtree(work_dir)
-        os.makedirs(work_dir)
-
-        os.makedirs(f"{code_dir}")
-
-        os.makedirs(f"{log_dir}")
+        if os.path.exists(log_dir):
+            shutil.rmtree(log_dir)
+        os.makedirs(log_dir)
+        wait_for_disk_space(work_dir)
 
-    # clone the pr directly will cause the error:
-    # fatal: Remote branch pull/127584/head not found in upstream origin
-    #
-    # clone_command = f"git clone --depth 1 --branch pull/{pr_number}/head {REPO_URL} {code_dir}"
-
-    clone_command = f"git clone --depth 1 --branch master {REPO_URL} {code_dir}"
-    if run_command(clone_command, f"{log_dir}/clone.log") != 0:
-        print(f"Error: Failed to clone the repository.")
-        sys.exit(1)
+    # Step 2: Check out the PR in a worktree of the pool, the worktrees share
+    # one object store and keep their Bazel output base between the PRs
+    if DRY_RUN:
+        print(f"DRY_RUN: check out PR #{pr_number} in the worktree pool")
+        result = check_pr(pr, os.getcwd(), log_dir, quiet)
+    else:
+        with worktree_pool.checkout(pr_number, f"{log_dir}/checkout.log") as code_dir:
+            if code_dir is None:
+                print(
+                    f"Error: Failed to checkout PR #{pr_number}, see here for details: {log_dir}/checkout.log"
+                )
+                result = {"status": "checkout failed"}
+            else:
+                result = check_pr(pr, code_dir, log_dir, quiet)
+
+    result.update(pr=pr_number, title=pr.title, duration=time.time() - start_time)
+
+    # the results of a dry run have already been recorded
+    if not DRY_RUN:
+        check_results.record_check(
+            pr_number,
+            result["status"],
+            start_time,
+            result["duration"],
+            steps=result.get("steps", []),
+            tests=result.get("tests", []),
+            errors=result.get("errors", []),
+            title=pr.title,
+            head_sha=pr.head_sha,
+            log_dir=log_dir,
+        )
+    return result
 
-    os.chdir(code_dir)
 
-    fetch_command = f"git fetch origin pull/{pr_number}/head:pr-{pr_number}"
-    checkout_command = f"git checkout pr-{pr_number}"
+def check_pr(pr: github_metadata.PullRequest, code_dir, log_dir, quiet=False) -> dict:
+    """
+    Run the checks of a PR checked out in code_dir.
 
-    if (
-        run_command(fetch_command, f"{log_dir}/fetch.log") != 0
-        or run_command(checkout_command, f"{log_dir}/checkout.log") != 0
-    ):
-        print(
-            f"Error: Failed to checkout PR #{pr_number}, see here for details: {log_dir}/fetch.log and {log_dir}/checkout.log"
-        )
-        sys.exit(1)
+    Return the status ("passed" or "<step> failed") and the number of passed
+    and failed tests.
+    """
+    changed_files = pr.changed_files
+    if not DRY_RUN and duration_history.current_commit(code_dir) != pr.head_sha:
+        # the fetched list misses the files of the new commits
+        print(f"PR #{pr.number} was updated after its metadata was fetched, diffing the checkout")
+        changed_files = None
 
     # Step 3: Copy Bazel config to the work dir
     # The modification to "dev" package must happen before using the "./dev" command.
-    bazel_config_dest = os.path.join(code_dir, os.path.basename(BAZEL_CONFIG))
-    shutil.copy(BAZEL_CONFIG, bazel_config_dest)
+    if not DRY_RUN:
+        worktree_pool.install_bazel_config(BAZEL_CONFIG, code_dir)
 
     # Step 4: Run the required commands
+    #
+    # Only the packages whose tests can be affected by the PR are tested.
+    if changed_files is None:
+        changed_files = pr_changed_files(pr.number, code_dir)
+    packages = import_graph.affected_packages(code_dir, changed_files)
+    test_targets = "" if packages is None else " ".join(packages)
     commands = {
         "doctor": "./dev doctor",
         "gen": "./dev gen",
         "lint": "./dev lint",
         # "test": "./dev test",
-        "test": " ./dev test --timeout 10m -- --experimental_remote_cache_eviction_retries 3",
+        "test": f" ./dev test {test_targets} --timeout 10m -- --experimental_remote_cache_eviction_retries 3",
     }
+    if packages == []:
+        print("No package affected by the PR, skip the tests.")
+        del commands["test"]
 
     logs = {}
+    analyzers = {}
+    # (test, duration, passed) of every test
+    tests = []
+    # (step, exit code, duration, log file)
+    steps = []
     for step, command in commands.items():
-        log_file = f"{log_dir}/{step}.log"
+        log_file = framed_log.log_path(f"{log_dir}/{step}.log", COMPRESS_LOGS)
         logs[step] = log_file
-        if run_command(command, log_file) != 0:
+        step_start = time.time()
+        if step == "test" and not DRY_RUN:
+            # analyze the log while the tests are running, the rolling summary
+            # is written next to the log
+            analyzers[step] = log_analyzer.TestLogAnalyzer(
+                TEST_KEYWORDS, result_handler=tests.append
+            )
+            result = live_analysis.run_command(
+                command,
+                log_file,
+                analyzers[step],
+                summary_path=f"{log_dir}/{step}.summary.log",
+                fatal_patterns=FATAL_PATTERNS,
+                cwd=code_dir,
+                # several PRs can be checked at the same time
+                label=f"PR #{pr.number}",
+            )
+            exit_code = result.exit_code
+        else:
+            exit_code = run_command(command, log_file, cwd=code_dir)
+        steps.append((step, exit_code, time.time() - step_start, log_file))
+        if exit_code != 0:
             print(f"Error: {step} failed, see {log_file} for details.")
+            status = f"{step} failed"
             break
     else:
         print("All steps completed successfully.")
+        status = "passed"
 
     # Step 5: Summarize the output
+    result = {
+        "status": status,
+        "passed": 0,
+        "failed": 0,
+        "steps": steps,
+        "tests": [],
+        "errors": [],
+    }
     for step, log_file in logs.items():
         match step:
             case "test":
-                keywords = [
-                    "ERROR",
-                    "FAILED TO BUILD",
-                ]
-                analyaze_test_log(log_file, keywords)
+                analyzer = analyaze_test_log(
+                    log_file,
+                    TEST_KEYWORDS,
+                    tests,
+                    analyzers.get(step),
+                    commit=duration_history.current_commit(code_dir),
+                    report_path=f"{log_dir}/{step}.report.log" if quiet else None,
+                )
+                result["passed"] = analyzer.passed_count
+                result["failed"] = analyzer.failed_count
+                result["tests"] = tests
+            case _ if status == f"{step} failed":
+                # keep the error lines of the failed step
+                analyzer = log_analyzer.analyze_test_log(log_file, TEST_KEYWORDS)
             case _:
                 continue
+        for keyword, lines in analyzer.keyword_lines.items():
+            for offset, line in zip(analyzer.keyword_offsets[keyword], lines):
+                result["errors"].append((step, keyword, offset, line))
+    return result
 
 
-def analyaze_test_log(log_file: str, keywords: list[str]):
-    print(f"=== log file <{log_file}> start ===")
-    with open(log_file, "r") as file:
-        lines = file.readlines()
-
-        for keyword in keywords:
-            print(f"=== {keyword} ===")
-            # Filter lines that contain any of the keywords
-            error_lines = [line for line in lines if keyword in line]
-            if error_lines:
-                print("".join(error_lines))
+def pr_changed_files(pr_number, code_dir) -> list[str]:
+    """
+    Return the files changed by the PR branch since it was branched from master.
+    """
+    result = subprocess.run(
+        ["git", "diff", "--name-only", f"master...pr-{pr_number}"],
+        cwd=code_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0:
+        # e.g. in a dry run, test everything
+        return ["<unknown>"]
+    return [path for path in result.stdout.split("\n") if path]
+
+
+def analyaze_test_log(
+    log_file: str,
+    keywords: list[str],
+    tests: list[tuple[str, float, bool]],
+    analyzer: Optional[log_analyzer.TestLogAnalyzer] = None,
+    commit: Optional[str] = None,
+    report_path: Optional[str] = None,
+) -> log_analyzer.TestLogAnalyzer:
+    """
+    Print the summary of a test log, the log is only read if it hasn't been
+    analyzed while the tests were running. The results of the tests are
+    collected into tests.
 
-        # get the number of lines that contain "NO STATUS"
-        print("=== NO STATUS ===")
-        no_status_lines = [line for line in lines if "NO STATUS" in line]
-        print("number of <NO STATUS> tests:", len(no_status_lines))
+    If report_path is given, the summary is written to this file instead of stdout.
+    """
+    if analyzer is None:
+        analyzer = log_analyzer.analyze_test_log(log_file, keywords, result_handler=tests.append)
+    if report_path:
+        with open(report_path, "w") as file:
+            analyzer.report(log_file, [file])
+    else:
+        analyzer.report(log_file)
 
-        test_results = []
-        for line in lines:
-            match = re.search(
-                r"(?P<test_name>\S+).+PASSED in (?P<duration>\d+\.\ds)", line
-            )
-            if match:
-                test_name = match.group("test_name")
-                duration = float(match.group("duration").replace("s", ""))
-                test_results.append((test_name, duration))
+    # the logs of a dry run have already been recorded
+    if not DRY_RUN:
+        duration_history.record_results(tests, source="check-pr", commit=commit)
+    return analyzer
 
-        # Sort the test results by duration in descending order
-        sorted_results = sorted(test_results, key=lambda x: x[1], reverse=True)
 
-        # Print the top 5 tests with the longest durations
-        print("Top 5 tests with the longest duration:")
-        for test_name, duration in sorted_results[:5]:
-            print(f"{duration}s : {test_name}")
+def check_prs(
+    pr_numbers: list[str], jobs: int, api: str = github_metadata.GITHUB_API
+) -> list[dict]:
+    """
+    Check several PRs concurrently, at most `jobs` at a time, and print a
+    summary table. Return the results in the order of the PRs.
+    """
+    pull_requests = github_metadata.get_pull_requests(pr_numbers, api=api)
+
+    def check(pr_number, pr):
+        if pr is None:
+            return {"pr": pr_number, "title": "", "status": "no metadata"}
+        try:
+            return main(pr, quiet=True)
+        except Exception as e:
+            print(f"Error: PR #{pr_number}: {e!r}")
+            return {"pr": pr_number, "title": pr.title, "status": "error"}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(check, pr_numbers, pull_requests))
+
+    lines = [
+        f"{'PR':<8} {'STATUS':<16} {'PASSED':>6} {'FAILED':>6} {'TIME':>8}  TITLE",
+    ]
+    for result in results:
+        lines.append(
+            f"{result['pr']:<8} {result['status']:<16} {result.get('passed', 0):>6} "
+            f"{result.get('failed', 0):>6} {result.get('duration', 0):>7.0f}s  {result['title']}"
+        )
+    summary = "\n".join(lines)
+    print(summary)
 
-    print(f"=== log file <{log_file}> end ===")
+    if not DRY_RUN:
+        summary_path = os.path.join(os.path.dirname(WORK_DIR_BASE), "check-pr-summary.log")
+        with open(summary_path, "w") as file:
+            file.write(summary + "\n")
+        print(f"summary written to {summary_path}")
+    return results
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: check-pr.py <pr_number>")
-        sys.exit(1)
-
-    pr_number = sys.argv[1]
-    main(pr_number)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check PRs of cockroachdb/cockroach.")
+    parser.add_argument("pr_numbers", nargs="+", metavar="pr_number")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=max(1, min(worktree_pool.POOL_SIZE, (os.cpu_count() or 1) // CPUS_PER_CHECK)),
+        help="number of PRs checked concurrently, default: limited by the worktree pool and the CPUs",
+    )
+    parser.add_argument(
+        "--github-api",
+        default=github_metadata.GITHUB_API,
+        help=f"GitHub API endpoint, default: {github_metadata.GITHUB_API}",
+    )
+    args = parser.parse_args()
+
+    if len(args.pr_numbers) == 1:
+        client = github_metadata.GitHubClient(args.github_api)
+        pr = client.get_pull_request(args.pr_numbers[0])
+        client.close()
+        if pr is None:
+            sys.exit(1)
+        result = main(pr)
+        if result["status"] == "checkout failed":
+            sys.exit(1)
+    else:
+        check_prs(args.pr_numbers, args.jobs, api=args.github_api)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Usage: check_results.py slowest [--last N] [--limit K]
+#        check_results.py errors [--last N] <keyword>
+#        check_results.py steps [--last N]
+#        check_results.py test [--last N] <test>
+# Example: check_results.py slowest --last 50
+# Example: check_results.py errors "FAILED TO BUILD"
+# Example: check_results.py test //pkg/kv/kvserver:kvserver_test
+#
+# A local store of the results of check-pr.py, kept in a SQLite database under
+# ~/.cache, so the results of many PRs can be compared without reading the
+# raw logs again:
+# - checks: one row per check of a PR, with its status and wall time
+# - steps: the exit code and wall time of each step (doctor, gen, lint, test)
+# - tests: the status and duration of each test target
+# - errors: the keyword lines of the logs (e.g. "FAILED TO BUILD"), with their
+#   byte offset in the log
+#
+# "--last N" only considers the latest check of the last N checked PRs.
+
+import os
+import sqlite3
+from typing import Optional
+
+
+RESULTS_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/check-pr-results.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checks (
+    id INTEGER PRIMARY KEY,
+    pr INTEGER NOT NULL,
+    title TEXT,
+    head_sha TEXT,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    log_dir TEXT
+);
+CREATE INDEX IF NOT EXISTS checks_pr ON checks (pr);
+
+CREATE TABLE IF NOT EXISTS steps (
+    check_id INTEGER NOT NULL REFERENCES checks (id),
+    step TEXT NOT NULL,
+    exit_code INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    log_path TEXT
+);
+CREATE INDEX IF NOT EXISTS steps_check ON steps (check_id);
+
+CREATE TABLE IF NOT EXISTS tests (
+    check_id INTEGER NOT NULL REFERENCES checks (id),
+    test TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_check ON tests (check_id);
+CREATE INDEX IF NOT EXISTS tests_test ON tests (test);
+
+CREATE TABLE IF NOT EXISTS errors (
+    check_id INTEGER NOT NULL REFERENCES checks (id),
+    step TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    -- the byte offset of the line in the log of the step
+    log_offset INTEGER,
+    line TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS errors_check ON errors (check_id);
+CREATE INDEX IF NOT EXISTS errors_keyword ON errors (keyword);
+"""
+
+# The latest check of each of the last N checked PRs
+LAST_CHECKS = """
+WITH last_checks AS (
+    SELECT MAX(id) AS id FROM checks
+    GROUP BY pr
+    ORDER BY MAX(started_at) DESC
+    LIMIT ?
+)
+"""
+
+
+def open_results(path: str = RESULTS_PATH) -> sqlite3.Connection:
+    """
+    Open the results database, creating it if it doesn't exist.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_check(
+    pr: int,
+    status: str,
+    started_at: float,
+    duration: float,
+    steps: list[tuple[str, int, float, str]],
+    tests: list[tuple[str, float, bool]],
+    errors: list[tuple[str, str, Optional[int], str]],
+    title: Optional[str] = None,
+    head_sha: Optional[str] = None,
+    log_dir: Optional[str] = None,
+    path: str = RESULTS_PATH,
+) -> int:
+    """
+    Record the check of a PR, return its id.
+
+    Args:
+        steps: (step, exit code, duration in seconds, log path) of each step.
+        tests: (test, duration in seconds, passed) of each test.
+        errors: (step, keyword, byte offset, line) of each keyword line.
+    """
+    conn = open_results(path)
+    with conn:
+        check_id = conn.execute(
+            "INSERT INTO checks (pr, title, head_sha, status, started_at, duration, log_dir) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (pr, title, head_sha, status, started_at, duration, log_dir),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO steps (check_id, step, exit_code, duration, log_path) VALUES (?, ?, ?, ?, ?)",
+            [(check_id, *step) for step in steps],
+        )
+        conn.executemany(
+            "INSERT INTO tests (check_id, test, passed, duration) VALUES (?, ?, ?, ?)",
+            [(check_id, test, int(passed), duration) for test, duration, passed in tests],
+        )
+        conn.executemany(
+            "INSERT INTO errors (check_id, step, keyword, log_offset, line) VALUES (?, ?, ?, ?, ?)",
+            [(check_id, *error) for error in errors],
+        )
+    conn.close()
+    return check_id
+
+
+def slowest_tests(
+    conn: sqlite3.Connection, last: int = 50, limit: int = 20
+) -> list[tuple[str, int, float, float, int]]:
+    """
+    Return the (test, runs, average duration, max duration, failures) of the
+    slowest tests of the last checked PRs, by average duration.
+    """
+    return conn.execute(
+        LAST_CHECKS
+        + """
+        SELECT test, COUNT(*), AVG(duration), MAX(duration), SUM(1 - passed)
+        FROM tests WHERE check_id IN (SELECT id FROM last_checks)
+        GROUP BY test
+        ORDER BY AVG(duration) DESC
+        LIMIT ?
+        """,
+        (last, limit),
+    ).fetchall()
+
+
+def prs_with_error(
+    conn: sqlite3.Connection, keyword: str, last: int = 50
+) -> list[tuple[int, str, str, int, str, Optional[int]]]:
+    """
+    Return the (PR, title, step, number of lines, first line, its offset) of
+    the last checked PRs whose logs contain the keyword.
+    """
+    return conn.execute(
+        LAST_CHECKS
+        + """
+        SELECT checks.pr, checks.title, errors.step, COUNT(*), errors.line, MIN(errors.log_offset)
+        FROM errors JOIN checks ON checks.id = errors.check_id
+        WHERE errors.check_id IN (SELECT id FROM last_checks) AND errors.keyword = ?
+        GROUP BY errors.check_id, errors.step
+        ORDER BY checks.started_at DESC
+        """,
+        (last, keyword),
+    ).fetchall()
+
+
+def step_durations(
+    conn: sqlite3.Connection, last: int = 50
+) -> list[tuple[str, int, float, float, int]]:
+    """
+    Return the (step, runs, average duration, max duration, failures) of the
+    steps of the last checked PRs.
+    """
+    return conn.execute(
+        LAST_CHECKS
+        + """
+        SELECT step, COUNT(*), AVG(duration), MAX(duration), SUM(exit_code != 0)
+        FROM steps WHERE check_id IN (SELECT id FROM last_checks)
+        GROUP BY step
+        ORDER BY AVG(duration) DESC
+        """,
+        (last,),
+    ).fetchall()
+
+
+def test_runs(
+    conn: sqlite3.Connection, test: str, last: int = 50
+) -> list[tuple[int, str, float, int]]:
+    """
+    Return the (PR, title, duration, passed) of a test in the last checked PRs.
+    """
+    return conn.execute(
+        LAST_CHECKS
+        + """
+        SELECT checks.pr, checks.title, tests.duration, tests.passed
+        FROM tests JOIN checks ON checks.id = tests.check_id
+        WHERE tests.check_id IN (SELECT id FROM last_checks) AND tests.test = ?
+        ORDER BY checks.started_at DESC
+        """,
+        (last, test),
+    ).fetchall()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the results of check-pr.py.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--last", type=int, default=50, help="the last N checked PRs, default: 50")
+
+    slowest_parser = subparsers.add_parser("slowest", parents=[common], help="the slowest tests")
+    slowest_parser.add_argument("--limit", type=int, default=20, help="default: 20")
+
+    errors_parser = subparsers.add_parser(
+        "errors", parents=[common], help="the PRs whose logs contain a keyword"
+    )
+    errors_parser.add_argument("keyword", help='e.g. "FAILED TO BUILD"')
+
+    subparsers.add_parser("steps", parents=[common], help="the wall time of the steps")
+
+    test_parser = subparsers.add_parser("test", parents=[common], help="the runs of a test")
+    test_parser.add_argument("test", help="e.g. //pkg/kv/kvserver:kvserver_test")
+
+    args = parser.parse_args()
+    conn = open_results()
+
+    match args.command:
+        case "slowest":
+            print(f"{'AVG':>8} {'MAX':>8} {'RUNS':>5} {'FAILS':>5}  TEST")
+            for test, runs, average, maximum, failures in slowest_tests(
+                conn, args.last, args.limit
+            ):
+                print(f"{average:>7.1f}s {maximum:>7.1f}s {runs:>5} {failures:>5}  {test}")
+        case "errors":
+            for pr, title, step, count, line, offset in prs_with_error(
+                conn, args.keyword, args.last
+            ):
+                print(f"PR #{pr} ({step}, {count} lines): {title}")
+                print(f"  {offset}: {line.rstrip()}")
+        case "steps":
+            print(f"{'AVG':>8} {'MAX':>8} {'RUNS':>5} {'FAILS':>5}  STEP")
+            for step, runs, average, maximum, failures in step_durations(conn, args.last):
+                print(f"{average:>7.1f}s {maximum:>7.1f}s {runs:>5} {failures:>5}  {step}")
+        case "test":
+            for pr, title, duration, passed in test_runs(conn, args.test, args.last):
+                status = "PASSED" if passed else "FAILED"
+                print(f"PR #{pr}: {status} in {duration:.1f}s  {title}")
+
+    conn.close()
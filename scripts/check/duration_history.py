@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Usage: duration_history.py [--window N] [--threshold RATIO]
+#
+# A local store of the test durations measured by run-tests.py, check-pr.py
+# and pre-push.py, kept in a SQLite database under ~/.cache.
+#
+# The resources used by the tests run by run-tests.py (CPU time, peak RSS and
+# I/O) are kept too, to cap the number of concurrent tests by memory.
+#
+# Run as a script, it prints the tests whose recent runs are slower than their
+# older runs.
+#
+# The tests are named as follows:
+# - "pkg/subpkg:TestName" for the tests run by run-tests.py
+# - "//pkg/subpkg:subpkg_test" for the Bazel targets parsed from the logs
+
+import hashlib
+import os
+import sqlite3
+import subprocess
+import time
+from typing import Optional
+
+
+HISTORY_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/test-history.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    test TEXT NOT NULL,
+    duration REAL NOT NULL,
+    passed INTEGER NOT NULL,
+    git_commit TEXT,
+    source TEXT NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_test ON runs (test);
+
+CREATE TABLE IF NOT EXISTS resources (
+    id INTEGER PRIMARY KEY,
+    test TEXT NOT NULL,
+    cpu_time REAL NOT NULL,
+    peak_rss INTEGER NOT NULL,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    git_commit TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resources_test ON resources (test);
+"""
+
+
+def open_history(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    """
+    Open the history database, creating it if it doesn't exist.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def current_commit(cwd: Optional[str] = None) -> Optional[str]:
+    """
+    Return the commit checked out in the given directory, or None if it isn't a git repo.
+    """
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+def record_results(
+    results: list[tuple[str, float, bool]],
+    source: str,
+    commit: Optional[str] = None,
+    path: str = HISTORY_PATH,
+):
+    """
+    Record a list of (test, duration in seconds, passed) measured by the given source.
+    """
+    if not results:
+        return
+
+    now = time.time()
+    conn = open_history(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO runs (test, duration, passed, git_commit, source, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (test, duration, int(passed), commit, source, now)
+                for test, duration, passed in results
+            ],
+        )
+    conn.close()
+
+
+def record_resources(
+    resources: list[tuple[str, float, int, Optional[int], Optional[int]]],
+    commit: Optional[str] = None,
+    path: str = HISTORY_PATH,
+):
+    """
+    Record a list of (test, CPU time in seconds, peak RSS in bytes, bytes read,
+    bytes written).
+    """
+    if not resources:
+        return
+
+    now = time.time()
+    conn = open_history(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO resources (test, cpu_time, peak_rss, read_bytes, write_bytes, git_commit, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*resource, commit, now) for resource in resources],
+        )
+    conn.close()
+
+
+def expected_peak_rss(
+    tests: list[str], window: int = 5, path: str = HISTORY_PATH
+) -> dict[str, int]:
+    """
+    Return the largest peak RSS of the last runs of each test.
+
+    Tests without any recorded run are left out.
+    """
+    conn = open_history(path)
+    peaks = {}
+    for test in tests:
+        row = conn.execute(
+            "SELECT MAX(peak_rss) FROM (SELECT peak_rss FROM resources WHERE test = ? ORDER BY id DESC LIMIT ?)",
+            (test, window),
+        ).fetchone()
+        if row[0] is not None:
+            peaks[test] = row[0]
+    conn.close()
+    return peaks
+
+
+def expected_durations(
+    tests: list[str], window: int = 5, path: str = HISTORY_PATH
+) -> dict[str, float]:
+    """
+    Return the average duration of the last runs of each test.
+
+    Tests without any recorded run are left out.
+    """
+    conn = open_history(path)
+    durations = {}
+    for test in tests:
+        row = conn.execute(
+            "SELECT AVG(duration) FROM (SELECT duration FROM runs WHERE test = ? ORDER BY id DESC LIMIT ?)",
+            (test, window),
+        ).fetchone()
+        if row[0] is not None:
+            durations[test] = row[0]
+    conn.close()
+    return durations
+
+
+def longest_first(tests: list[str], durations: dict[str, float]) -> list[str]:
+    """
+    Order the tests longest-processing-time first.
+
+    Tests without a known duration are assumed to be the slowest, so they are
+    started first and get a duration on the next run.
+    """
+    return sorted(tests, key=lambda test: durations.get(test, float("inf")), reverse=True)
+
+
+def shard(tests: list[str], shard_count: int) -> list[list[str]]:
+    """
+    Split the tests into shard_count buckets by a hash of their name.
+
+    The buckets only depend on the names, not on the local history, so every
+    shard (on any machine, before or after the other shards ran) sees the same
+    split, and each test runs in exactly one shard.
+    """
+    buckets = [[] for _ in range(shard_count)]
+    for test in tests:
+        digest = hashlib.sha256(test.encode()).digest()
+        buckets[int.from_bytes(digest[:8], "big") % shard_count].append(test)
+    return buckets
+
+
+def slowdowns(
+    window: int = 5, threshold: float = 1.2, path: str = HISTORY_PATH
+) -> list[tuple[str, float, float]]:
+    """
+    Find the tests whose last `window` passing runs are slower than the
+    `window` passing runs before them by more than the given ratio.
+
+    Return a list of (test, older average, recent average), the largest
+    slowdown first.
+    """
+    conn = open_history(path)
+    tests = [
+        row[0]
+        for row in conn.execute(
+            "SELECT test FROM runs WHERE passed = 1 GROUP BY test HAVING COUNT(*) >= ?",
+            (2 * window,),
+        )
+    ]
+
+    result = []
+    for test in tests:
+        durations = [
+            row[0]
+            for row in conn.execute(
+                "SELECT duration FROM runs WHERE test = ? AND passed = 1 ORDER BY id DESC LIMIT ?",
+                (test, 2 * window),
+            )
+        ]
+        recent = sum(durations[:window]) / window
+        older = sum(durations[window:]) / window
+        if older > 0 and recent / older > threshold:
+            result.append((test, older, recent))
+    conn.close()
+
+    result.sort(key=lambda x: x[2] / x[1], reverse=True)
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Print the tests that are getting slower."
+    )
+    parser.add_argument(
+        "--window", type=int, default=5, help="number of runs to average, default: 5"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="slowdown ratio to report, default: 1.2"
+    )
+    args = parser.parse_args()
+
+    for test, older, recent in slowdowns(args.window, args.threshold):
+        print(f"{older:.1f}s -> {recent:.1f}s ({recent / older:.2f}x) : {test}")
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Usage: github_metadata.py [--github-api URL] <pr_number> ...
+# Example: github_metadata.py 127584
+#
+# Fetch the metadata of the PRs of cockroachdb/cockroach: title, head commit,
+# base branch and changed files.
+#
+# The responses of the GitHub API are cached on disk with their ETag and
+# revalidated with conditional requests (If-None-Match), so checking a PR
+# again costs a single "304 Not Modified" call, which doesn't count against
+# the rate limit of authenticated requests. The changed files are only
+# fetched again when the head commit of the PR changed. If the API can't be
+# reached or the rate limit is exceeded, the cached metadata is used.
+#
+# Set GITHUB_TOKEN to authenticate the requests.
+#
+# This module is used by check-pr.py.
+
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+GITHUB_API = os.environ.get("GITHUB_API", "https://api.github.com")
+GITHUB_REPO = "cockroachdb/cockroach"
+
+CACHE_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/github-cache.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    body TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+# The files endpoint returns at most this many files per page, and at most
+# MAX_FILES files in total
+FILES_PER_PAGE = 100
+MAX_FILES = 3000
+
+
+@dataclass
+class PullRequest:
+    number: int
+    title: str
+    head_sha: str
+    base_ref: str
+    # None if the PR changes more files than the API returns
+    changed_files: Optional[list[str]] = field(default=None)
+
+
+def open_cache(path: str = CACHE_PATH) -> sqlite3.Connection:
+    """
+    Open the cache database, creating it if it doesn't exist.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class GitHubClient:
+    """
+    A client of the GitHub REST API, with keep-alive connections and an
+    on-disk cache of the responses.
+
+    Args:
+        api (str, optional): Defaults to GITHUB_API.
+        token (Optional[str], optional): Defaults to the GITHUB_TOKEN environment variable.
+        pool_size (int, optional): The number of connections kept alive. Defaults to 10.
+        cache_path (str, optional): Defaults to CACHE_PATH.
+    """
+
+    def __init__(
+        self,
+        api: str = GITHUB_API,
+        token: Optional[str] = None,
+        pool_size: int = 10,
+        cache_path: str = CACHE_PATH,
+    ):
+        self.api = api.rstrip("/")
+        self.cache_path = cache_path
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        token = token or os.environ.get("GITHUB_TOKEN")
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def close(self):
+        self.session.close()
+
+    def cached(self, url: str) -> Optional[tuple[Optional[str], str]]:
+        conn = open_cache(self.cache_path)
+        row = conn.execute(
+            "SELECT etag, body FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        conn.close()
+        return row
+
+    def store(self, url: str, etag: Optional[str], body: str):
+        conn = open_cache(self.cache_path)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (url, etag, body, fetched_at) VALUES (?, ?, ?, ?)",
+                (url, etag, body, time.time()),
+            )
+        conn.close()
+
+    def get_json(
+        self, url: str, conditional: bool = True
+    ) -> tuple[Optional[object], Optional[str]]:
+        """
+        Return the JSON body of a GET request and the URL of the next page.
+
+        If conditional is True, the response is cached and revalidated with
+        its ETag. Return (None, None) if the request failed and nothing is cached.
+        """
+        cached = self.cached(url) if conditional else None
+        headers = {}
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            print(f"GitHub request failed: {url}: {e}")
+            response = None
+
+        next_url = None
+        if response is not None:
+            next_url = response.links.get("next", {}).get("url")
+            if response.status_code == 304 and cached:
+                return json.loads(cached[1]), next_url
+            if response.status_code == 200:
+                if conditional:
+                    self.store(url, response.headers.get("ETag"), response.text)
+                return response.json(), next_url
+
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = time.localtime(int(response.headers.get("X-RateLimit-Reset", "0")))
+                print(f"GitHub rate limit exceeded until {time.strftime('%H:%M:%S', reset)}")
+            else:
+                print(f"GitHub request failed: {url}: {response.status_code}")
+
+        if cached:
+            print(f"using the cached response of {url}")
+            return json.loads(cached[1]), None
+        return None, None
+
+    def get_pull_request(self, pr_number) -> Optional[PullRequest]:
+        """
+        Return the metadata of a PR, or None if it can't be fetched.
+        """
+        url = f"{self.api}/repos/{GITHUB_REPO}/pulls/{pr_number}"
+        pull, _ = self.get_json(url)
+        if pull is None:
+            return None
+
+        pr = PullRequest(
+            number=pull["number"],
+            title=pull.get("title", "Unknown PR"),
+            head_sha=pull["head"]["sha"],
+            base_ref=pull["base"]["ref"],
+        )
+        if pull.get("changed_files", 0) <= MAX_FILES:
+            pr.changed_files = self.get_changed_files(pr_number, pr.head_sha)
+        return pr
+
+    def get_changed_files(self, pr_number, head_sha: str) -> Optional[list[str]]:
+        """
+        Return the files changed by the PR at the given head commit, renamed
+        files are listed with both their old and new paths.
+        """
+        # the files only change with the head commit, which is part of the
+        # cache key, so a cached list is never revalidated. The pages are
+        # fetched unconditionally, a "304 Not Modified" has no link to the
+        # next page.
+        files_url = f"{self.api}/repos/{GITHUB_REPO}/pulls/{pr_number}/files"
+        key = f"{files_url}#{head_sha}"
+        cached = self.cached(key)
+        if cached:
+            return json.loads(cached[1])
+
+        changed_files = []
+        url = f"{files_url}?per_page={FILES_PER_PAGE}"
+        while url:
+            files, url = self.get_json(url, conditional=False)
+            if files is None:
+                return None
+            for file in files:
+                changed_files.append(file["filename"])
+                if "previous_filename" in file:
+                    changed_files.append(file["previous_filename"])
+
+        self.store(key, None, json.dumps(changed_files))
+        return changed_files
+
+
+def get_pull_requests(
+    pr_numbers: list, api: str = GITHUB_API
+) -> list[Optional[PullRequest]]:
+    """
+    Return the metadata of several PRs, fetched concurrently over one pool of
+    connections. The metadata of a PR is None if it can't be fetched.
+    """
+    client = GitHubClient(api, pool_size=len(pr_numbers))
+    with ThreadPoolExecutor(max_workers=len(pr_numbers)) as executor:
+        pull_requests = list(executor.map(client.get_pull_request, pr_numbers))
+    client.close()
+    return pull_requests
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fetch the metadata of PRs.")
+    parser.add_argument("pr_numbers", nargs="+", metavar="pr_number")
+    parser.add_argument(
+        "--github-api", default=GITHUB_API, help=f"GitHub API endpoint, default: {GITHUB_API}"
+    )
+    args = parser.parse_args()
+
+    for pr in get_pull_requests(args.pr_numbers, api=args.github_api):
+        if pr is None:
+            continue
+        print(f"PR #{pr.number}: {pr.title}")
+        print(f"  head: {pr.head_sha}, base: {pr.base_ref}")
+        if pr.changed_files is None:
+            print("  changed files: too many to list")
+        else:
+            print(f"  changed files: {len(pr.changed_files)}")
+            for path in pr.changed_files:
+                print(f"    {path}")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Usage: go_test_index.py [--root DIR] [--match REGEX] [--subtests] <package_pattern>
+# Example: go_test_index.py pkg/kv/...
+# Example: go_test_index.py --match Rangefeed pkg/ccl/changefeedccl
+#
+# An on-disk index of the Go tests of a tree: the test functions (including
+# TestMain) and the subtests with a literal name (t.Run("name", ...)), with
+# their file, line and package.
+#
+# The "_test.go" files are scanned in a process pool, and only the files whose
+# mtime changed since the last scan are scanned again.
+#
+# This module is used by run-tests.py.
+
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+
+# bumped when the scanning changes, so the files are scanned again
+INDEX_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/go-test-index-v2.db")
+
+SKIPPED_DIRS = {"testdata", "node_modules", "vendor", ".git"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    package TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (root, path)
+);
+
+CREATE TABLE IF NOT EXISTS tests (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    package TEXT NOT NULL,
+    name TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    -- "test", "subtest" or "main"
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_package ON tests (root, package);
+CREATE INDEX IF NOT EXISTS tests_path ON tests (root, path);
+"""
+
+# "go test" only runs the functions named "Test" or "Test" followed by a
+# character which isn't a lowercase letter (e.g. not "Testfoo")
+TEST_FUNC = re.compile(
+    r"^func\s+(Test(?:[A-Z0-9_]\w*)?)\s*\(\s*\w+\s+\*testing\.(T|M)\s*\)"
+)
+SUBTEST = re.compile(r'\bt\.Run\(\s*"([^"]*)"')
+
+
+def open_index(path: str = INDEX_PATH) -> sqlite3.Connection:
+    """
+    Open the index database, creating it if it doesn't exist.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def like_prefix(prefix: str) -> str:
+    """
+    Return a LIKE pattern (with ESCAPE '\\') matching the strings starting with
+    the prefix, the "_" and "%" of the prefix being matched literally.
+    """
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def scan_file(root: str, path: str) -> list[tuple[str, int, str]]:
+    """
+    Return the (name, line, kind) of the tests of a Go test file.
+
+    A subtest is named after its enclosing test, with the spaces replaced by
+    underscores as "go test -run" expects, e.g. "TestFoo/bar_baz".
+    """
+    tests = []
+    current_test = None
+    with open(os.path.join(root, path), "r", errors="replace") as file:
+        for line_number, line in enumerate(file, start=1):
+            if line.startswith("func "):
+                match = TEST_FUNC.match(line)
+                if match is None:
+                    current_test = None
+                elif match.group(2) == "M":
+                    current_test = None
+                    tests.append((match.group(1), line_number, "main"))
+                else:
+                    current_test = match.group(1)
+                    tests.append((current_test, line_number, "test"))
+                continue
+
+            if current_test and "t.Run(" in line:
+                for name in SUBTEST.findall(line):
+                    name = name.replace(" ", "_")
+                    tests.append((f"{current_test}/{name}", line_number, "subtest"))
+    return tests
+
+
+def walk_test_files(root: str, subtree: str) -> dict[str, float]:
+    """
+    Return the mtime of every "_test.go" file under the subtree, keyed by
+    path relative to the root.
+    """
+    files = {}
+    for directory, dirs, entries in os.walk(os.path.join(root, subtree)):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+        for entry in entries:
+            if entry.endswith("_test.go"):
+                full_path = os.path.join(directory, entry)
+                files[os.path.relpath(full_path, root)] = os.path.getmtime(full_path)
+    return files
+
+
+def refresh(
+    conn: sqlite3.Connection, root: str, subtree: str = "pkg", jobs: Optional[int] = None
+) -> int:
+    """
+    Bring the index of the subtree up to date, return the number of scanned files.
+    """
+    root = os.path.abspath(root)
+    subtree = os.path.normpath(subtree)
+    prefix = "" if subtree == "." else subtree + "/"
+
+    current = walk_test_files(root, subtree)
+    recorded = {
+        path: mtime
+        for path, mtime in conn.execute(
+            "SELECT path, mtime FROM files WHERE root = ? AND path LIKE ? ESCAPE '\\'",
+            (root, like_prefix(prefix)),
+        )
+    }
+
+    removed = [path for path in recorded if path not in current]
+    stale = [path for path, mtime in current.items() if recorded.get(path) != mtime]
+
+    scanned = []
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            scanned = list(
+                executor.map(scan_file, [root] * len(stale), stale, chunksize=64)
+            )
+
+    with conn:
+        for path in removed + stale:
+            conn.execute("DELETE FROM files WHERE root = ? AND path = ?", (root, path))
+            conn.execute("DELETE FROM tests WHERE root = ? AND path = ?", (root, path))
+
+        for path, tests in zip(stale, scanned):
+            package = os.path.dirname(path)
+            conn.execute(
+                "INSERT INTO files (root, path, package, mtime) VALUES (?, ?, ?, ?)",
+                (root, path, package, current[path]),
+            )
+            conn.executemany(
+                "INSERT INTO tests (root, path, package, name, line, kind) VALUES (?, ?, ?, ?, ?, ?)",
+                [(root, path, package, name, line, kind) for name, line, kind in tests],
+            )
+
+    return len(stale)
+
+
+def query(
+    conn: sqlite3.Connection,
+    root: str,
+    package_pattern: str,
+    match: Optional[str] = None,
+    kinds: tuple[str, ...] = ("test",),
+) -> list[tuple[str, str, str, int]]:
+    """
+    Return the (package, name, file, line) of the tests of the packages
+    matching the pattern, ordered by package, file and line.
+
+    The pattern is either a package (e.g. "pkg/kv") or a package and all the
+    packages below it (e.g. "pkg/kv/..."). If match is given, only the tests
+    whose name matches this regex are returned.
+    """
+    root = os.path.abspath(root)
+    pattern = os.path.normpath(package_pattern.removesuffix("..."))
+    if package_pattern.endswith("..."):
+        condition = "(package = ? OR package LIKE ? ESCAPE '\\')"
+        args = [pattern, like_prefix(pattern + "/")]
+    else:
+        condition = "package = ?"
+        args = [pattern]
+
+    rows = conn.execute(
+        f"""
+        SELECT package, name, path, line FROM tests
+        WHERE root = ? AND {condition} AND kind IN ({", ".join("?" for _ in kinds)})
+        ORDER BY package, path, line
+        """,
+        [root, *args, *kinds],
+    ).fetchall()
+
+    if match:
+        regex = re.compile(match)
+        rows = [row for row in rows if regex.search(row[1])]
+    return rows
+
+
+def find_tests(
+    root: str,
+    package_pattern: str,
+    match: Optional[str] = None,
+    kinds: tuple[str, ...] = ("test",),
+) -> list[tuple[str, str, str, int]]:
+    """
+    Refresh the index for the packages matching the pattern and query it, see query().
+    """
+    subtree = os.path.normpath(package_pattern.removesuffix("..."))
+    conn = open_index()
+    refresh(conn, root, subtree)
+    tests = query(conn, root, package_pattern, match=match, kinds=kinds)
+    conn.close()
+    return tests
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List the Go tests of a tree.")
+    parser.add_argument("package_pattern", help="e.g. pkg/kv or pkg/kv/...")
+    parser.add_argument("--root", default=".", help="root of the repo, default: .")
+    parser.add_argument("--match", help="only the tests whose name matches this regex")
+    parser.add_argument("--subtests", action="store_true", help="include the subtests")
+    args = parser.parse_args()
+
+    kinds = ("test", "subtest") if args.subtests else ("test",)
+    for package, name, path, line in find_tests(
+        args.root, args.package_pattern, match=args.match, kinds=kinds
+    ):
+        print(f"{package}:{name} ({path}:{line})")
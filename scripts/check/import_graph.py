@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Usage: import_graph.py <cockroach_dir> <changed_file> ...
+# Example: import_graph.py ~/code/cockroach pkg/util/hlc/hlc.go
+#
+# Map the changed files of the cockroach repo to the packages whose tests can
+# be affected by them, using a reverse import graph built from the import
+# blocks of the ".go" files.
+#
+# The imports of each file are cached on disk by relative path, and are only
+# parsed again when the content of the file changed (checked by mtime and size
+# first, then by content hash), so the cache can be shared by several clones.
+#
+# This module is used by pre-push.py and check-pr.py.
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import defaultdict
+from typing import Optional
+
+
+CACHE_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/import-graph.json")
+
+GO_MODULE = "github.com/cockroachdb/cockroach"
+
+# The directories that never contain packages we want to test
+SKIPPED_DIRS = {"testdata", "node_modules", "vendor", ".git"}
+
+IMPORT_SPEC = re.compile(r'^\s*(?:[\w.]+\s+)?"([^"]+)"', re.MULTILINE)
+IMPORT_BLOCK = re.compile(r"^import\s*\(([^)]*)\)", re.MULTILINE)
+SINGLE_IMPORT = re.compile(r'^import\s+(?:[\w.]+\s+)?"([^"]+)"', re.MULTILINE)
+# The first top-level declaration, the imports are always before it
+FIRST_DECL = re.compile(r"^(?:func|type|var|const)\b", re.MULTILINE)
+
+
+def parse_imports(content: str) -> list[str]:
+    """
+    Return the packages of the cockroach repo imported by a Go file, relative
+    to the root of the repo (e.g. "pkg/util/hlc").
+    """
+    match = FIRST_DECL.search(content)
+    header = content[: match.start()] if match else content
+
+    imports = SINGLE_IMPORT.findall(header)
+    for block in IMPORT_BLOCK.findall(header):
+        imports.extend(IMPORT_SPEC.findall(block))
+
+    prefix = GO_MODULE + "/"
+    return sorted({path[len(prefix) :] for path in imports if path.startswith(prefix)})
+
+
+def load_cache(path: str = CACHE_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_cache(cache: dict, path: str = CACHE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a temporary file per writer, the concurrent checks of check-pr.py save
+    # the cache at the same time
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".import-graph-")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(cache, file)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def scan_tree(root: str, cache_path: str = CACHE_PATH) -> dict[str, dict]:
+    """
+    Return the imports of every Go file under "pkg/", keyed by relative path,
+    refreshing the on-disk cache.
+    """
+    if not os.path.isdir(os.path.join(root, "pkg")):
+        # not a cockroach tree, don't overwrite the cache of the real ones
+        return {}
+
+    cache = load_cache(cache_path)
+    files = {}
+    changed = False
+
+    for directory, dirs, entries in os.walk(os.path.join(root, "pkg")):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+        for entry in entries:
+            if not entry.endswith(".go"):
+                continue
+
+            full_path = os.path.join(directory, entry)
+            path = os.path.relpath(full_path, root)
+            stat = os.stat(full_path)
+
+            record = cache.get(path)
+            if record and record["mtime"] == stat.st_mtime and record["size"] == stat.st_size:
+                files[path] = record
+                continue
+
+            with open(full_path, "rb") as file:
+                data = file.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if record is None or record["hash"] != digest:
+                record = {"imports": parse_imports(data.decode(errors="replace"))}
+            record.update(mtime=stat.st_mtime, size=stat.st_size, hash=digest)
+            files[path] = record
+            changed = True
+
+    if changed or len(files) != len(cache):
+        save_cache(files, cache_path)
+    return files
+
+
+def package_of(root: str, path: str) -> Optional[str]:
+    """
+    Return the package a changed file belongs to: the closest directory with
+    Go files, so a change in "testdata" belongs to the package using it.
+
+    Return None if the file isn't under "pkg/".
+    """
+    if not path.startswith("pkg/"):
+        return None
+
+    directory = os.path.dirname(path)
+    while directory != "pkg":
+        full_dir = os.path.join(root, directory)
+        if os.path.isdir(full_dir) and any(
+            entry.endswith(".go") for entry in os.listdir(full_dir)
+        ):
+            return directory
+        directory = os.path.dirname(directory)
+    return None
+
+
+def affected_packages(root: str, changed_files: list[str]) -> Optional[list[str]]:
+    """
+    Return the packages with tests which can be affected by the changed files:
+    - the packages of the changed files
+    - the packages importing them, transitively
+    - the packages whose tests import any of the above
+
+    Return None if a file outside of "pkg/" changed, in which case all the
+    tests can be affected.
+    """
+    # checked before scanning the tree, which isn't needed then
+    if any(not path.startswith("pkg/") for path in changed_files):
+        return None
+
+    files = scan_tree(root)
+
+    # package -> packages importing it from non-test files
+    importers = defaultdict(set)
+    # package -> packages importing it from test files
+    test_importers = defaultdict(set)
+    packages_with_tests = set()
+    for path, record in files.items():
+        package = os.path.dirname(path)
+        is_test = path.endswith("_test.go")
+        if is_test:
+            packages_with_tests.add(package)
+        for imported in record["imports"]:
+            (test_importers if is_test else importers)[imported].add(package)
+
+    changed_packages = set()
+    for path in changed_files:
+        package = package_of(root, path)
+        if package:
+            changed_packages.add(package)
+
+    # the dependents are affected transitively through the non-test imports
+    closure = set(changed_packages)
+    queue = list(changed_packages)
+    while queue:
+        package = queue.pop()
+        for importer in importers[package]:
+            if importer not in closure:
+                closure.add(importer)
+                queue.append(importer)
+
+    # tests don't propagate further
+    affected = set(closure)
+    for package in closure:
+        affected |= test_importers[package]
+
+    return sorted(affected & packages_with_tests)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} <cockroach_dir> <changed_file> ...")
+        sys.exit(1)
+
+    packages = affected_packages(os.path.expanduser(sys.argv[1]), sys.argv[2:])
+    if packages is None:
+        print("all packages")
+    else:
+        for package in packages:
+            print(package)
@@ -0,0 +1,118 @@
+# Analyze the output of a command while the command is still running.
+#
+# The lines of the output are fed to a log_analyzer.TestLogAnalyzer as soon as
+# they are written, a rolling summary is published to a file and the terminal,
+# and the command can be aborted as soon as a fatal pattern shows up (e.g.
+# "FAILED TO BUILD").
+#
+# This module is used by check-pr.py and pre-push.py.
+
+import os
+import time
+from typing import Optional
+
+import log_analyzer
+
+import command_runner
+
+
+class LiveAnalysis:
+    """
+    Feed the lines of a running command to an analyzer.
+
+    Args:
+        log_path (str): The log file of the command, used in the summary.
+        analyzer (log_analyzer.TestLogAnalyzer): The analyzer fed with the lines.
+        summary_path (Optional[str], optional): The file where the rolling summary is
+            written every interval seconds. Defaults to None.
+        interval (float, optional): Defaults to 10 seconds.
+        label (Optional[str], optional): Prefixed to the status lines, to tell
+            apart the commands running at the same time. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        log_path: str,
+        analyzer: log_analyzer.TestLogAnalyzer,
+        summary_path: Optional[str] = None,
+        interval: float = 10,
+        label: Optional[str] = None,
+    ):
+        self.log_path = log_path
+        self.analyzer = analyzer
+        self.summary_path = summary_path
+        self.interval = interval
+        self.prefix = f"[live {label}]" if label else "[live]"
+        self.last_publish = time.time()
+
+    def feed(self, line: str):
+        self.analyzer.feed(line)
+        if time.time() - self.last_publish >= self.interval:
+            self.publish()
+
+    def publish(self):
+        """
+        Write the rolling summary to the summary file and a status line to stdout.
+        """
+        self.last_publish = time.time()
+
+        analyzer = self.analyzer
+        keyword_counts = ", ".join(
+            f"{keyword}: {count}" for keyword, count in analyzer.keyword_counts.items()
+        )
+        print(
+            f"{self.prefix} {analyzer.passed_count} passed, {analyzer.failed_count} failed, {analyzer.no_status_count} no status, {keyword_counts}"
+        )
+
+        if self.summary_path:
+            # write to a temporary file first so readers never see a partial summary
+            tmp_path = f"{self.summary_path}.tmp"
+            with open(tmp_path, "w") as file:
+                analyzer.report(self.log_path, [file])
+            os.replace(tmp_path, self.summary_path)
+
+
+def run_command(
+    command: str,
+    log_path: str,
+    analyzer: log_analyzer.TestLogAnalyzer,
+    summary_path: Optional[str] = None,
+    fatal_patterns: Optional[list[str]] = None,
+    capture_patterns: Optional[list[str]] = None,
+    interval: float = 10,
+    cwd: Optional[str] = None,
+    stream_output: bool = False,
+    label: Optional[str] = None,
+) -> command_runner.CommandResult:
+    """
+    Run a command with its output (stdout and stderr) written to a log file,
+    analyzing the output while the command is running.
+
+    The command is killed (with its whole process group, e.g. the Bazel client)
+    as soon as one of the fatal patterns shows up.
+
+    The lines containing the capture patterns are kept in the result, see
+    command_runner.run(). If stream_output is True, the output is also written
+    to stdout, between the rolling summaries. The status lines are prefixed
+    with the label, if any.
+    """
+    live = LiveAnalysis(
+        log_path, analyzer, summary_path=summary_path, interval=interval, label=label
+    )
+
+    print(f"running command: {command}, log file: {log_path}")
+    result = command_runner.run_command(
+        command,
+        log_path=log_path,
+        line_handlers=[live.feed],
+        kill_on_output=fatal_patterns,
+        capture_patterns=capture_patterns,
+        cwd=cwd,
+        stream_output=stream_output,
+    )
+    live.publish()
+
+    if result.killed_on:
+        print(f"{live.prefix} aborted on fatal pattern <{result.killed_on}>")
+    print(f"command finished in {result.duration:.2f} seconds.")
+    return result
@@ -0,0 +1,199 @@
+# A single-pass analyzer for the logs of "./dev test".
+#
+# The log is streamed line by line, and the analyzer uses constant memory
+# whatever the size of the log:
+# - all the keywords are matched with one precompiled alternation, the lines
+#   that match it are then attributed to each keyword, the lines of a keyword
+#   are counted but only the first MAX_KEYWORD_LINES are kept
+# - the tests are counted, only the top N slowest tests are kept, in a bounded
+#   heap; a caller which needs the result of every test (e.g. to record the
+#   durations) gets them one by one through result_handler
+#
+# This module is used by check-pr.py, pre-push.py and analyze-test-log.py.
+
+import heapq
+import re
+import sys
+from typing import Callable, Iterable, Optional, TextIO
+
+import framed_log
+
+
+# Lines like:
+# //pkg/kv/kvserver:kvserver_test                                PASSED in 245.3s
+DURATION_PATTERN = re.compile(
+    r"(?P<test_name>\S+).+(?P<status>PASSED|FAILED) in (?P<duration>\d+\.\ds)"
+)
+
+NO_STATUS = "NO STATUS"
+
+# The number of lines kept for each keyword, the others are only counted
+MAX_KEYWORD_LINES = 100
+
+
+class TestLogAnalyzer:
+    """
+    Collect the summary of a test log, one line at a time.
+
+    Args:
+        keywords (list[str]): The lines containing any of these keywords are kept.
+        top_n (int, optional): The number of slowest tests to keep. Defaults to 5.
+        counters (Optional[dict[str, re.Pattern]], optional): Count the lines
+            matching each pattern, reported under the given names. Defaults to None.
+        result_handler (Optional[Callable], optional): Called with the
+            (test name, duration, passed) of every test. Defaults to None.
+        max_keyword_lines (int, optional): The number of lines kept for each
+            keyword. Defaults to MAX_KEYWORD_LINES.
+    """
+
+    def __init__(
+        self,
+        keywords: list[str],
+        top_n: int = 5,
+        counters: Optional[dict[str, re.Pattern]] = None,
+        result_handler: Optional[Callable[[tuple[str, float, bool]], None]] = None,
+        max_keyword_lines: int = MAX_KEYWORD_LINES,
+    ):
+        self.keywords = keywords
+        self.top_n = top_n
+        self.counters = counters or {}
+        self.result_handler = result_handler
+        self.max_keyword_lines = max_keyword_lines
+
+        self.keyword_pattern = re.compile(
+            "|".join(re.escape(keyword) for keyword in keywords + [NO_STATUS])
+        )
+
+        # the first lines of each keyword, and their byte offsets in the log
+        self.keyword_lines = {keyword: [] for keyword in keywords}
+        self.keyword_offsets = {keyword: [] for keyword in keywords}
+        self.keyword_counts = {keyword: 0 for keyword in keywords}
+        # the byte offset of the next line fed, only exact if the log is valid
+        # UTF-8 (the invalid bytes are decoded as one replacement character)
+        self.offset = 0
+        self.no_status_count = 0
+        self.counts = {name: 0 for name in self.counters}
+        # (duration, test name) of the slowest passed tests, smallest first
+        self.slowest = []
+        self.passed_count = 0
+        self.failed_count = 0
+
+    def feed(self, line: str):
+        offset = self.offset
+        self.offset += len(line) if line.isascii() else len(line.encode())
+
+        if self.keyword_pattern.search(line):
+            for keyword in self.keywords:
+                if keyword in line:
+                    self.add_keyword_line(keyword, offset, line)
+            if NO_STATUS in line:
+                self.no_status_count += 1
+
+        if "PASSED in " in line or "FAILED in " in line:
+            match = DURATION_PATTERN.search(line)
+            if match:
+                self.add_result(
+                    match.group("test_name"),
+                    float(match.group("duration").replace("s", "")),
+                    match.group("status") == "PASSED",
+                )
+
+        for name, pattern in self.counters.items():
+            if pattern.search(line):
+                self.counts[name] += 1
+
+    def feed_lines(self, lines: Iterable[str]):
+        for line in lines:
+            self.feed(line)
+
+    def add_keyword_line(self, keyword: str, offset: int, line: str):
+        self.keyword_counts[keyword] += 1
+        if len(self.keyword_lines[keyword]) < self.max_keyword_lines:
+            self.keyword_lines[keyword].append(line)
+            self.keyword_offsets[keyword].append(offset)
+
+    def add_result(self, test_name: str, duration: float, passed: bool):
+        if self.result_handler:
+            self.result_handler((test_name, duration, passed))
+        if not passed:
+            self.failed_count += 1
+            return
+        self.passed_count += 1
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, (duration, test_name))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, test_name))
+
+    def slowest_tests(self) -> list[tuple[str, float]]:
+        """
+        Return the (test name, duration) of the slowest passed tests, slowest first.
+        """
+        return [
+            (test_name, duration)
+            for duration, test_name in sorted(self.slowest, reverse=True)
+        ]
+
+    def report(
+        self,
+        log_path: str,
+        outputs: Optional[list[TextIO]] = None,
+        show_offsets: bool = False,
+    ):
+        """
+        Print the summary of the log to each of the outputs, stdout by default.
+
+        If show_offsets is True, the keyword lines are prefixed with their byte
+        offset in the log.
+        """
+        if outputs is None:
+            outputs = [sys.stdout]
+
+        def tee_print(message: str):
+            for output in outputs:
+                print(message, file=output)
+
+        tee_print(f"=== log file <{log_path}> start ===")
+
+        for name, count in self.counts.items():
+            tee_print(f"{name}: {count}")
+
+        for keyword in self.keywords:
+            tee_print(f"=== {keyword} ===")
+            lines = self.keyword_lines[keyword]
+            if lines and show_offsets:
+                offsets = self.keyword_offsets[keyword]
+                lines = [f"{offset}: {line}" for offset, line in zip(offsets, lines)]
+            if lines:
+                tee_print("".join(lines))
+            omitted = self.keyword_counts[keyword] - len(lines)
+            if omitted:
+                tee_print(f"... {omitted} more lines, see the log file")
+
+        tee_print(f"=== {NO_STATUS} ===")
+        tee_print(f"number of <{NO_STATUS}> tests: {self.no_status_count}")
+
+        tee_print(f"Top {self.top_n} tests with the longest duration:")
+        for test_name, duration in self.slowest_tests():
+            tee_print(f"{duration}s : {test_name}")
+
+        tee_print(f"=== log file <{log_path}> end ===")
+
+
+def analyze_test_log(
+    log_path: str,
+    keywords: list[str],
+    top_n: int = 5,
+    counters: Optional[dict[str, re.Pattern]] = None,
+    result_handler: Optional[Callable[[tuple[str, float, bool]], None]] = None,
+) -> TestLogAnalyzer:
+    """
+    Analyze a log file in a single streaming pass, the log can be compressed
+    (see framed_log.py).
+    """
+    analyzer = TestLogAnalyzer(
+        keywords, top_n=top_n, counters=counters, result_handler=result_handler
+    )
+    # the "\r\n" line endings are kept, to count the offsets right
+    with framed_log.open_text(log_path) as file:
+        analyzer.feed_lines(file)
+    return analyzer
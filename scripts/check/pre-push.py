@@ -6,26 +6,243 @@
 # - ./dev gen
 # - ./dev lint
 # - ./dev test
+#
+# The stages run as soon as the stages they depend on are done, so "./dev lint"
+# overlaps with "./dev test" (see PARALLEL_LINT_AND_TEST). A per-stage timing
+# breakdown is printed at the end.
+#
+# The stages "gen", "lint" and "test" are skipped when their inputs (the files
+# changed since upstream/master, their content and the tool versions) are the
+# same as in their last successful run. Only the packages whose tests can be
+# affected by the changed files are tested (see import_graph.py).
 
+import hashlib
 import io
+import json
 import os
 import re
+import shutil
 import sys
-from typing import Tuple
+import threading
+from typing import Optional, Tuple
 import subprocess
 import time
 import logging
-import xiaochen_py
+from concurrent.futures import ThreadPoolExecutor
+
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+import duration_history
+import import_graph
+import live_analysis
+import log_analyzer
+
+import command_runner
+import framed_log
 
 COCKROACH_SRC_DIR = os.path.expanduser("~/code/cockroach")
 
+TEST_KEYWORDS = [
+    "--- FAIL",
+    "ERROR",
+    "FAILED TO BUILD",
+]
+
+# Abort "./dev test" as soon as one of these patterns shows up in its output,
+# e.g. "FAILED TO BUILD". The log is analyzed while the tests are running either way.
+FATAL_PATTERNS = []
+
+CACHE_MISS_ERROR = "Failed to fetch blobs because they do not exist remotely."
+
+# Start "./dev lint" and "./dev test" together once "./dev gen" is done. Both
+# use the same Bazel server, so their Bazel commands still wait for each other,
+# but the non-Bazel parts of the lint (e.g. the go linters) overlap with the
+# tests.
+PARALLEL_LINT_AND_TEST = True
+
+# Write the logs of gen, lint and test compressed, they can be read with zcat
+# (or zstdcat) and framed_log.py, see framed_log.py
+COMPRESS_LOGS = False
+
+# The inputs key of the last successful run of each stage
+RESULT_CACHE_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/pre-push-results.json")
+
+result_cache_lock = threading.Lock()
+
 
 def run():
     goto_src_dir()
-    format_code()
-    gen()
-    lint()
-    test()
+
+    # stage name -> (function, names of the stages it depends on)
+    stages = {
+        "format": (format_code, []),
+        # gen changes the generated files, the next run sees the key after it
+        "gen": (cached_stage("gen", gen, key_after_run=True), ["format"]),
+        "lint": (cached_stage("lint", lint), ["gen"]),
+        "test": (
+            cached_stage("test", test),
+            ["gen"] if PARALLEL_LINT_AND_TEST else ["lint"],
+        ),
+    }
+    run_stages(stages)
+
+
+def run_stages(stages: dict):
+    """
+    Run each stage as soon as all the stages it depends on are done, and print
+    the timing breakdown of the stages.
+
+    The stages must be listed after the stages they depend on. If a stage
+    fails, the stages depending on it are not run and the error is raised.
+    """
+    start_time = time.time()
+    timings = {}
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = {}
+
+        def run_stage(name, func, deps):
+            for dep in deps:
+                futures[dep].result()
+
+            stage_start = time.time()
+            try:
+                func()
+            finally:
+                timings[name] = (stage_start - start_time, time.time() - stage_start)
+
+        for name, (func, deps) in stages.items():
+            futures[name] = executor.submit(run_stage, name, func, deps)
+
+        try:
+            for future in futures.values():
+                future.result()
+        finally:
+            print("=== stage timings ===")
+            for name in stages:
+                if name in timings:
+                    offset, duration = timings[name]
+                    print(f"{name:<8} started at {offset:8.2f}s, took {duration:8.2f}s")
+                else:
+                    print(f"{name:<8} not run")
+            print(f"total: {time.time() - start_time:.2f}s")
+
+
+def cached_stage(name: str, func, key_after_run: bool = False):
+    """
+    Wrap a stage function returning True on success, so the stage is skipped
+    when its inputs key matches the one of its last successful run.
+
+    The key recorded is the one computed before the run, so a file changed
+    during the run invalidates the result, or the one computed after the run
+    if key_after_run is True, for a stage which changes its own inputs.
+    """
+
+    def run_cached():
+        key = inputs_key(name)
+        with result_cache_lock:
+            record = load_result_cache().get(name)
+        if record and record["key"] == key:
+            finished_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+            print(f"{name}: inputs unchanged since the successful run at {finished_at}, skipped")
+            return
+
+        if func():
+            if key_after_run:
+                key = inputs_key(name)
+            with result_cache_lock:
+                cache = load_result_cache()
+                cache[name] = {"key": key, "time": time.time()}
+                save_result_cache(cache)
+
+    return run_cached
+
+
+def load_result_cache() -> dict:
+    if not os.path.exists(RESULT_CACHE_PATH):
+        return {}
+    with open(RESULT_CACHE_PATH, "r") as file:
+        return json.load(file).get(COCKROACH_SRC_DIR, {})
+
+
+def save_result_cache(stages: dict):
+    cache = {}
+    if os.path.exists(RESULT_CACHE_PATH):
+        with open(RESULT_CACHE_PATH, "r") as file:
+            cache = json.load(file)
+    cache[COCKROACH_SRC_DIR] = stages
+
+    os.makedirs(os.path.dirname(RESULT_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{RESULT_CACHE_PATH}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(cache, file, indent=2)
+    os.replace(tmp_path, RESULT_CACHE_PATH)
+
+
+def inputs_key(stage: str) -> str:
+    """
+    Hash the inputs of a stage: the base commit, the changed and untracked
+    files and their content, and the versions of the tools.
+    """
+    h = hashlib.sha256()
+    h.update(stage.encode())
+
+    base = subprocess.run(
+        ["git", "rev-parse", "upstream/master"], stdout=subprocess.PIPE, text=True
+    ).stdout
+    h.update(base.encode())
+
+    go_version = subprocess.run(
+        ["go", "version"], stdout=subprocess.PIPE, text=True
+    ).stdout
+    h.update(go_version.encode())
+    with open("dev", "rb") as file:
+        h.update(file.read())
+
+    for path in changed_files():
+        h.update(path.encode() + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                h.update(hashlib.sha256(file.read()).digest())
+        else:
+            h.update(b"<deleted>")
+
+    return h.hexdigest()
+
+
+def changed_files() -> list[str]:
+    """
+    Return the files that have been changed since upstream/master, including
+    the uncommitted changes and the new source files not added yet.
+
+    Only the untracked files under "pkg/" or ending with ".go" are included,
+    the others are e.g. the logs written by this script in the source dir.
+    """
+    output = subprocess.run(
+        ["git", "diff", "--name-only", "upstream/master"],
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    untracked = subprocess.run(
+        ["git", "ls-files", "--others", "--exclude-standard"],
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    files = {file for file in output.split("\n") if file}
+    files.update(
+        file
+        for file in untracked.split("\n")
+        if file.startswith("pkg/") or file.endswith(".go")
+    )
+    return sorted(files)
+
+
+def affected_test_packages() -> Optional[list[str]]:
+    """
+    Return the packages whose tests can be affected by the changed files, or
+    None if all the tests must run (see import_graph.affected_packages).
+    """
+    return import_graph.affected_packages(".", changed_files())
 
 
 def goto_src_dir():
@@ -36,136 +253,150 @@ def format_code():
     """
     Format the Go code in the changed files.
     """
-    # get the list of files that have been changed
-    output, _ = xiaochen_py.run_command(
-        "git diff --name-only upstream/master", stream_output=False, slient=True
-    )
-    changed_files = output.decode().strip().split("\n")
-
     # filter out the files that are not go files
-    changed_go_files = [file for file in changed_files if file.endswith(".go")]
+    changed_go_files = [
+        file for file in changed_files() if file.endswith(".go") and os.path.exists(file)
+    ]
 
     if not changed_go_files:
         logging.info("no go files changed")
         return
 
     # run gofmt
-    xiaochen_py.run_command(
-        f"gofmt -s -w {' '.join(changed_go_files)}", stream_output=False, slient=True
-    )
+    results = [command_runner.run_command(f"gofmt -s -w {' '.join(changed_go_files)}")]
 
-    # install crlfmt
-    xiaochen_py.run_command(
-        "go install github.com/cockroachdb/crlfmt", stream_output=False, slient=True
-    )
+    # install crlfmt, unless the installed one matches the version in go.mod
+    if not crlfmt_up_to_date():
+        results.append(command_runner.run_command("go install github.com/cockroachdb/crlfmt"))
+
+    # run crlfmt on the Go files concurrently
+    if all(result.exit_code == 0 for result in results):
+        results += command_runner.run_commands(
+            [{"command": f"crlfmt -w {file}"} for file in changed_go_files],
+            limit=os.cpu_count(),
+        )
 
-    # run crlfmt on each Go file
-    for file in changed_go_files:
-        xiaochen_py.run_command(f"crlfmt -w {file}", stream_output=False, slient=True)
+    failed = [result for result in results if result.exit_code != 0]
+    for result in failed:
+        logging.error(f"{result.command} failed:\n{result.tail.decode(errors='replace')}")
+    if failed:
+        sys.exit(1)
+
+
+def crlfmt_up_to_date() -> bool:
+    """
+    Check whether the installed crlfmt has the version required by go.mod.
+    """
+    binary = shutil.which("crlfmt")
+    if binary is None:
+        return False
+
+    with open("go.mod", "r") as file:
+        match = re.search(r"^\s*github\.com/cockroachdb/crlfmt (\S+)", file.read(), re.MULTILINE)
+    if match is None:
+        return False
+
+    # crlfmt is installed from the cockroach module, so it's one of its
+    # dependencies, example:
+    # path	github.com/cockroachdb/crlfmt
+    # mod	github.com/cockroachdb/cockroach	(devel)
+    # dep	github.com/cockroachdb/crlfmt	v0.0.0-20221214225007-b2fc5c302548	h1:...
+    output = subprocess.run(
+        ["go", "version", "-m", binary], stdout=subprocess.PIPE, text=True
+    ).stdout
+    return re.search(
+        rf"^\s*(?:mod|dep)\s+github\.com/cockroachdb/crlfmt\s+{re.escape(match.group(1))}\s",
+        output,
+        re.MULTILINE,
+    ) is not None
 
 
 def gen():
     """
     Run `./dev gen` and check the result.
     """
-    output, exit_code = xiaochen_py.run_command("./dev gen", log_path="gen.log")
+    log_path = framed_log.log_path("gen.log", COMPRESS_LOGS)
+    result = command_runner.run_command("./dev gen", log_path=log_path, stream_output=True)
+    if result.exit_code != 0:
+        logging.error(f"gen failed, see {log_path} for details")
+        sys.exit(1)
+    return True
 
 
 def lint():
     """
     Run `./dev lint` and check the result.
     """
-    output, exit_code = xiaochen_py.run_command("./dev lint", log_path="lint.log")
-    if exit_code != 0:
-        logging.error("lint failed")
+    # the output isn't streamed when it overlaps with the tests
+    log_path = framed_log.log_path("lint.log", COMPRESS_LOGS)
+    result = command_runner.run_command(
+        "./dev lint", log_path=log_path, stream_output=not PARALLEL_LINT_AND_TEST
+    )
+    if result.exit_code != 0:
+        logging.error(f"lint failed, see {log_path} for details")
+    return result.exit_code == 0
 
 
 def test():
     """
-    Run `./dev test` and check the result.
+    Run `./dev test` on the affected packages and check the result.
     """
-    log_path = "test.log"
+    log_path = framed_log.log_path("test.log", COMPRESS_LOGS)
+
+    packages = affected_test_packages()
+    if packages is None:
+        command = "./dev test"
+    elif not packages:
+        print("test: no package affected, skipped")
+        return True
+    else:
+        command = f"./dev test {' '.join(packages)}"
 
     while True:
-        output, exit_code = xiaochen_py.run_command(
-            "./dev test", log_path=log_path, raise_on_failure=False
+        # analyze the log while the tests are running, the rolling summary is
+        # written to "test-summary.log"
+        tests = []
+        analyzer = log_analyzer.TestLogAnalyzer(TEST_KEYWORDS, result_handler=tests.append)
+        # only the lines with the cache miss error are kept in memory, the
+        # full output is in the log file
+        result = live_analysis.run_command(
+            command,
+            log_path,
+            analyzer,
+            summary_path="test-summary.log",
+            fatal_patterns=FATAL_PATTERNS,
+            capture_patterns=[CACHE_MISS_ERROR],
+            stream_output=True,
         )
 
-        if cache_miss_found(output):
+        if cache_miss_found(result):
             logging.info("cache miss found, run ./dev cache --reset")
-            xiaochen_py.run_command(
-                "./dev cache --reset", stream_output=False, log_path="cache_reset.log"
-            )
+            command_runner.run_command("./dev cache --reset", log_path="cache_reset.log")
             continue
         else:
             break
 
-    analyaze_test_log(log_path)
-
-
-def cache_miss_found(output: bytes) -> bool:
-    cache_miss_error = "Failed to fetch blobs because they do not exist remotely."
-    return cache_miss_error in output.decode()
+    analyaze_test_log(log_path, analyzer, tests)
+    return result.exit_code == 0
 
 
-def analyaze_test_log(log_path: str):
-    keywords = [
-        "--- FAIL",
-        "ERROR",
-        "FAILED TO BUILD",
-    ]
-
-    test_summary = open("test-analyze.log", "w")
-
-    xiaochen_py.tee_print(
-        f"=== log file <{log_path}> start ===", [sys.stdout, test_summary]
-    )
+def cache_miss_found(result: command_runner.CommandResult) -> bool:
+    """
+    Check whether the remote cache miss error was captured from the output.
+    """
+    return result.hit_counts.get(CACHE_MISS_ERROR, 0) > 0
 
-    with open(log_path, "r") as file:
-        lines = file.readlines()
-
-        for keyword in keywords:
-            xiaochen_py.tee_print(f"=== {keyword} ===", [sys.stdout, test_summary])
-            # Filter lines that contain any of the keywords
-            error_lines = [line for line in lines if keyword in line]
-            if error_lines:
-                xiaochen_py.tee_print("".join(error_lines), [sys.stdout, test_summary])
-
-        # get the number of lines that contain "NO STATUS"
-        xiaochen_py.tee_print("=== NO STATUS ===", [sys.stdout, test_summary])
-        no_status_lines = [line for line in lines if "NO STATUS" in line]
-        xiaochen_py.tee_print(
-            f"number of <NO STATUS> tests: {len(no_status_lines)}",
-            [sys.stdout, test_summary],
-        )
 
-        test_results = []
-        for line in lines:
-            match = re.search(
-                r"(?P<test_name>\S+).+PASSED in (?P<duration>\d+\.\ds)", line
-            )
-            if match:
-                test_name = match.group("test_name")
-                duration = float(match.group("duration").replace("s", ""))
-                test_results.append((test_name, duration))
-
-        # Sort the test results by duration in descending order
-        sorted_results = sorted(test_results, key=lambda x: x[1], reverse=True)
-
-        # Print the top 5 tests with the longest durations
-        xiaochen_py.tee_print(
-            "Top 5 tests with the longest duration:", [sys.stdout, test_summary]
-        )
-        for test_name, duration in sorted_results[:5]:
-            xiaochen_py.tee_print(
-                f"{duration}s : {test_name}", [sys.stdout, test_summary]
-            )
+def analyaze_test_log(
+    log_path: str, analyzer: log_analyzer.TestLogAnalyzer, tests: list[tuple[str, float, bool]]
+):
+    with open("test-analyze.log", "w") as test_summary:
+        analyzer.report(log_path, [sys.stdout, test_summary])
 
-    xiaochen_py.tee_print(
-        f"=== log file <{log_path}> end ===", [sys.stdout, test_summary]
+    duration_history.record_results(
+        tests, source="pre-push", commit=duration_history.current_commit()
     )
 
 
 if __name__ == "__main__":
-    # xiaochen_py.DRY_RUN = True
     run()
@@ -1,68 +1,646 @@
 #!/usr/bin/env python3
 
-# Usage: run-tests.py <test_directory>
+# Usage: run-tests.py [--jobs N] [--fail-fast] [--shard I/N] [--match REGEX] [--log-dir DIR]
+#                     [--profile] [--max-memory SIZE] <test_directory>
+#        run-tests.py --stress [--count N] [--duration D] [--cpu C,...] [--jobs N] [--match REGEX] <test_directory>
 # Example: run-tests.py pkg/ccl/changefeedccl
+# Example: run-tests.py --match Rangefeed pkg/kv/...
+# Example: run-tests.py --jobs 64 --max-memory 48G --profile pkg/sql
+# Example: run-tests.py --stress --duration 30m --cpu 1,4 --match TestFlaky -j 16 pkg/kv
+# Example: run-tests.py --jobs 64 pkg/ccl/changefeedccl
+# Example: run-tests.py --shard 1/4 pkg/ccl/changefeedccl
 #
 # This script runs all the test files in the specified directory and saves the logs.
+#
+# The test binary is compiled once with "go test -c", then the tests are run
+# concurrently against it. The durations of the tests are recorded in the
+# duration history (see duration_history.py), and the slowest tests are started
+# first on the next run. With --shard, the tests are split into N buckets by a
+# hash of their name, the same on every run and machine, and only the I-th
+# bucket (1-based) is run, slowest tests first.
+#
+# The CPU time, peak RSS and I/O of every test are measured (see
+# process_usage.py), written to "resources.json" in the log directory and
+# recorded in the history. The heaviest tests are printed at the end. With
+# --profile, the Go CPU and memory profiles of every test are written next to
+# its log. With --max-memory, a test only starts if the peak RSS of its last
+# runs fits in the memory left by the running tests.
+#
+# The tests are found with the test index (see go_test_index.py), which only
+# rescans the test files changed since the last run. A directory ending with
+# "/..." runs the tests of all the packages below it, one package at a time.
+#
+# With --stress, the tests are run again and again until each test ran --count
+# times or the --duration budget is spent, cycling through the --cpu values
+# (GOMAXPROCS). Only the logs of the failed runs are kept, and the failure
+# rate of each test is reported with its 95% confidence interval (Wilson score
+# interval), along with the tail of the first failure's log.
 
 
+import itertools
+import json
+import math
 import os
-import subprocess
 import re
+import shlex
+import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+import duration_history
+import go_test_index
+
+import command_runner
+import process_usage
+
+# The memory assumed for a test without any recorded peak RSS
+DEFAULT_TEST_MEMORY = 512 * 1024 * 1024
+
+
+class MemoryBudget:
+    """
+    Admit tests while the sum of their expected memory fits in the limit.
+
+    A test is always admitted when nothing else runs, so a test larger than
+    the limit still runs, alone.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            while self.running and self.used + amount > self.limit:
+                self.condition.wait()
+            self.used += amount
+            self.running += 1
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def index_package(test_dir):
+    """
+    Return the (root, package) of a test directory, as keyed by the test index
+    and the duration history: a relative directory is relative to the current
+    directory, an absolute one to its Go module (the closest parent with a
+    go.mod).
+    """
+    if not os.path.isabs(test_dir):
+        return ".", os.path.normpath(test_dir)
+    root = os.path.normpath(test_dir)
+    while not os.path.exists(os.path.join(root, "go.mod")):
+        parent = os.path.dirname(root)
+        if parent == root:
+            return ".", os.path.relpath(test_dir)
+        root = parent
+    return root, os.path.relpath(test_dir, root)
+
+
+def build_test_binary(test_dir, log_dir):
+    """
+    Compile the test binary of the package in the specified directory.
+
+    Return the path of the binary, or None if the build failed.
+    """
+    binary_path = os.path.abspath(
+        os.path.join(log_dir, os.path.basename(os.path.normpath(test_dir)) + ".test")
+    )
+    log_file_path = os.path.join(log_dir, "build.log")
+
+    print(f"Building test binary: {binary_path}")
+    start_time = time.time()
+    # built from the package directory, so an absolute directory outside the
+    # current module works too
+    result = command_runner.run_command(
+        shlex.join(["go", "test", "-c", "-o", binary_path, "."]),
+        log_path=log_file_path,
+        cwd=test_dir,
+    )
+    duration = time.time() - start_time
+
+    if result.exit_code != 0 or not os.path.exists(binary_path):
+        print(f"Build failed. See log file: {log_file_path}")
+        return None
+
+    print(f"Build finished in {duration:.2f} seconds.")
+    return binary_path
+
+
+def run_test(
+    binary_path, test_dir, test_name, log_dir, timeout, profile=False, memory=None, budget=None
+):
+    """
+    Run a single test against the compiled test binary.
+
+    If profile is True, the Go CPU and memory profiles are written next to the
+    log. If a memory budget is given, the test waits for the expected memory
+    to be available.
+
+    Return a tuple of (passed, process_usage.ProcessUsage, log file path).
+    """
+    log_file_path = os.path.join(log_dir, f"{test_name}.log")
+    cmd = [
+        os.path.abspath(binary_path),
+        "-test.run",
+        f"^{test_name}$",
+        "-test.v",
+        "-test.count=1",
+        "-test.timeout",
+        timeout,
+    ]
+    if profile:
+        cmd += [
+            f"-test.cpuprofile={os.path.abspath(os.path.join(log_dir, f'{test_name}.cpu.pprof'))}",
+            f"-test.memprofile={os.path.abspath(os.path.join(log_dir, f'{test_name}.mem.pprof'))}",
+        ]
+
+    if budget:
+        budget.acquire(memory)
+    try:
+        with open(log_file_path, "w") as log_file:
+            # go test runs the tests in the directory of the package; not
+            # run by command_runner, which can't measure the resources
+            usage = process_usage.run(
+                cmd, cwd=test_dir, stdout=log_file, stderr=subprocess.STDOUT
+            )
+    finally:
+        if budget:
+            budget.release(memory)
+    return usage.exit_code == 0, usage, log_file_path
+
+
+def report_resources(usages, log_dir, top_n=5):
+    """
+    Write the resources used by the tests to "resources.json" in the log
+    directory, and print the heaviest tests.
+    """
+    with open(os.path.join(log_dir, "resources.json"), "w") as file:
+        json.dump(
+            {test_name: usage.to_dict() for test_name, usage in usages.items()},
+            file,
+            indent=2,
+        )
+
+    def io_bytes(usage):
+        return (usage.read_chars or 0) + (usage.write_chars or 0)
+
+    rankings = [
+        ("CPU time", lambda usage: usage.cpu_time, lambda value: f"{value:8.1f}s"),
+        ("peak RSS", lambda usage: usage.peak_rss, lambda value: f"{value / 1024 ** 2:8.0f}MB"),
+        ("I/O", io_bytes, lambda value: f"{value / 1024 ** 2:8.0f}MB"),
+    ]
+    for title, key, format_value in rankings:
+        print(f"Top {top_n} tests by {title}:")
+        heaviest = sorted(usages, key=lambda test_name: key(usages[test_name]), reverse=True)
+        for test_name in heaviest[:top_n]:
+            print(f"  {format_value(key(usages[test_name]))} : {test_name}")
+
+
+def run_tests_in_dir(
+    test_dir,
+    log_dir,
+    jobs=1,
+    fail_fast=False,
+    timeout="3m",
+    shard=None,
+    match=None,
+    profile=False,
+    max_memory=None,
+):
+    """
+    Runs all Go tests in the specified directory.
+
+    shard is an optional (index, count) tuple, index starting at 1. If match
+    is given, only the tests whose name matches this regex are run. If
+    max_memory is given (in bytes), the tests only start while their expected
+    peak RSS fits in it.
+
+    Return the names of the failed tests.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    root, package = index_package(test_dir)
+
+    test_names = [
+        name for _, name, _, _ in go_test_index.find_tests(root, package, match=match)
+    ]
+
+    if not test_names:
+        print(f"No tests found in {test_dir}")
+        return []
 
+    # start the slowest tests first to shorten the tail of the run
+    history = duration_history.expected_durations(
+        [f"{package}:{name}" for name in test_names]
+    )
+    durations = {
+        name: history[f"{package}:{name}"]
+        for name in test_names
+        if f"{package}:{name}" in history
+    }
+    if shard:
+        index, count = shard
+        test_names = duration_history.shard(test_names, count)[index - 1]
+        print(f"Shard {index}/{count}: {len(test_names)} tests")
+    test_names = duration_history.longest_first(test_names, durations)
 
-def extract_test_names(file_path):
-    """Extracts all test names from a Go test file."""
-    test_names = []
-    with open(file_path, "r") as file:
-        content = file.read()
-        # Regular expression to match Go test function names
-        matches = re.findall(r"^func\s+(Test\w+)\s*\(.*\)\s*{", content, re.MULTILINE)
-        test_names.extend(matches)
-    return test_names
+    binary_path = build_test_binary(test_dir, log_dir)
+    if binary_path is None:
+        return test_names
 
+    print(f"Running {len(test_names)} tests with {jobs} jobs")
 
-def run_tests_in_dir(test_dir, log_dir):
-    """Runs all Go tests in the specified directory."""
-    for file in os.listdir(test_dir):
-        if file.endswith("_test.go"):
-            file_path = os.path.join(test_dir, file)
-            test_names = extract_test_names(file_path)
+    budget = None
+    memory = {}
+    if max_memory:
+        budget = MemoryBudget(max_memory)
+        peaks = duration_history.expected_peak_rss(
+            [f"{package}:{name}" for name in test_names]
+        )
+        memory = {
+            name: peaks.get(f"{package}:{name}", DEFAULT_TEST_MEMORY) for name in test_names
+        }
 
-            for test_name in test_names:
-                print("-" * 80)
-                print(f"Running test: {test_name}")
-                print(f"File path: {file_path}")
+    failed_tests = []
+    results = []
+    usages = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                run_test,
+                binary_path,
+                test_dir,
+                test_name,
+                log_dir,
+                timeout,
+                profile=profile,
+                memory=memory.get(test_name),
+                budget=budget,
+            ): test_name
+            for test_name in test_names
+        }
 
-                log_file_path = os.path.join(log_dir, f"{test_name}.log")
-                print(f"Log path: {log_file_path}")
+        for done, future in enumerate(as_completed(futures), start=1):
+            if future.cancelled():
+                continue
 
-                # Construct the Go test command
-                cmd = f"go test -timeout 3m -run ^{test_name}$ github.com/cockroachdb/cockroach/pkg/ccl/changefeedccl -v -count=1"
+            test_name = futures[future]
+            passed, usage, log_file_path = future.result()
+            results.append((f"{package}:{test_name}", usage.duration, passed))
+            usages[test_name] = usage
 
-                start_time = time.time()
-                with open(log_file_path, "w") as log_file:
-                    result = subprocess.run(
-                        cmd, shell=True, stdout=log_file, stderr=subprocess.STDOUT
-                    )
-                duration = time.time() - start_time
-                print(f"Test finished in {duration:.2f} seconds.")
+            # Report the result
+            status = "passed" if passed else "failed"
+            print(
+                f"[{done}/{len(test_names)}] Test {test_name} {status} in {usage.duration:.2f} seconds "
+                f"(CPU {usage.cpu_time:.2f}s, peak RSS {usage.peak_rss / 1024 ** 2:.0f}MB). Log: {log_file_path}"
+            )
 
-                # Report the result
-                if result.returncode != 0:
-                    print(f"Test {test_name} failed. See log file: {log_file_path}")
-                    return  # Stop if there is an error
-                else:
-                    print(f"Test {test_name} passed.")
+            if not passed:
+                failed_tests.append(test_name)
+                if fail_fast:
+                    # running tests are left to finish
+                    for pending in futures:
+                        pending.cancel()
+
+    commit = duration_history.current_commit()
+    duration_history.record_results(results, source="run-tests", commit=commit)
+    duration_history.record_resources(
+        [
+            (
+                f"{package}:{test_name}",
+                usage.cpu_time,
+                usage.peak_rss,
+                usage.read_bytes,
+                usage.write_bytes,
+            )
+            for test_name, usage in usages.items()
+        ],
+        commit=commit,
+    )
+    if usages:
+        report_resources(usages, log_dir)
+
+    skipped = sum(1 for future in futures if future.cancelled())
+    passed = len(test_names) - len(failed_tests) - skipped
+    print("-" * 80)
+    print(f"{passed} passed, {len(failed_tests)} failed, {skipped} skipped")
+    for test_name in failed_tests:
+        print(f"Test {test_name} failed. See log file: {os.path.join(log_dir, f'{test_name}.log')}")
+    return failed_tests
+
+
+def parse_duration(duration):
+    """
+    Parse a Go-like duration (e.g. "90s", "1h30m"), return it in seconds.
+    """
+    parts = re.findall(r"(\d+(?:\.\d+)?)(h|m|s)", duration)
+    if not parts or "".join(number + unit for number, unit in parts) != duration:
+        raise ValueError(f"invalid duration: {duration}")
+    return sum(float(number) * {"h": 3600, "m": 60, "s": 1}[unit] for number, unit in parts)
+
+
+def parse_size(size):
+    """
+    Parse a size like "512M" or "48G", return it in bytes.
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", size.upper())
+    if match is None:
+        raise ValueError(f"invalid size: {size}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "_KMGT".index(unit or "_"))
+
+
+def wilson_interval(failures, runs, z=1.96):
+    """
+    Return the (low, high) bounds of the confidence interval of a failure
+    rate, 95% by default.
+    """
+    if runs == 0:
+        return 0.0, 1.0
+    rate = failures / runs
+    denominator = 1 + z * z / runs
+    center = (rate + z * z / (2 * runs)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / runs + z * z / (4 * runs * runs)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def stress_run(binary_path, test_dir, test_name, iteration, cpu, log_dir, timeout):
+    """
+    Run a test once, the log is only kept if the test failed.
+
+    Return a tuple of (passed, log file path).
+    """
+    log_file_path = os.path.join(log_dir, f"{test_name}.{iteration}.log")
+    cmd = [
+        os.path.abspath(binary_path),
+        "-test.run",
+        f"^{test_name}$",
+        "-test.v",
+        "-test.count=1",
+        "-test.timeout",
+        timeout,
+    ]
+    if cpu:
+        cmd.append(f"-test.cpu={cpu}")
+
+    result = command_runner.run_command(shlex.join(cmd), log_path=log_file_path, cwd=test_dir)
+    if result.exit_code == 0:
+        os.remove(log_file_path)
+    return result.exit_code == 0, log_file_path
+
+
+def stress_tests_in_dir(
+    test_dir, log_dir, jobs=1, timeout="3m", match=None, count=None, budget=None, cpus=None
+):
+    """
+    Runs the Go tests in the specified directory repeatedly, until each test
+    ran count times or budget seconds are spent.
+
+    cpus is an optional list of GOMAXPROCS values, the iterations cycle through them.
+
+    Return the names of the tests which failed at least once.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    root, package = index_package(test_dir)
+
+    test_names = [
+        name for _, name, _, _ in go_test_index.find_tests(root, package, match=match)
+    ]
+    if not test_names:
+        print(f"No tests found in {test_dir}")
+        return []
+
+    binary_path = build_test_binary(test_dir, log_dir)
+    if binary_path is None:
+        return test_names
+
+    cpus = cpus or [None]
+    iterations = itertools.count() if count is None else range(count)
+    runs = (
+        (test_name, iteration, cpus[iteration % len(cpus)])
+        for iteration in iterations
+        for test_name in test_names
+    )
+    deadline = time.time() + budget if budget else None
+
+    # (test name, cpu) -> [runs, failures]
+    stats = {(test_name, cpu): [0, 0] for test_name in test_names for cpu in cpus}
+    # test name -> log of its first failure
+    first_failures = {}
+
+    limits = []
+    if count is not None:
+        limits.append(f"{count} iterations")
+    if budget:
+        limits.append(f"{budget:.0f} seconds")
+    print(f"Stressing {len(test_names)} tests with {jobs} jobs for {' or '.join(limits)}")
+
+    start_time = time.time()
+    last_progress = start_time
+    total = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+
+        def submit_next():
+            if deadline and time.time() >= deadline:
+                return
+            run = next(runs, None)
+            if run is not None:
+                future = executor.submit(
+                    stress_run, binary_path, test_dir, *run, log_dir, timeout
+                )
+                pending[future] = run
+
+        for _ in range(jobs):
+            submit_next()
+
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    test_name, iteration, cpu = pending.pop(future)
+                    passed, log_file_path = future.result()
+                    total += 1
+                    stats[(test_name, cpu)][0] += 1
+                    if not passed:
+                        stats[(test_name, cpu)][1] += 1
+                        first_failures.setdefault(test_name, log_file_path)
+                        print(
+                            f"Test {test_name} failed (iteration {iteration}, cpu {cpu or 'default'}). Log: {log_file_path}"
+                        )
+                    submit_next()
+
+                if time.time() - last_progress >= 10:
+                    last_progress = time.time()
+                    failures = sum(failed for _, failed in stats.values())
+                    print(f"{total} runs, {failures} failures, {last_progress - start_time:.0f}s elapsed")
+        except KeyboardInterrupt:
+            # the tests run in their own session and don't get the interrupt,
+            # kill them (again if a run was just starting), their results are
+            # dropped
+            print("Interrupted, killing the running tests")
+            while not all(future.done() for future in pending):
+                command_runner.kill_running_commands()
+                wait(pending, timeout=1)
+
+    print("-" * 80)
+    print(f"{total} runs in {time.time() - start_time:.0f} seconds")
+    print(f"{'TEST':<40} {'CPU':>7} {'RUNS':>6} {'FAILS':>6}  FAILURE RATE (95% CI)")
+    for (test_name, cpu), (runs_count, failures) in stats.items():
+        low, high = wilson_interval(failures, runs_count)
+        rate = failures / runs_count if runs_count else 0.0
+        print(
+            f"{test_name:<40} {cpu or 'default':>7} {runs_count:>6} {failures:>6}  "
+            f"{rate:6.1%} ({low:.1%} - {high:.1%})"
+        )
+
+    for test_name, log_file_path in first_failures.items():
+        print("-" * 80)
+        print(f"First failure of {test_name}: {log_file_path}")
+        with open(log_file_path, "r", errors="replace") as log_file:
+            print("".join(log_file.readlines()[-30:]), end="")
+    return list(first_failures)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <test_directory>")
-        sys.exit(1)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run all the tests in the specified directory and save the logs."
+    )
+    parser.add_argument(
+        "test_directory", help="e.g. pkg/ccl/changefeedccl or pkg/ccl/..."
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="number of tests to run concurrently"
+    )
+    parser.add_argument(
+        "--fail-fast", action="store_true", help="stop scheduling tests after the first failure"
+    )
+    parser.add_argument(
+        "--shard", help="run only the I-th of N buckets of tests, e.g. 1/4"
+    )
+    parser.add_argument("--match", help="only run the tests whose name matches this regex")
+    parser.add_argument("--log-dir", default="/tmp/logs", help="default: /tmp/logs")
+    parser.add_argument("--timeout", default="3m", help="timeout of each test, default: 3m")
+    parser.add_argument(
+        "--stress", action="store_true", help="run the tests repeatedly to find the flaky ones"
+    )
+    parser.add_argument(
+        "--count", type=int, help="stress: number of runs of each test, default: 100 without --duration"
+    )
+    parser.add_argument("--duration", help="stress: time budget, e.g. 30m or 2h")
+    parser.add_argument("--cpu", help="stress: GOMAXPROCS values to cycle through, e.g. 1,4,16")
+    parser.add_argument(
+        "--profile", action="store_true", help="write the Go CPU and memory profiles of each test"
+    )
+    parser.add_argument(
+        "--max-memory", help="cap the expected peak RSS of the running tests, e.g. 48G"
+    )
+    args = parser.parse_args()
+
+    max_memory = None
+    if args.max_memory:
+        try:
+            max_memory = parse_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+    budget = None
+    if args.duration:
+        try:
+            budget = parse_duration(args.duration)
+        except ValueError as e:
+            parser.error(str(e))
+    count = args.count
+    if count is None and budget is None:
+        count = 100
+    cpus = None
+    if args.cpu:
+        try:
+            cpus = [int(cpu) for cpu in args.cpu.split(",")]
+        except ValueError:
+            parser.error(f"invalid cpu list: {args.cpu}")
+        if any(cpu < 1 for cpu in cpus):
+            parser.error(f"invalid cpu list: {args.cpu}")
+
+    shard = None
+    if args.shard:
+        try:
+            index, shard_count = (int(x) for x in args.shard.split("/"))
+        except ValueError:
+            parser.error(f"invalid shard: {args.shard}")
+        if not 1 <= index <= shard_count:
+            parser.error(f"invalid shard: {args.shard}")
+        shard = (index, shard_count)
 
-    test_directory = sys.argv[1]
-    log_directory = "/tmp/logs"
-    run_tests_in_dir(test_directory, log_directory)
+    if args.test_directory.endswith("..."):
+        root, subtree = index_package(args.test_directory.removesuffix("..."))
+        tests = go_test_index.find_tests(root, f"{subtree}/...", match=args.match)
+        packages = sorted({package for package, _, _, _ in tests})
+        # one log directory per package, e.g. /tmp/logs/pkg-kv-kvserver
+        test_dirs = [
+            (
+                os.path.normpath(os.path.join(root, package)),
+                os.path.join(args.log_dir, package.replace("/", "-")),
+            )
+            for package in packages
+        ]
+        if not test_dirs:
+            print(f"No tests found in {args.test_directory}")
+    else:
+        test_dirs = [(args.test_directory, args.log_dir)]
+
+    failed = []
+    for test_dir, log_dir in test_dirs:
+        if args.stress:
+            # the time budget is shared evenly by the packages
+            failed.extend(
+                f"{index_package(test_dir)[1]}:{name}"
+                for name in stress_tests_in_dir(
+                    test_dir,
+                    log_dir,
+                    jobs=args.jobs,
+                    timeout=args.timeout,
+                    match=args.match,
+                    count=count,
+                    budget=budget / len(test_dirs) if budget else None,
+                    cpus=cpus,
+                )
+            )
+            continue
+
+        failed.extend(
+            f"{index_package(test_dir)[1]}:{name}"
+            for name in run_tests_in_dir(
+                test_dir,
+                log_dir,
+                jobs=args.jobs,
+                fail_fast=args.fail_fast,
+                timeout=args.timeout,
+                shard=shard,
+                match=args.match,
+                profile=args.profile,
+                max_memory=max_memory,
+            )
+        )
+        if failed and args.fail_fast:
+            break
+
+    if len(test_dirs) > 1 and failed:
+        print(f"{len(failed)} failed tests:")
+        for name in failed:
+            print(f"  {name}")
+    if failed:
+        sys.exit(1)
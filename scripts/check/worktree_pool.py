@@ -0,0 +1,198 @@
+# A pool of reusable git worktrees of the cockroach repo, backed by one shared
+# object store.
+#
+# Checking out a PR only fetches the new objects into the shared repository
+# and resets a worktree of the pool to the PR, instead of cloning the repo
+# again. The worktrees keep their path, so Bazel reuses their output base
+# (which is derived from the workspace path) and the analysis cache of the
+# previous check. The ".bazelrc.user" file and the "bazel-*" symlinks survive
+# the reset.
+#
+# Each worktree is locked (flock) while it is in use, so several checks can run
+# at the same time, each in its own worktree. A PR is checked out in the
+# worktree which last checked it if that one is free, to rebuild as little as
+# possible.
+#
+# This module is used by check-pr.py.
+
+import fcntl
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from bazel_config import strip_managed_block
+
+
+REPO_URL = "https://github.com/cockroachdb/cockroach.git"
+# use HDD to prevent SSD wear
+POOL_DIR = "/media/xiaochen/large/ci/cockroach/pool"
+POOL_SIZE = 2
+
+# The untracked files kept when a worktree is reset
+KEPT_FILES = [".bazelrc.user", "bazel-*"]
+
+
+def shared_repo_path(pool_dir: str = POOL_DIR) -> str:
+    return os.path.join(pool_dir, "repo.git")
+
+
+def worktree_path(index: int, pool_dir: str = POOL_DIR) -> str:
+    return os.path.join(pool_dir, f"worktree-{index}")
+
+
+def git(args: list[str], cwd: str, log_file) -> int:
+    """
+    Run a git command, append its output to the log file and return the exit code.
+    """
+    log_file.write(f"$ git {' '.join(args)}\n")
+    log_file.flush()
+    return subprocess.run(
+        ["git", *args], cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT
+    ).returncode
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold an exclusive lock on the file, yield False if the lock is taken and
+    blocking is False.
+    """
+    with open(path, "a") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def fetch_pr(pr_number, log_file, pool_dir: str = POOL_DIR) -> bool:
+    """
+    Fetch master and the PR into the shared repository (cloned on first use),
+    as the branches "master" and "pr-<pr_number>".
+    """
+    repo = shared_repo_path(pool_dir)
+    os.makedirs(pool_dir, exist_ok=True)
+
+    # git doesn't support concurrent fetches into the same repository
+    with file_lock(f"{repo}.lock"):
+        if not os.path.exists(repo):
+            if git(["clone", "--bare", REPO_URL, repo], pool_dir, log_file) != 0:
+                shutil.rmtree(repo, ignore_errors=True)
+                return False
+
+        # the PRs are force-pushed, so the branches are force-updated
+        return (
+            git(
+                [
+                    "fetch",
+                    "origin",
+                    "+refs/heads/master:refs/heads/master",
+                    f"+refs/pull/{pr_number}/head:refs/heads/pr-{pr_number}",
+                ],
+                repo,
+                log_file,
+            )
+            == 0
+        )
+
+
+def last_pr_path(index: int, pool_dir: str = POOL_DIR) -> str:
+    return f"{worktree_path(index, pool_dir)}.last-pr"
+
+
+def read_last_pr(index: int, pool_dir: str = POOL_DIR) -> Optional[str]:
+    path = last_pr_path(index, pool_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return file.read().strip()
+
+
+def reset_worktree(index: int, pr_number, log_file, pool_dir: str = POOL_DIR) -> bool:
+    """
+    Create the worktree if needed, then reset it to the PR.
+    """
+    path = worktree_path(index, pool_dir)
+    branch = f"pr-{pr_number}"
+
+    if not os.path.exists(os.path.join(path, ".git")):
+        repo = shared_repo_path(pool_dir)
+        # drop the records of worktrees removed by hand
+        git(["worktree", "prune"], repo, log_file)
+        if git(["worktree", "add", "--detach", path, branch], repo, log_file) != 0:
+            return False
+
+    clean_command = ["clean", "-ffdx"]
+    for pattern in KEPT_FILES:
+        clean_command += ["-e", f"/{pattern}"]
+    if (
+        git(["checkout", "--force", "--detach", branch], path, log_file) != 0
+        or git(clean_command, path, log_file) != 0
+    ):
+        return False
+
+    with open(last_pr_path(index, pool_dir), "w") as file:
+        file.write(str(pr_number))
+    return True
+
+
+def install_bazel_config(bazel_config: str, code_dir: str):
+    """
+    Copy the Bazel config to the worktree, unless it's already there. The
+    file is left untouched otherwise, so Bazel doesn't see a new config.
+
+    The block managed by xiaochen-patch.py is left out, it selects an output
+    base of the main checkout which must not be shared with the worktrees.
+    """
+    with open(bazel_config, "r") as file:
+        config = strip_managed_block(file.read())
+
+    dest = os.path.join(code_dir, os.path.basename(bazel_config))
+    if os.path.exists(dest):
+        with open(dest, "r") as file:
+            if file.read() == config:
+                return
+    with open(dest, "w") as file:
+        file.write(config)
+
+
+@contextmanager
+def checkout(pr_number, log_path: str, pool_dir: str = POOL_DIR) -> Iterator[Optional[str]]:
+    """
+    Check out the PR in a free worktree of the pool, yield the path of the
+    worktree, or None if the checkout failed. The worktree is locked until the
+    end of the context.
+
+    The output of the git commands is written to log_path.
+    """
+    with open(log_path, "w") as log_file:
+        if not fetch_pr(pr_number, log_file, pool_dir):
+            yield None
+            return
+
+        # the worktree which last checked the PR first
+        indexes = sorted(
+            range(POOL_SIZE),
+            key=lambda index: read_last_pr(index, pool_dir) != str(pr_number),
+        )
+        while True:
+            for index in indexes:
+                with file_lock(f"{worktree_path(index, pool_dir)}.lock", blocking=False) as locked:
+                    if not locked:
+                        continue
+                    print(f"PR #{pr_number}: using {worktree_path(index, pool_dir)}")
+                    if not reset_worktree(index, pr_number, log_file, pool_dir):
+                        yield None
+                        return
+                    log_file.flush()
+                    yield worktree_path(index, pool_dir)
+                    return
+            print(f"PR #{pr_number}: all {POOL_SIZE} worktrees are in use, waiting...")
+            time.sleep(10)
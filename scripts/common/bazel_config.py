@@ -0,0 +1,24 @@
+# The block of ".bazelrc.user" managed by xiaochen-patch.py.
+#
+# xiaochen-patch.py writes its Bazel settings (e.g. the output base of the
+# current patch state) between the two marker lines, and worktree_pool.py
+# leaves them out when copying the config to a worktree.
+
+MANAGED_BLOCK_BEGIN = "# xiaochen-patch: begin"
+MANAGED_BLOCK_END = "# xiaochen-patch: end"
+
+
+def strip_managed_block(config: str) -> str:
+    """
+    Remove the managed block, markers included, from a Bazel config.
+    """
+    lines = []
+    managed = False
+    for line in config.splitlines(keepends=True):
+        if line.strip() == MANAGED_BLOCK_BEGIN:
+            managed = True
+        elif line.strip() == MANAGED_BLOCK_END:
+            managed = False
+        elif not managed:
+            lines.append(line)
+    return "".join(lines)
@@ -0,0 +1,296 @@
+# An asyncio-based runner for shell commands, shared by the scripts.
+#
+# The output (stdout and stderr) of a command is read in large binary chunks
+# and teed to:
+# - a log file
+# - the console, if stream_output is True
+# - line handlers, called with each decoded line
+# - pattern watchers, which can kill the command once a pattern is seen
+#
+# The full output is only spilled to the log file, which is compressed if its
+# extension is ".gz" or ".zst" (see framed_log.py). In memory, only the tail of
+# the output is kept, in a ring buffer, along with the lines matching the
+# capture patterns. Many commands can run concurrently from one event loop
+# with run_commands().
+
+import asyncio
+import codecs
+import os
+import signal
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Union
+
+import framed_log
+
+
+CHUNK_SIZE = 256 * 1024
+
+# The size of the output kept in memory by default
+TAIL_SIZE = 1024 * 1024
+
+# The number of lines kept in memory for each capture pattern by default
+MAX_HITS = 100
+
+
+@dataclass
+class CommandResult:
+    command: str
+    exit_code: int
+    # the last bytes of the output, at most tail_size bytes
+    tail: bytes
+    duration: float
+    timed_out: bool = False
+    # the pattern which caused the command to be killed
+    killed_on: Optional[str] = None
+    # the first lines matching each capture pattern
+    hits: dict[str, list[str]] = field(default_factory=dict)
+    # the number of lines matching each capture pattern
+    hit_counts: dict[str, int] = field(default_factory=dict)
+
+
+class RingBuffer:
+    """
+    Keep the last `size` bytes written to it.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+
+    def write(self, data: bytes):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.chunks and self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks)[-self.size :] if self.size else b""
+
+
+class LineSplitter:
+    """
+    Decode chunks of output and call the handlers with each complete line,
+    including its trailing newline.
+    """
+
+    def __init__(self, handlers: list[Callable[[str], None]]):
+        self.handlers = handlers
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+
+    def feed(self, data: bytes):
+        text = self.partial + self.decoder.decode(data)
+        lines = text.split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            for handler in self.handlers:
+                handler(line + "\n")
+
+    def close(self):
+        text = self.partial + self.decoder.decode(b"", final=True)
+        self.partial = ""
+        if text:
+            for handler in self.handlers:
+                handler(text)
+
+
+class PatternCapture:
+    """
+    Keep the first max_hits lines containing each pattern, and count them all.
+    """
+
+    def __init__(self, patterns: list[str], max_hits: int):
+        self.max_hits = max_hits
+        self.hits = {pattern: [] for pattern in patterns}
+        self.hit_counts = {pattern: 0 for pattern in patterns}
+
+    def feed(self, line: str):
+        for pattern, lines in self.hits.items():
+            if pattern in line:
+                self.hit_counts[pattern] += 1
+                if len(lines) < self.max_hits:
+                    lines.append(line)
+
+
+# The processes of the commands being run, from any thread
+running_processes = set()
+
+
+def kill_process_group(process: asyncio.subprocess.Process):
+    # the command runs in its own session, so this also kills its children
+    # (e.g. the Bazel client started by "./dev")
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def kill_running_commands():
+    """
+    Kill all the commands being run, e.g. those run by worker threads when
+    the main thread is interrupted. They run in their own session, so they
+    don't get the SIGINT of Ctrl-C.
+    """
+    for process in list(running_processes):
+        kill_process_group(process)
+
+
+async def run(
+    command: str,
+    log_path: Optional[str] = None,
+    stream_output: bool = False,
+    include_stderr: bool = True,
+    line_handlers: Optional[list[Callable[[str], None]]] = None,
+    kill_on_output: Optional[Union[str, list[str]]] = None,
+    kill_delay: float = 1.0,
+    timeout: Optional[float] = None,
+    tail_size: int = TAIL_SIZE,
+    capture_patterns: Optional[list[str]] = None,
+    max_hits: int = MAX_HITS,
+    cwd: Optional[str] = None,
+) -> CommandResult:
+    """
+    Run a shell command and return its result.
+
+    Args:
+        command (str): The shell command to execute.
+        log_path (Optional[str], optional): The file where the output is written, it
+            will be overwritten if it exists, and compressed if it ends with ".gz" or
+            ".zst". Defaults to None.
+        stream_output (bool, optional): If True, streams the output to stdout. Defaults to False.
+        include_stderr (bool, optional): If True, stderr is included in the output. Defaults to True.
+        line_handlers (Optional[list[Callable[[str], None]]], optional): Called with each
+            line of the output. Defaults to None.
+        kill_on_output (Optional[Union[str, list[str]]], optional): If the given string (or
+            any of the given strings) is found in the output, the command is killed after
+            kill_delay seconds. Defaults to None.
+        kill_delay (float, optional): Defaults to 1 second, to collect more output.
+        timeout (Optional[float], optional): The command is killed after this many seconds.
+            Defaults to None.
+        tail_size (int, optional): The number of bytes of output kept in memory.
+            Defaults to TAIL_SIZE.
+        capture_patterns (Optional[list[str]], optional): The lines containing these
+            strings are kept in memory, see CommandResult.hits. Defaults to None.
+        max_hits (int, optional): The number of lines kept for each capture pattern.
+            Defaults to MAX_HITS.
+        cwd (Optional[str], optional): Defaults to None.
+    """
+    start_time = time.time()
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT if include_stderr else None,
+        cwd=cwd,
+        start_new_session=True,
+    )
+    running_processes.add(process)
+
+    log_file = framed_log.open_writer(log_path) if log_path else None
+    tail = RingBuffer(tail_size)
+    capture = PatternCapture(capture_patterns or [], max_hits)
+    handlers = list(line_handlers or [])
+    if capture_patterns:
+        handlers.append(capture.feed)
+    splitter = LineSplitter(handlers) if handlers else None
+
+    if isinstance(kill_on_output, str):
+        kill_on_output = [kill_on_output]
+    patterns = [pattern.encode() for pattern in kill_on_output or []]
+    # the end of the previous chunk, to find a pattern across two chunks
+    carry_size = max((len(pattern) for pattern in patterns), default=1) - 1
+    carry = b""
+    killed_on = None
+    kill_handle = None
+    loop = asyncio.get_running_loop()
+
+    async def pump():
+        nonlocal carry, killed_on, kill_handle
+        while True:
+            chunk = await process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if log_file:
+                log_file.write(chunk)
+            if stream_output:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            tail.write(chunk)
+            if splitter:
+                splitter.feed(chunk)
+
+            if patterns and killed_on is None:
+                data = carry + chunk
+                for pattern in patterns:
+                    if pattern in data:
+                        killed_on = pattern.decode()
+                        kill_handle = loop.call_later(
+                            kill_delay, kill_process_group, process
+                        )
+                        break
+                carry = data[-carry_size:] if carry_size else b""
+
+        if splitter:
+            splitter.close()
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(pump(), timeout=timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        kill_process_group(process)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        # Ctrl-C, the command doesn't get the SIGINT (see kill_running_commands)
+        kill_process_group(process)
+        raise
+    finally:
+        exit_code = await process.wait()
+        running_processes.discard(process)
+        if kill_handle:
+            kill_handle.cancel()
+        if log_file:
+            log_file.close()
+
+    return CommandResult(
+        command=command,
+        exit_code=exit_code,
+        tail=tail.getvalue(),
+        duration=time.time() - start_time,
+        timed_out=timed_out,
+        killed_on=killed_on,
+        hits=capture.hits,
+        hit_counts=capture.hit_counts,
+    )
+
+
+def run_command(command: str, **kwargs) -> CommandResult:
+    """
+    Run a shell command from a new event loop, see run() for the arguments.
+    """
+    return asyncio.run(run(command, **kwargs))
+
+
+def run_commands(commands: list[dict], limit: Optional[int] = None) -> list[CommandResult]:
+    """
+    Run many commands concurrently from one event loop, at most `limit` at a time.
+
+    Each command is a dict of the arguments of run(), e.g.
+    {"command": "./dev gen", "log_path": "gen.log"}.
+
+    Return the results in the order of the commands.
+    """
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(limit or len(commands) or 1)
+
+        async def run_one(kwargs):
+            async with semaphore:
+                return await run(**kwargs)
+
+        return await asyncio.gather(*(run_one(kwargs) for kwargs in commands))
+
+    return asyncio.run(run_all())
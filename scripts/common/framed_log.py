@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Usage: framed_log.py cat [--offset N] [--length M] <log_file>
+#        framed_log.py compress [--codec gzip|zstd] <log_file>
+# Example: framed_log.py cat --offset 1048576 --length 4096 test.log.gz
+# Example: framed_log.py compress test.log
+#
+# Compressed log files with random access.
+#
+# A log is written as a sequence of independently compressed frames of about
+# FRAME_SIZE bytes, cut at line boundaries when possible:
+# - ".gz": each frame is a gzip member, the file can be read with zcat/zgrep
+# - ".zst": each frame is a zstd frame, the file can be read with zstdcat
+#   (requires the "zstandard" package)
+#
+# Next to the log, "<log>.idx" maps the uncompressed offset of every frame to
+# its compressed offset, so a range of the log can be read by decompressing
+# only the frames covering it. A sequential read decompresses the log as a
+# stream and doesn't need the index.
+#
+# The other files are plain logs, so callers can choose to compress a log by
+# its extension only. A compressed log is only complete once it's closed, the
+# last frame (up to FRAME_SIZE bytes) is buffered in memory until then.
+
+import bisect
+import gzip
+import io
+import os
+import struct
+from typing import BinaryIO, Optional, TextIO, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+FRAME_SIZE = 1024 * 1024
+
+EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+# zstd compresses faster and better, gzip is always available
+DEFAULT_CODEC = "zstd" if zstandard else "gzip"
+
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+# (uncompressed offset, compressed offset) of a frame
+INDEX_ENTRY = struct.Struct("<QQ")
+
+
+def codec_of(path: str) -> Optional[str]:
+    """
+    Return the codec of a log file by its extension, None for a plain log.
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def log_path(path: str, compress: bool, codec: str = DEFAULT_CODEC) -> str:
+    """
+    Return the path of a log, with the extension of the codec if it's compressed.
+    """
+    if not compress:
+        return path
+    extension = next(ext for ext, name in EXTENSIONS.items() if name == codec)
+    return path + extension
+
+
+def index_path(path: str) -> str:
+    return f"{path}.idx"
+
+
+def compress_frame(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress_frames(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True
+        )
+        return reader.read()
+    return gzip.decompress(data)
+
+
+def check_codec(codec: str):
+    if codec == "zstd" and zstandard is None:
+        raise RuntimeError('the "zstandard" package is required for ".zst" logs')
+
+
+class FramedLogWriter:
+    """
+    Write a compressed log as independent frames, see the top of this file.
+
+    Args:
+        path (str): The log file, ending with ".gz" or ".zst".
+        frame_size (int, optional): Defaults to FRAME_SIZE.
+    """
+
+    def __init__(self, path: str, frame_size: int = FRAME_SIZE):
+        self.codec = codec_of(path)
+        if self.codec is None:
+            raise ValueError(f"not a compressed log: {path}")
+        check_codec(self.codec)
+
+        self.path = path
+        self.frame_size = frame_size
+        # the index of an earlier log at this path doesn't match the new one,
+        # the readers decompress the log from the start until close() writes
+        # the new index
+        try:
+            os.remove(index_path(path))
+        except FileNotFoundError:
+            pass
+        self.file = open(path, "wb")
+        self.buffer = bytearray()
+        self.index = []
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.frame_size:
+            # end the frame after the last complete line if there is one
+            cut = self.buffer.rfind(b"\n", 0, self.frame_size) + 1 or self.frame_size
+            self.write_frame(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+        return len(data)
+
+    def write_frame(self, data: bytes):
+        frame = compress_frame(self.codec, data)
+        self.file.write(frame)
+        self.index.append((self.uncompressed_offset, self.compressed_offset))
+        self.uncompressed_offset += len(data)
+        self.compressed_offset += len(frame)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.buffer:
+            self.write_frame(bytes(self.buffer))
+            self.buffer.clear()
+        self.file.close()
+
+        # the last entry is the end of the log
+        entries = self.index + [(self.uncompressed_offset, self.compressed_offset)]
+        tmp_path = f"{index_path(self.path)}.tmp"
+        with open(tmp_path, "wb") as file:
+            for entry in entries:
+                file.write(INDEX_ENTRY.pack(*entry))
+        os.replace(tmp_path, index_path(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_writer(path: str) -> Union[BinaryIO, FramedLogWriter]:
+    """
+    Open a log for writing in binary mode, compressed if its extension is
+    ".gz" or ".zst".
+    """
+    if codec_of(path):
+        return FramedLogWriter(path)
+    return open(path, "wb")
+
+
+def open_text(path: str) -> TextIO:
+    """
+    Open a log for reading as a stream of text, decompressing it if needed.
+
+    The line endings are kept as they are, so the lengths of the lines add up
+    to the offsets in the log.
+    """
+    codec = codec_of(path)
+    if codec is None:
+        return open(path, "r", errors="replace", newline="")
+    check_codec(codec)
+    if codec == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(reader, errors="replace", newline="")
+    return gzip.open(path, "rt", errors="replace", newline="")
+
+
+class FramedLogReader:
+    """
+    Read ranges of a compressed log, decompressing only the frames covering
+    each range.
+
+    If the index is missing (e.g. the writer was killed), the log is
+    decompressed from the start.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.codec = codec_of(path)
+        if self.codec is None:
+            raise ValueError(f"not a compressed log: {path}")
+        check_codec(self.codec)
+
+        self.index = None
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), "rb") as file:
+                data = file.read()
+            self.index = list(INDEX_ENTRY.iter_unpack(data))
+
+    def size(self) -> int:
+        """
+        Return the uncompressed size of the log.
+        """
+        if self.index:
+            return self.index[-1][0]
+        return len(self.read_all())
+
+    def frames(self) -> list[tuple[int, int]]:
+        """
+        Return the (start, end) uncompressed offsets of the frames.
+        """
+        if not self.index:
+            return [(0, self.size())]
+        return [
+            (start, end) for (start, _), (end, _) in zip(self.index, self.index[1:])
+        ]
+
+    def read_all(self) -> bytes:
+        with open(self.path, "rb") as file:
+            return decompress_frames(self.codec, file.read())
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Return at most length bytes of the uncompressed log, starting at offset.
+        """
+        if not self.index:
+            return self.read_all()[offset : offset + length]
+
+        starts = [start for start, _ in self.index]
+        first = max(bisect.bisect_right(starts, offset) - 1, 0)
+        last = min(bisect.bisect_left(starts, offset + length), len(self.index) - 1)
+        compressed_start = self.index[first][1]
+        compressed_end = self.index[last][1]
+
+        with open(self.path, "rb") as file:
+            file.seek(compressed_start)
+            data = decompress_frames(self.codec, file.read(compressed_end - compressed_start))
+        skip = offset - self.index[first][0]
+        return data[skip : skip + length]
+
+
+def compress(path: str, codec: str = DEFAULT_CODEC) -> str:
+    """
+    Compress a plain log into a framed log next to it, return the path of the
+    compressed log.
+    """
+    dest = log_path(path, True, codec)
+    with open(path, "rb") as src, FramedLogWriter(dest) as writer:
+        while True:
+            data = src.read(FRAME_SIZE)
+            if not data:
+                break
+            writer.write(data)
+    return dest
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Read and write compressed logs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cat_parser = subparsers.add_parser("cat", help="print a range of a log")
+    cat_parser.add_argument("log_file")
+    cat_parser.add_argument("--offset", type=int, default=0, help="default: 0")
+    cat_parser.add_argument("--length", type=int, help="default: until the end of the log")
+
+    compress_parser = subparsers.add_parser("compress", help="compress a plain log")
+    compress_parser.add_argument("log_file")
+    compress_parser.add_argument(
+        "--codec", choices=["gzip", "zstd"], default=DEFAULT_CODEC, help=f"default: {DEFAULT_CODEC}"
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "cat":
+            if codec_of(args.log_file) is None:
+                with open(args.log_file, "rb") as file:
+                    file.seek(args.offset)
+                    data = file.read() if args.length is None else file.read(args.length)
+            else:
+                reader = FramedLogReader(args.log_file)
+                length = args.length if args.length is not None else reader.size() - args.offset
+                data = reader.read(args.offset, length)
+            sys.stdout.buffer.write(data)
+        case "compress":
+            dest = compress(args.log_file, args.codec)
+            print(
+                f"{args.log_file}: {os.path.getsize(args.log_file)} bytes -> {dest}: {os.path.getsize(dest)} bytes"
+            )
@@ -0,0 +1,88 @@
+# Measure the resources used by a command: CPU time, peak RSS and I/O.
+#
+# The command is waited for without being reaped (waitid with WNOWAIT), so its
+# I/O counters can still be read from /proc/<pid>/io once it has exited, then
+# it's reaped with wait4, which returns its resource usage. Both include the
+# children the command waited for. There is no sampling, so the numbers are
+# exact and measuring costs nothing while the command runs.
+#
+# /proc is Linux only, the I/O counters are None elsewhere.
+
+import os
+import subprocess
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+@dataclass
+class ProcessUsage:
+    exit_code: int
+    # wall time in seconds
+    duration: float
+    # CPU time in seconds
+    user_time: float
+    system_time: float
+    # peak resident set size in bytes
+    peak_rss: int
+    # bytes read and written through syscalls, including the page cache
+    read_chars: Optional[int] = None
+    write_chars: Optional[int] = None
+    # bytes actually read from and written to the storage
+    read_bytes: Optional[int] = None
+    write_bytes: Optional[int] = None
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def read_proc_io(pid: int) -> dict[str, int]:
+    """
+    Return the I/O counters of a process from /proc/<pid>/io, or an empty dict
+    if they can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/io", "r") as file:
+            return {
+                key: int(value)
+                for key, value in (line.split(": ") for line in file if ": " in line)
+            }
+    except OSError:
+        return {}
+
+
+def run(cmd: list[str], **popen_kwargs) -> ProcessUsage:
+    """
+    Run a command and return its exit code and resource usage.
+
+    The keyword arguments are passed to subprocess.Popen (e.g. cwd, stdout).
+    """
+    start_time = time.time()
+    process = subprocess.Popen(cmd, **popen_kwargs)
+
+    # wait for the exit, but leave the process as a zombie to read its counters
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io_counters = read_proc_io(process.pid)
+    _, status, rusage = os.wait4(process.pid, 0)
+    duration = time.time() - start_time
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    # the process is reaped, don't let Popen wait for it again
+    process.returncode = exit_code
+
+    return ProcessUsage(
+        exit_code=exit_code,
+        duration=duration,
+        user_time=rusage.ru_utime,
+        system_time=rusage.ru_stime,
+        # in kilobytes on Linux
+        peak_rss=rusage.ru_maxrss * 1024,
+        read_chars=io_counters.get("rchar"),
+        write_chars=io_counters.get("wchar"),
+        read_bytes=io_counters.get("read_bytes"),
+        write_bytes=io_counters.get("write_bytes"),
+    )
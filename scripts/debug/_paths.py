@@ -0,0 +1,12 @@
+# Make the modules of scripts/common importable.
+#
+# Imported first by the scripts of this directory. The modules they import,
+# here and in scripts/common, rely on it and don't change sys.path themselves.
+
+import os
+import sys
+
+COMMON_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "common")
+
+if COMMON_DIR not in sys.path:
+    sys.path.insert(0, COMMON_DIR)
@@ -0,0 +1,269 @@
+# A persistent index from lines of code to the unit tests that cover them.
+#
+# The index is built by running every test of a package once with a Go
+# coverage profile, and is stored in a SQLite database. A package is only
+# re-profiled when the content of one of its Go files changes.
+#
+# This module is used by identify-test.py.
+
+import hashlib
+import os
+import sqlite3
+import subprocess
+import tempfile
+from typing import Optional
+
+
+INDEX_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/identify-test.db")
+
+GO_MODULE = "github.com/cockroachdb/cockroach"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    package TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    package TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_package ON tests (package);
+
+CREATE TABLE IF NOT EXISTS coverage (
+    file_id INTEGER NOT NULL,
+    start_line INTEGER NOT NULL,
+    end_line INTEGER NOT NULL,
+    test_id INTEGER NOT NULL,
+    PRIMARY KEY (file_id, start_line, end_line, test_id)
+) WITHOUT ROWID;
+"""
+
+
+def open_index(path: str = INDEX_PATH) -> sqlite3.Connection:
+    """
+    Open the index database, creating it if it doesn't exist.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def package_files(root: str, package: str) -> list[str]:
+    """
+    Return the Go files of a package, relative to the root of the repo.
+    """
+    directory = os.path.join(root, package)
+    return sorted(
+        os.path.join(package, entry)
+        for entry in os.listdir(directory)
+        if entry.endswith(".go")
+    )
+
+
+def is_package_fresh(conn: sqlite3.Connection, root: str, package: str) -> bool:
+    """
+    Check whether the indexed coverage of a package is still valid.
+
+    The files are compared by mtime first, and only the files whose mtime
+    changed are hashed. The recorded mtime is refreshed when the content is
+    unchanged, so the next check is cheap again.
+    """
+    rows = conn.execute(
+        "SELECT path, mtime, hash FROM files WHERE package = ?", (package,)
+    ).fetchall()
+    if not rows:
+        return False
+
+    try:
+        current_files = package_files(root, package)
+    except FileNotFoundError:
+        return False
+
+    recorded = {path: (mtime, hash) for path, mtime, hash in rows}
+    if set(recorded) != set(current_files):
+        return False
+
+    for path in current_files:
+        mtime, hash = recorded[path]
+        current_mtime = os.path.getmtime(os.path.join(root, path))
+        if current_mtime == mtime:
+            continue
+        if file_hash(os.path.join(root, path)) != hash:
+            return False
+        conn.execute("UPDATE files SET mtime = ? WHERE path = ?", (current_mtime, path))
+
+    conn.commit()
+    return True
+
+
+def lookup(
+    conn: sqlite3.Connection, root: str, code_file: str, code_line: int
+) -> Optional[list[str]]:
+    """
+    Return the tests covering a line of code, of the form "pkg/subpkg:TestName".
+
+    Return None if the package of the file isn't indexed or its index is stale.
+    """
+    package = os.path.dirname(code_file)
+    if not is_package_fresh(conn, root, package):
+        return None
+
+    rows = conn.execute(
+        """
+        SELECT DISTINCT tests.package, tests.name
+        FROM files
+        JOIN coverage ON coverage.file_id = files.id
+        JOIN tests ON tests.id = coverage.test_id
+        WHERE files.path = ? AND coverage.start_line <= ? AND coverage.end_line >= ?
+        ORDER BY tests.name
+        """,
+        (code_file, code_line, code_line),
+    ).fetchall()
+    return [f"{package}:{name}" for package, name in rows]
+
+
+def parse_cover_profile(path: str) -> list[tuple[str, int, int]]:
+    """
+    Parse a Go coverage profile and return the covered blocks as
+    (file, start line, end line), with the file relative to the root of the repo.
+
+    Example of a line in the profile:
+    github.com/cockroachdb/cockroach/pkg/kv/kvserver/queue.go:1204.3,1206.10 2 1
+    """
+    blocks = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("mode:"):
+                continue
+            try:
+                location, _, count = line.split()
+            except ValueError:
+                continue
+            if count == "0":
+                continue
+
+            code_file, span = location.rsplit(":", 1)
+            start, end = span.split(",")
+            code_file = code_file.removeprefix(GO_MODULE + "/")
+            blocks.append((code_file, int(start.split(".")[0]), int(end.split(".")[0])))
+    return blocks
+
+
+def index_package(
+    conn: sqlite3.Connection, root: str, package: str, force: bool = False
+) -> bool:
+    """
+    Run every test of a package with a coverage profile and record the result.
+
+    The package is skipped if its index is fresh, unless force is True.
+
+    Return True if the package was profiled.
+    """
+    if not force and is_package_fresh(conn, root, package):
+        print(f"{package}: index is up to date")
+        return False
+
+    package_dir = os.path.join(root, package)
+    with tempfile.TemporaryDirectory(prefix="identify-test-") as tmp_dir:
+        binary = os.path.join(tmp_dir, "test.bin")
+        print(f"{package}: building the test binary")
+        subprocess.run(
+            ["go", "test", "-c", "-cover", "-o", binary, f"./{package}"],
+            cwd=root,
+            check=True,
+        )
+        if not os.path.exists(binary):
+            # the package has no tests
+            print(f"{package}: no tests found")
+            tests = []
+        else:
+            tests = subprocess.run(
+                [binary, "-test.list", "^Test"],
+                cwd=package_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                check=True,
+            ).stdout.split()
+
+        # the files are recorded before running the tests, so a change made
+        # during the run is detected by the next freshness check
+        files = [
+            (path, os.path.getmtime(os.path.join(root, path)), file_hash(os.path.join(root, path)))
+            for path in package_files(root, package)
+        ]
+
+        coverage = {}
+        for i, test_name in enumerate(tests):
+            print(f"{package}: [{i + 1}/{len(tests)}] {test_name}")
+            profile = os.path.join(tmp_dir, f"{test_name}.cover")
+            subprocess.run(
+                [
+                    binary,
+                    "-test.run",
+                    f"^{test_name}$",
+                    "-test.count",
+                    "1",
+                    "-test.timeout",
+                    "10m",
+                    "-test.coverprofile",
+                    profile,
+                ],
+                cwd=package_dir,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if os.path.exists(profile):
+                coverage[test_name] = parse_cover_profile(profile)
+
+    clear_package(conn, package)
+
+    file_ids = {}
+    for path, mtime, hash in files:
+        cursor = conn.execute(
+            "INSERT INTO files (path, package, mtime, hash) VALUES (?, ?, ?, ?)",
+            (path, package, mtime, hash),
+        )
+        file_ids[path] = cursor.lastrowid
+
+    for test_name, blocks in coverage.items():
+        cursor = conn.execute(
+            "INSERT INTO tests (package, name) VALUES (?, ?)", (package, test_name)
+        )
+        test_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT OR IGNORE INTO coverage VALUES (?, ?, ?, ?)",
+            [
+                (file_ids[code_file], start, end, test_id)
+                for code_file, start, end in blocks
+                if code_file in file_ids
+            ],
+        )
+
+    conn.commit()
+    print(f"{package}: indexed {len(coverage)} tests")
+    return True
+
+
+def clear_package(conn: sqlite3.Connection, package: str):
+    """
+    Remove the recorded files, tests and coverage of a package.
+    """
+    conn.execute(
+        "DELETE FROM coverage WHERE file_id IN (SELECT id FROM files WHERE package = ?)",
+        (package,),
+    )
+    conn.execute("DELETE FROM files WHERE package = ?", (package,))
+    conn.execute("DELETE FROM tests WHERE package = ?", (package,))
@@ -0,0 +1,177 @@
+# Inject code into Go files without modifying the source tree.
+#
+# The injected version of every file is written to a scratch directory, and
+# "go test -c -overlay <json>" compiles the package with the scratch files in
+# place of the real ones. The source tree is never written, so an interrupted
+# run can't leave injected code behind, and the files keep their mtime (the
+# Bazel and gopls caches stay valid).
+#
+# The scratch directory is removed when the Overlay context exits, including
+# on an exception or Ctrl-C.
+#
+# The test binaries are cached under ~/.cache, keyed by the injected contents
+# and the state of the source tree (HEAD, plus the mtime and size of every
+# modified or untracked file), so running again with the same injection and an
+# unchanged tree skips the build. A handful of binaries are kept, the least
+# recently used ones are removed.
+#
+# This module is used by identify-test.py.
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Optional
+
+
+BINARY_CACHE_DIR = os.path.expanduser("~/.cache/cockroach-toolkit/identify-test/binaries")
+
+# the test binaries of the big packages take a few hundred MB each
+MAX_CACHED_BINARIES = 8
+
+
+class Overlay:
+    """
+    A set of files replaced in the Go build, see the top of this file.
+
+    Example:
+    >>> with Overlay(root) as overlay:
+    ...     overlay.replace("pkg/kv/kvserver/queue.go", content)
+    ...     binary = build_test_binary(root, "pkg/kv/kvserver", overlay)
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        # relative path -> injected content
+        self.files = {}
+        self.scratch_dir = None
+
+    def __enter__(self):
+        self.scratch_dir = tempfile.mkdtemp(prefix="go-overlay-")
+        return self
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        self.scratch_dir = None
+
+    def replace(self, path: str, content: str):
+        """
+        Replace a file, relative to the root, by the given content.
+        """
+        self.files[path] = content
+
+    def write(self) -> str:
+        """
+        Write the scratch files and the overlay JSON, return the path of the JSON.
+        """
+        replace = {}
+        for i, (path, content) in enumerate(sorted(self.files.items())):
+            # keep the base name, the compiler reports errors with it
+            scratch_path = os.path.join(self.scratch_dir, str(i), os.path.basename(path))
+            os.makedirs(os.path.dirname(scratch_path), exist_ok=True)
+            with open(scratch_path, "w") as f:
+                f.write(content)
+            replace[os.path.join(self.root, path)] = scratch_path
+
+        overlay_path = os.path.join(self.scratch_dir, "overlay.json")
+        with open(overlay_path, "w") as f:
+            json.dump({"Replace": replace}, f, indent=2)
+        return overlay_path
+
+    def fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for path, content in sorted(self.files.items()):
+            digest.update(path.encode() + b"\0")
+            digest.update(hashlib.sha256(content.encode()).digest())
+        return digest.hexdigest()
+
+
+def tree_fingerprint(root: str) -> str:
+    """
+    Return a fingerprint of the source tree which changes with HEAD or with any
+    modified or untracked file.
+    """
+    head = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=root, stdout=subprocess.PIPE, text=True, check=True
+    ).stdout.strip()
+    status = subprocess.run(
+        ["git", "status", "--porcelain", "-z", "--untracked-files=all"],
+        cwd=root,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+
+    digest = hashlib.sha256(head.encode())
+    for entry in sorted(filter(None, status.split("\0"))):
+        # "XY path", the source path of a rename is a separate entry
+        path = entry[3:] if len(entry) > 3 and entry[2] == " " else entry
+        try:
+            stat = os.stat(os.path.join(root, path))
+            digest.update(f"{entry}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode())
+        except OSError:
+            digest.update(f"{entry}\0-\0".encode())
+    return digest.hexdigest()
+
+
+def prune_binaries(keep: int = MAX_CACHED_BINARIES):
+    """
+    Remove the least recently used binaries. The ".test.tmp" files are being
+    written by a running build and are left alone.
+    """
+    binaries = []
+    for entry in os.listdir(BINARY_CACHE_DIR):
+        if not entry.endswith(".test"):
+            continue
+        path = os.path.join(BINARY_CACHE_DIR, entry)
+        try:
+            binaries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            # removed by another run
+            pass
+    binaries.sort(reverse=True)
+    for _, path in binaries[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def build_test_binary(root: str, package: str, overlay: Overlay) -> Optional[str]:
+    """
+    Build the test binary of a package with the overlay, or reuse the cached
+    one if neither the overlay nor the source tree changed.
+
+    Return the path of the binary, or None if the package has no tests.
+    Raise subprocess.CalledProcessError if the build fails.
+    """
+    key = hashlib.sha256(
+        f"{package}\0{overlay.fingerprint()}\0{tree_fingerprint(root)}".encode()
+    ).hexdigest()
+    binary = os.path.join(BINARY_CACHE_DIR, f"{key[:16]}.test")
+    if os.path.exists(binary):
+        print(f"{package}: reusing the test binary {binary}")
+        # mark it as recently used
+        os.utime(binary)
+        return binary
+
+    os.makedirs(BINARY_CACHE_DIR, exist_ok=True)
+    tmp_binary = f"{binary}.tmp"
+    print(f"{package}: building the test binary")
+    try:
+        subprocess.run(
+            ["go", "test", "-c", f"-overlay={overlay.write()}", "-o", tmp_binary, f"./{package}"],
+            cwd=root,
+            check=True,
+        )
+        if not os.path.exists(tmp_binary):
+            return None
+        os.replace(tmp_binary, binary)
+    finally:
+        if os.path.exists(tmp_binary):
+            os.remove(tmp_binary)
+
+    prune_binaries()
+    return binary
@@ -3,20 +3,61 @@
 # Identify which unit test calls a specific piece of code.
 #
 # Usage: identify-test.py <path-to-code>
+#        identify-test.py [--batch] [--from-file <file>] [--git-diff [<rev>]] [<path-to-code> ...]
+#        identify-test.py index [--force] <package> ...
 # Example: identify-test.py cockroach/pkg/kv/kvserver/queue.go:1204
+# Example: identify-test.py --git-diff upstream/master
+# Example: identify-test.py index pkg/kv/kvserver
+#
+# In batch mode, a non-fatal marker is injected at every location and each
+# package is tested only once, so the cost is one build per package instead of
+# one build per line.
+#
+# The code is injected through a Go overlay (see go_overlay.py), the source
+# tree is never modified. The tests are built with "go test -c" instead of
+# "./dev test", since Bazel doesn't support overlays, and the test binary is
+# reused while the injection and the source tree stay the same.
+#
+# The "index" subcommand runs the tests of the given packages once with
+# coverage profiles and stores a line -> test index on disk. Lookups for lines
+# in an indexed package are answered from the index, as long as none of the
+# package's files changed since it was indexed.
 
 
 import os
 import re
+import shlex
 import subprocess
 import sys
-import threading
-import time
+from collections import defaultdict
 from typing import Tuple
 
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+import coverage_index
+import go_overlay
+
+import command_runner
+
 
 COCKROACH_ROOT = os.path.expanduser("~/code/cockroach")
 
+# The marker written to stderr by the code injected in batch mode, followed by
+# the id of the location.
+LOCATION_MARKER = "IDENTIFY_TEST_LOC:"
+
+# Comment appended to every injected line so it can be recognized in the source.
+INJECTION_TAG = "// IDENTIFY_TEST"
+
+# The code injected by identify_test, which stops at the first test reaching it
+PANIC_CODE = f'panic("IDENTIFY_TEST") {INJECTION_TAG}'
+
+# A line ending with "{" which opens a block of statements, as opposed to a
+# composite literal (e.g. "x := T{" or "map[string]int{")
+BLOCK_OPENER = re.compile(
+    r"^(\}\s*)?(func|if|for|switch|select|else|go func|defer func)\b|\bfunc\s*\(.*\)\s*\S*\s*\{$|^\{$"
+)
+
 
 def identify_test(code_file: str, code_line: int) -> list[str]:
     """
@@ -40,22 +81,7 @@ def identify_test(code_file: str, code_line: int) -> list[str]:
     # remove the file name to get the package path
     package_path = os.path.dirname(code_file)
 
-    # inject panic into the code to identify the test
-    inject_code(
-        code_file,
-        code_line,
-        """
-        panic("IDENTIFY_TEST")
-        """,
-    )
-
-    output = run_command(
-        f"./dev test {package_path}",
-        output_file="/tmp/out",
-        # stream_output=True,
-        stream_output=False,
-        kill_on_output="panic",
-    )
+    warn_leftover_injection(code_file)
 
     # analyze the output to identify the test
     # test example:
@@ -67,134 +93,423 @@ def identify_test(code_file: str, code_line: int) -> list[str]:
     )
 
     tests = []
-    for match in test_pattern.finditer(output):
-        package_path = match.group(1)
-        test_name = match.group(2)
-        if test_name == "TestMain":
-            continue
+    line_count = 0
+
+    def collect_tests(line: str):
+        nonlocal line_count
+        line_count += 1
+        for match in test_pattern.finditer(line):
+            package_path = match.group(1)
+            test_name = match.group(2)
+            if test_name == "TestMain":
+                continue
 
-        formatted_test = f"{package_path}:{test_name}"
-        tests.append(formatted_test)
+            formatted_test = f"{package_path}:{test_name}"
+            tests.append(formatted_test)
+
+    # inject panic into the code to identify the test
+    with go_overlay.Overlay(COCKROACH_ROOT) as overlay:
+        overlay.replace(code_file, inject_code(code_file, code_line, PANIC_CODE))
+        try:
+            binary = go_overlay.build_test_binary(COCKROACH_ROOT, package_path, overlay)
+        except subprocess.CalledProcessError:
+            print(f"Failed to build the tests of {package_path}")
+            return []
+    if binary is None:
+        print(f"No tests found in {package_path}")
+        return []
+
+    command = f"{shlex.quote(binary)} -test.v"
+    print(f"Running command: {command}")
+    command_runner.run_command(
+        command,
+        log_path="/tmp/out",
+        line_handlers=[collect_tests],
+        kill_on_output="panic",
+        cwd=package_path,
+    )
 
     # print the count of lines in the output
-    print(f"Output lines: {len(output.splitlines())}")
+    print(f"Output lines: {line_count}")
 
     for test in tests:
         print(test)
+    return tests
 
 
-def inject_code(code_file: str, code_line: int, injected_code: str):
+def identify_tests_batch(locations: list[Tuple[str, int]]) -> dict[str, list[str]]:
     """
-    Inject code into a specific line of a file.
+    Identify which unit tests call each of the given lines of code.
 
-    Throws an exception if any error occurs.
+    A uniquely tagged `println` (which writes to stderr and doesn't stop the
+    test) is injected at every location, then the tests of every affected
+    package are run once in verbose mode. Each marker in the output is
+    attributed to the test that was running when it was printed.
+
+    The code is injected through a Go overlay, the source files are not modified.
+
+    Return a dict from "file:line" to a list of tests of the form
+    "pkg/subpkg:TestName".
+
+    Example:
+    >>> identify_tests_batch([("pkg/kv/kvserver/queue.go", 1204)])
+    {"pkg/kv/kvserver/queue.go:1204": ["pkg/kv/kvserver:TestQueue"]}
     """
-    with open(code_file, "r") as f:
-        lines = f.readlines()
+    os.chdir(COCKROACH_ROOT)
+
+    # assign an id to every location, grouped by package
+    location_names = {}
+    packages = defaultdict(list)
+    for code_file, code_line in locations:
+        code_file = code_file.replace("cockroach/", "")
+        location_id = len(location_names)
+        location_names[location_id] = f"{code_file}:{code_line}"
+        packages[os.path.dirname(code_file)].append((location_id, code_file, code_line))
+
+    results = {name: [] for name in location_names.values()}
+
+    for package_path, package_locations in packages.items():
+        print(
+            f"Identifying tests for {len(package_locations)} locations in {package_path}..."
+        )
+
+        with go_overlay.Overlay(COCKROACH_ROOT) as overlay:
+            for code_file, content in inject_markers(package_locations).items():
+                overlay.replace(code_file, content)
+            try:
+                binary = go_overlay.build_test_binary(COCKROACH_ROOT, package_path, overlay)
+            except subprocess.CalledProcessError:
+                # e.g. a marker injected where Go doesn't accept a statement
+                print(f"Failed to build the tests of {package_path}, skipping its locations")
+                continue
+        if binary is None:
+            print(f"No tests found in {package_path}")
+            continue
 
-    # Return if the injected code is already present
-    output = "".join(lines)
-    if injected_code in output:
-        return
+        parser = MarkerParser()
+        output_file = f"/tmp/identify-test-{package_path.replace('/', '-')}.out"
+        command = f"{shlex.quote(binary)} -test.v"
+        print(f"Running command: {command}")
+        command_runner.run_command(
+            command, log_path=output_file, line_handlers=[parser.feed], cwd=package_path
+        )
 
-    lines.insert(code_line - 1, injected_code)
+        hits = parser.hits
+        if not hits:
+            print(f"No marker found in the output, see {output_file} for details.")
 
-    with open(code_file, "w") as f:
-        f.write("".join(lines))
+        for location_id, tests in hits.items():
+            results[location_names[location_id]] = [
+                f"{package_path}:{test_name}" for test_name in sorted(tests)
+            ]
 
+    for location, tests in results.items():
+        print(f"{location}:")
+        for test in tests:
+            print(f"    {test}")
 
-from typing import Tuple, Optional
+    return results
 
 
-def run_command(
-    command: str,
-    include_stderr: bool = True,
-    output_file: Optional[str] = None,
-    stream_output: bool = False,
-    kill_on_output: Optional[str] = None,
-) -> Tuple[str, int]:
+def inject_markers(locations: list[Tuple[int, str, int]]) -> dict[str, str]:
     """
-    Run a shell command and return its output and exit code.
+    Inject a location marker before each of the given (id, file, line) locations.
 
-    Args:
-        command (str): The shell command to execute.
-        include_stderr (bool, optional): If True, stderr is included in the output. Defaults to True.
-        output_file (Optional[str], optional): The file path where output will be written in real-time. If None, no file is written.
-                                               If the file exists, it will be overwritten. Defaults to None.
-        stream_output (bool, optional): If True, streams the output to stdout while executing. Defaults to False.
-        kill_on_output (Optional[str], optional): If the given string is found in the output, the process will be killed after 1 second.
-                                                 Defaults to None.
+    Lines that don't look like the start of a statement inside a function body
+    (see is_statement_line) are skipped with a warning.
 
-    Returns:
-        Tuple[str, int]: A tuple containing the output of the command as a string and the exit code of the process.
+    Return a dict from the files to their injected content, the files
+    themselves are not modified.
     """
-    f = None
-    if output_file:
-        f = open(output_file, "w")
+    by_file = defaultdict(list)
+    for location_id, code_file, code_line in locations:
+        by_file[code_file].append((location_id, code_line))
 
-    print(f"Running command: {command}")
-    print(f"Running command: {command}", file=f)
+    injected_files = {}
+    for code_file, file_locations in by_file.items():
+        warn_leftover_injection(code_file)
+        with open(code_file, "r") as f:
+            lines = f.read().splitlines(keepends=True)
 
-    # Set up the subprocess command
-    stderr_option = subprocess.STDOUT if include_stderr else None
-    process = subprocess.Popen(
-        command, shell=True, stdout=subprocess.PIPE, stderr=stderr_option, text=True
-    )
+        # inject from the bottom up so the line numbers stay valid
+        injected = False
+        for location_id, code_line in sorted(file_locations, key=lambda x: -x[1]):
+            if not is_statement_line(lines, code_line - 1):
+                print(f"Skipping {code_file}:{code_line}: not a statement")
+                continue
+
+            target = lines[code_line - 1]
+            indent = target[: len(target) - len(target.lstrip())]
+            marker = f'{indent}println("{LOCATION_MARKER}{location_id}") {INJECTION_TAG}\n'
+            lines.insert(code_line - 1, marker)
+            injected = True
+
+        if injected:
+            injected_files[code_file] = "".join(lines)
+
+    return injected_files
+
+
+def is_statement_line(lines: list[str], index: int) -> bool:
+    """
+    Check whether a statement can be inserted before the given line.
+
+    This relies on the layout of gofmt-ed code: function bodies are indented
+    and closed by a "}" in the first column, and a statement can't start after
+    a line which ends with an operator, an open bracket or the "{" of a
+    composite literal.
+    """
+    if index < 0 or index >= len(lines):
+        return False
+
+    stripped = lines[index].strip()
+    if not stripped or not lines[index].startswith("\t"):
+        return False
+    if stripped.startswith(("}", ")", ".", "case ", "default:")):
+        return False
+
+    # find the enclosing top-level declaration
+    in_func = False
+    for line in reversed(lines[:index]):
+        if line.startswith("}") or line.startswith(")"):
+            break
+        if line.startswith("func "):
+            in_func = True
+            break
+    if not in_func:
+        return False
+
+    # find the previous line of code
+    for line in reversed(lines[:index]):
+        previous = line.strip()
+        if previous and not previous.startswith("//"):
+            break
+    else:
+        return False
+
+    if previous.endswith("{"):
+        return BLOCK_OPENER.search(previous) is not None
+    return not previous.endswith((",", "(", "[", "+", "-", "*", "/", "&&", "||", "=", "."))
+
+
+class MarkerParser:
+    """
+    Map each location marker in the verbose test output to the tests that hit it,
+    one line at a time.
 
-    output = []
-    kill_event = threading.Event()
+    A marker is attributed to the test of the closest preceding "=== RUN" or
+    "=== CONT" line. Subtests are attributed to their top-level test.
+    """
 
-    def monitor_output():
-        while process.poll() is None:
-            # process is still running
+    test_pattern = re.compile(r"^=== (?:RUN|CONT)\s+(Test[A-Za-z0-9_]*)")
+    marker_pattern = re.compile(re.escape(LOCATION_MARKER) + r"(\d+)")
 
-            line = process.stdout.readline()
-            if not line:
-                break
-            if stream_output:
-                print(line, end="")  # Stream the output to stdout
-            output.append(line)
-            if f:
-                f.write(line)  # Write output to the file in real-time
-                f.flush()  # Ensure the output is written immediately
-            if kill_on_output:
-                if kill_on_output in line:
-                    kill_event.set()
+    def __init__(self):
+        self.hits = defaultdict(set)
+        self.current_test = None
 
-    def control_process():
-        kill_event.wait()
+    def feed(self, line: str):
+        match = self.test_pattern.match(line)
+        if match:
+            self.current_test = match.group(1)
+            return
 
-        # sleep for 1 second for more output
-        time.sleep(1)
+        match = self.marker_pattern.search(line)
+        if match and self.current_test and self.current_test != "TestMain":
+            self.hits[int(match.group(1))].add(self.current_test)
 
-        process.kill()
 
-    # Start monitoring the output in a separate thread
-    thread = threading.Thread(target=monitor_output)
-    thread.start()
+def lookup_index(
+    locations: list[Tuple[str, int]],
+) -> Tuple[dict[str, list[str]], list[Tuple[str, int]]]:
+    """
+    Look up the given locations in the coverage index.
 
-    # Start the control process in a separate thread
-    control_thread = threading.Thread(target=control_process)
-    control_thread.start()
+    Return the tests of the locations found in a fresh index, and the locations
+    that still need to be identified by running the tests.
+    """
+    conn = coverage_index.open_index()
+    found = {}
+    missing = []
+    for code_file, code_line in locations:
+        code_file = code_file.replace("cockroach/", "")
+        tests = coverage_index.lookup(conn, COCKROACH_ROOT, code_file, code_line)
+        if tests is None:
+            missing.append((code_file, code_line))
+        else:
+            found[f"{code_file}:{code_line}"] = tests
+    conn.close()
+    return found, missing
+
+
+def build_index(packages: list[str], force: bool = False):
+    """
+    Build the coverage index for the given packages.
+    """
+    conn = coverage_index.open_index()
+    for package in packages:
+        package = package.replace("cockroach/", "").rstrip("/")
+        coverage_index.index_package(conn, COCKROACH_ROOT, package, force=force)
+    conn.close()
 
-    thread.join()  # Wait for the thread to finish
-    control_thread.join()  # Wait for the control thread to finish
 
-    process.wait()  # Ensure the process has terminated
-    return "".join(output)
+def read_locations_file(path: str) -> list[Tuple[str, int]]:
+    """
+    Read locations of the form "file:line" from a file, one per line.
+
+    Empty lines and lines starting with "#" are ignored.
+    """
+    locations = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                locations.append(parse_location(line))
+    return locations
+
+
+def git_diff_locations(rev: str) -> list[Tuple[str, int]]:
+    """
+    Return the added or modified lines of the Go files changed since the given revision.
+
+    For a hunk which only removes lines, the line following the removal is used.
+    """
+    output = subprocess.run(
+        ["git", "diff", "-U0", rev, "--", "*.go"],
+        cwd=COCKROACH_ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+
+    hunk_pattern = re.compile(r"^@@ -\S+ \+(\d+)(?:,(\d+))? @@")
+
+    locations = []
+    code_file = None
+    for line in output.splitlines():
+        if line.startswith("+++ "):
+            path = line[4:]
+            code_file = path[2:] if path.startswith("b/") else None
+            continue
+
+        match = hunk_pattern.match(line)
+        if match and code_file:
+            start = int(match.group(1))
+            count = int(match.group(2)) if match.group(2) is not None else 1
+            if count == 0:
+                locations.append((code_file, start + 1))
+            for code_line in range(start, start + count):
+                locations.append((code_file, code_line))
+
+    return locations
+
+
+def parse_location(code_path: str) -> Tuple[str, int]:
+    """
+    Parse a location of the form "file:line".
+
+    Throws a ValueError if the location is invalid.
+    """
+    parts = code_path.split(":")
+    if len(parts) != 2:
+        raise ValueError(f"Invalid path: {code_path}")
+    return parts[0], int(parts[1])
+
+
+def inject_code(code_file: str, code_line: int, injected_code: str) -> str:
+    """
+    Return the content of a file with a line of code injected before the given
+    line, indented like it. The file itself is not modified.
+
+    Throws an exception if any error occurs.
+    """
+    with open(code_file, "r") as f:
+        lines = f.readlines()
+
+    target = lines[code_line - 1] if code_line <= len(lines) else ""
+    indent = target[: len(target) - len(target.lstrip())]
+    lines.insert(code_line - 1, f"{indent}{injected_code}\n")
+    return "".join(lines)
+
+
+def warn_leftover_injection(code_file: str):
+    """
+    Warn about code injected into the source file itself, by an older version
+    of this script which didn't use an overlay.
+    """
+    with open(code_file, "r") as f:
+        content = f.read()
+    if INJECTION_TAG in content or 'panic("IDENTIFY_TEST")' in content:
+        print(f"Warning: {code_file} contains injected code, restore it with git checkout")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: identify-test.py <path-to-code>")
+    import argparse
+
+    if len(sys.argv) > 1 and sys.argv[1] == "index":
+        index_parser = argparse.ArgumentParser(
+            prog="identify-test.py index",
+            description="Index the lines covered by each test of the given packages.",
+        )
+        index_parser.add_argument("packages", nargs="+", help="e.g. pkg/kv/kvserver")
+        index_parser.add_argument(
+            "--force", action="store_true", help="re-profile even if the index is fresh"
+        )
+        index_args = index_parser.parse_args(sys.argv[2:])
+        build_index(index_args.packages, force=index_args.force)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Identify which unit test calls a specific piece of code."
+    )
+    parser.add_argument("locations", nargs="*", help="locations of the form file:line")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="inject a non-fatal marker and run each package once",
+    )
+    parser.add_argument(
+        "--from-file", help="read locations from a file, one per line (implies --batch)"
+    )
+    parser.add_argument(
+        "--git-diff",
+        nargs="?",
+        const="upstream/master",
+        metavar="REV",
+        help="use the lines changed since REV, default upstream/master (implies --batch)",
+    )
+    parser.add_argument(
+        "--no-index", action="store_true", help="don't answer from the coverage index"
+    )
+    args = parser.parse_args()
+
+    try:
+        locations = [parse_location(location) for location in args.locations]
+        if args.from_file:
+            locations += read_locations_file(args.from_file)
+    except ValueError as e:
+        print(e)
         sys.exit(1)
+    if args.git_diff:
+        locations += git_diff_locations(args.git_diff)
 
-    code_path = sys.argv[1]
-    code_path = code_path.split(":")
-    if len(code_path) != 2:
-        print("Invalid path")
+    if not locations:
+        parser.print_usage()
         sys.exit(1)
 
-    code_file = code_path[0]
-    code_line = int(code_path[1])
-    identify_test(code_file, code_line)
+    batch = args.batch or args.from_file or args.git_diff or len(locations) > 1
+
+    if not args.no_index:
+        found, locations = lookup_index(locations)
+        for location, tests in found.items():
+            print(f"{location} (from index):")
+            for test in tests:
+                print(f"    {test}")
+        if not locations:
+            sys.exit(0)
+
+    if batch:
+        identify_tests_batch(locations)
+    else:
+        code_file, code_line = locations[0]
+        identify_test(code_file, code_line)
@@ -0,0 +1,790 @@
+#!/usr/bin/env python3
+
+# Usage: run-sql.py [--nodes N] [--url URL] [--jobs J] [--log-dir DIR] <scenario> ...
+#        run-sql.py --bench [--iterations N] [--warmup W] [--concurrency C] [--output FILE]
+#                   [--baseline FILE] [--threshold PERCENT] [--nodes N] [--url URL] <scenario> ...
+# Example: run-sql.py add_column
+# Example: run-sql.py --bench --concurrency 8 --output /tmp/after.json --baseline /tmp/before.json add_column
+# Example: run-sql.py --nodes 3 --jobs 8 archive/sql/*.sql
+# Example: run-sql.py --url "postgresql://postgres@localhost:5432/postgres?sslmode=disable" add_column
+#
+# Run SQL scenario files against a local CockroachDB cluster.
+#
+# One cluster is started for all the scenarios: N insecure nodes on temporary
+# stores, listening on free ports of localhost. A node is ready as soon as it
+# answers "SELECT 1", which is polled instead of sleeping a fixed time. The
+# cluster is stopped and its stores removed at the end, even on Ctrl-C. With
+# --url, the scenarios run against an existing server instead, which can be
+# any server speaking the Postgres wire protocol.
+#
+# The scenarios run concurrently (--jobs), each in its own database, created
+# from scratch, on connections borrowed from a pool spread over the nodes.
+# The statements of a scenario run one by one in autocommit mode, on one
+# connection; a scenario stops at its first failed statement. The results of
+# each scenario are written to "<log_dir>/<scenario>.out", and the latency of
+# every statement is printed at the end.
+#
+# A scenario is a path to a SQL file, or the name of a file of archive/sql.
+#
+# With --bench, the scenarios are benchmarked one after another: --concurrency
+# clients run the scenario, each in its own database, --warmup times without
+# measuring, then --iterations measured times. The measured phase starts for
+# all the clients at once. The p50/p95/p99 latency of every statement and the
+# throughput (scenario iterations per second, over all the clients) are
+# printed and saved as JSON (--output). The scenarios must be rerunnable,
+# e.g. start with "DROP TABLE IF EXISTS".
+#
+# With --baseline, the results are compared with a JSON file saved by an
+# earlier run (e.g. before a patch). A statement whose p50 or p99 grew by more
+# than --threshold percent (and by more than MIN_REGRESSION_DELTA), or a
+# scenario whose throughput dropped by more than --threshold percent, is a
+# regression, and the exit code is 1.
+#
+# Requires the "psycopg2" package.
+
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+import psycopg2
+
+COCKROACH_ROOT = os.path.expanduser("~/code/cockroach")
+COCKROACH_BINARY = os.path.join(COCKROACH_ROOT, "cockroach")
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "archive", "sql")
+
+# How long a node may take to answer "SELECT 1"
+STARTUP_TIMEOUT = 60
+POLL_INTERVAL = 0.1
+# How long a node may take to stop before it's killed
+SHUTDOWN_TIMEOUT = 10
+
+# The latency changes below this are noise, in seconds
+MIN_REGRESSION_DELTA = 0.0005
+
+
+@dataclass
+class Node:
+    process: subprocess.Popen
+    sql_port: int
+    store_dir: str
+    log_path: str
+
+    @property
+    def url(self) -> str:
+        return f"postgresql://root@localhost:{self.sql_port}/defaultdb?sslmode=disable"
+
+
+@dataclass
+class StatementResult:
+    # the line of the scenario where the statement starts
+    line: int
+    statement: str
+    # in seconds
+    latency: float
+    rows: Optional[int] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    database: str
+    statements: list[StatementResult] = field(default_factory=list)
+
+    @property
+    def failed(self) -> bool:
+        return any(result.error for result in self.statements)
+
+
+@dataclass
+class ClientRun:
+    """
+    The measured iterations of one benchmark client.
+    """
+
+    # the latencies of each statement of the scenario, in seconds
+    latencies: list[list[float]]
+    # the failed iterations, by the statement which failed
+    errors: list[int]
+    # the first error message
+    error: Optional[str] = None
+    start_time: float = 0
+    end_time: float = 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(node: Node, timeout: float = STARTUP_TIMEOUT):
+    """
+    Poll the SQL port of a node until it answers "SELECT 1".
+
+    Raise RuntimeError if the node exits or doesn't answer in time.
+    """
+    deadline = time.time() + timeout
+    while True:
+        if node.process.poll() is not None:
+            raise RuntimeError(f"node exited with code {node.process.returncode}, see {node.log_path}")
+        try:
+            with socket.create_connection(("localhost", node.sql_port), timeout=1):
+                pass
+            conn = psycopg2.connect(node.url, connect_timeout=2)
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                return
+            finally:
+                conn.close()
+        except (OSError, psycopg2.Error):
+            if time.time() > deadline:
+                raise RuntimeError(f"node not ready after {timeout}s, see {node.log_path}")
+            time.sleep(POLL_INTERVAL)
+
+
+def stop_nodes(nodes: list[Node]):
+    for node in nodes:
+        if node.process.poll() is None:
+            node.process.send_signal(signal.SIGTERM)
+    for node in nodes:
+        try:
+            node.process.wait(timeout=SHUTDOWN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            node.process.kill()
+            node.process.wait()
+        shutil.rmtree(node.store_dir, ignore_errors=True)
+
+
+@contextmanager
+def start_cluster(node_count: int, log_dir: str, binary: str = COCKROACH_BINARY) -> Iterator[list[Node]]:
+    """
+    Start a local insecure cluster on temporary stores, yield its nodes once
+    they are all ready. The nodes are stopped and their stores removed at the
+    end of the context.
+
+    The output of node i is written to "<log_dir>/node-<i>.log".
+    """
+    listen_ports = [free_port() for _ in range(node_count)]
+    join = ",".join(f"localhost:{port}" for port in listen_ports)
+
+    nodes = []
+    try:
+        for i, listen_port in enumerate(listen_ports):
+            store_dir = tempfile.mkdtemp(prefix=f"run-sql-node-{i + 1}-")
+            sql_port = free_port()
+            command = [
+                binary,
+                "start-single-node" if node_count == 1 else "start",
+                "--insecure",
+                f"--store={store_dir}",
+                f"--listen-addr=localhost:{listen_port}",
+                f"--sql-addr=localhost:{sql_port}",
+                f"--http-addr=localhost:{free_port()}",
+            ]
+            if node_count > 1:
+                command.append(f"--join={join}")
+
+            log_path = os.path.join(log_dir, f"node-{i + 1}.log")
+            with open(log_path, "w") as log_file:
+                process = subprocess.Popen(
+                    command, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True
+                )
+            nodes.append(Node(process, sql_port, store_dir, log_path))
+
+        if node_count > 1:
+            with open(os.path.join(log_dir, "init.log"), "w") as log_file:
+                subprocess.run(
+                    [binary, "init", "--insecure", f"--host=localhost:{listen_ports[0]}"],
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT,
+                    check=True,
+                )
+
+        start_time = time.time()
+        for node in nodes:
+            wait_until_ready(node)
+        print(f"{node_count} nodes ready in {time.time() - start_time:.1f}s")
+
+        yield nodes
+    finally:
+        stop_nodes(nodes)
+
+
+class ConnectionPool:
+    """
+    A pool of at most `size` connections, opened on the given servers in turn.
+
+    The idle connections are kept by database. When a connection to a new
+    database is needed and the pool is full, an idle connection to another
+    database is closed.
+
+    cancel() cancels the statements running on the borrowed connections, from
+    another thread, and makes the pool refuse new borrowers.
+    """
+
+    def __init__(self, urls: list[str], size: int):
+        self.urls = urls
+        self.size = size
+        self.next_url = 0
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # database -> idle connections
+        self.idle = {}
+        self.open_count = 0
+        self.borrowed = set()
+        self.cancelled = False
+
+    @contextmanager
+    def connection(self, database: Optional[str] = None) -> Iterator["psycopg2.extensions.connection"]:
+        self.slots.acquire()
+        conn = None
+        try:
+            with self.lock:
+                if self.cancelled:
+                    raise RuntimeError("the connection pool was cancelled")
+                if self.idle.get(database):
+                    conn = self.idle[database].pop()
+                else:
+                    if self.open_count == self.size:
+                        # a slot is free, so some connection is idle
+                        next(conns for conns in self.idle.values() if conns).pop().close()
+                        self.open_count -= 1
+                    self.open_count += 1
+                    url = self.urls[self.next_url % len(self.urls)]
+                    self.next_url += 1
+            if conn is None:
+                try:
+                    if database is None:
+                        conn = psycopg2.connect(url)
+                    else:
+                        conn = psycopg2.connect(url, dbname=database)
+                except BaseException:
+                    with self.lock:
+                        self.open_count -= 1
+                    raise
+                conn.autocommit = True
+
+            with self.lock:
+                self.borrowed.add(conn)
+            yield conn
+        except BaseException:
+            # the state of the connection is unknown
+            if conn is not None:
+                with self.lock:
+                    self.borrowed.discard(conn)
+                    self.open_count -= 1
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self.lock:
+                    self.borrowed.discard(conn)
+                    self.idle.setdefault(database, []).append(conn)
+            self.slots.release()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            borrowed = list(self.borrowed)
+        for conn in borrowed:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                # e.g. the connection was just closed
+                pass
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+            self.open_count = 0
+
+
+def split_statements(sql: str) -> list[tuple[int, str]]:
+    """
+    Split a SQL script into its statements, return the (line, statement) of
+    each one without the comments.
+
+    The semicolons inside strings, quoted identifiers, dollar-quoted strings
+    and comments don't end a statement.
+    """
+    statements = []
+    current = []
+    start_line = None
+    line = 1
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+            continue
+        if sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            end = len(sql) if end == -1 else end + 2
+            line += sql.count("\n", i, end)
+            current.append(" ")
+            i = end
+            continue
+
+        if char == ";":
+            statement = "".join(current).strip()
+            if statement:
+                statements.append((start_line, statement))
+            current = []
+            start_line = None
+            i += 1
+            continue
+
+        if char in "'\"":
+            # '' and "" are escaped quotes, a new string starts right after
+            end = sql.find(char, i + 1)
+            end = len(sql) if end == -1 else end + 1
+        elif char == "$" and (match := re.match(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$", sql[i:])):
+            end = sql.find(match.group(0), i + len(match.group(0)))
+            end = len(sql) if end == -1 else end + len(match.group(0))
+        else:
+            end = i + 1
+
+        if start_line is None and not char.isspace():
+            start_line = line
+        current.append(sql[i:end])
+        line += sql.count("\n", i, end)
+        i = end
+
+    statement = "".join(current).strip()
+    if statement:
+        statements.append((start_line, statement))
+    return statements
+
+
+def scenario_path(scenario: str) -> str:
+    """
+    Return the path of a scenario, given as a path or as a name of archive/sql.
+    """
+    if os.path.exists(scenario):
+        return scenario
+    return os.path.join(SQL_DIR, f"{scenario}.sql")
+
+
+def scenario_database(name: str) -> str:
+    return "scenario_" + re.sub(r"[^a-z0-9_]", "_", name.lower())
+
+
+def format_rows(cursor) -> str:
+    columns = [column.name for column in cursor.description]
+    lines = ["\t".join(columns)]
+    for row in cursor.fetchall():
+        lines.append("\t".join("NULL" if value is None else str(value) for value in row))
+    return "\n".join(lines) + f"\n({len(lines) - 1} rows)\n"
+
+
+def scenario_names(paths: list[str]) -> list[str]:
+    """
+    Return the names of the scenarios, the file names suffixed with a number
+    when their database would be the same as another one's (see
+    scenario_database).
+    """
+    names = []
+    databases = set()
+    for path in paths:
+        base = os.path.splitext(os.path.basename(path))[0]
+        name = base
+        suffix = 1
+        while scenario_database(name) in databases:
+            suffix += 1
+            name = f"{base}_{suffix}"
+        databases.add(scenario_database(name))
+        names.append(name)
+    return names
+
+
+def create_database(pool: ConnectionPool, database: str):
+    """
+    Create an empty database, dropping the one left by an earlier run.
+    """
+    with pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+        cursor.execute(f"CREATE DATABASE {database}")
+
+
+def run_scenario(pool: ConnectionPool, name: str, path: str, log_dir: str) -> ScenarioResult:
+    """
+    Run the statements of a scenario in a new database, write their results
+    to "<log_dir>/<name>.out".
+    """
+    result = ScenarioResult(name, scenario_database(name))
+    with open(path, "r") as f:
+        statements = split_statements(f.read())
+
+    create_database(pool, result.database)
+
+    with open(os.path.join(log_dir, f"{name}.out"), "w") as out, pool.connection(
+        result.database
+    ) as conn, conn.cursor() as cursor:
+        for line, statement in statements:
+            out.write(f"> {statement};\n")
+            start_time = time.perf_counter()
+            try:
+                cursor.execute(statement)
+                output = format_rows(cursor) if cursor.description else f"{cursor.statusmessage}\n"
+            except psycopg2.Error as e:
+                latency = time.perf_counter() - start_time
+                error = str(e).strip()
+                out.write(f"ERROR: {error}\n")
+                result.statements.append(StatementResult(line, statement, latency, error=error))
+                break
+            latency = time.perf_counter() - start_time
+            out.write(output + "\n")
+            result.statements.append(StatementResult(line, statement, latency, rows=cursor.rowcount))
+
+    return result
+
+
+def cancel_running(pool: ConnectionPool, futures: list):
+    """
+    Cancel the pending tasks and the statements of the running ones, e.g. on
+    Ctrl-C, and wait for them to stop. The servers run in their own session
+    and don't get the interrupt.
+    """
+    for future in futures:
+        future.cancel()
+    # again until they stop, a task may start a statement right after a cancel
+    while not all(future.done() for future in futures):
+        pool.cancel()
+        wait(futures, timeout=1)
+
+
+def run_scenarios(
+    urls: list[str], paths: list[str], log_dir: str, jobs: int
+) -> list[ScenarioResult]:
+    """
+    Run the scenarios concurrently, at most `jobs` at a time.
+    """
+    pool = ConnectionPool(urls, jobs)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = []
+    try:
+        futures = [
+            executor.submit(run_scenario, pool, name, path, log_dir)
+            for name, path in zip(scenario_names(paths), paths)
+        ]
+        return [future.result() for future in futures]
+    except KeyboardInterrupt:
+        cancel_running(pool, futures)
+        raise
+    finally:
+        executor.shutdown()
+        pool.close()
+
+
+def print_results(results: list[ScenarioResult], log_dir: str):
+    print(f"{'LATENCY':>10} {'ROWS':>6}  STATEMENT")
+    for result in results:
+        print(f"{result.name} ({log_dir}/{result.name}.out):")
+        for statement in result.statements:
+            first_line = statement.statement.splitlines()[0]
+            rows = "" if statement.rows is None or statement.rows < 0 else statement.rows
+            print(f"{statement.latency * 1000:>8.1f}ms {rows:>6}  {statement.line}: {first_line}")
+            if statement.error:
+                print(f"{'':>18}ERROR: {statement.error.splitlines()[0]}")
+
+    total = sum(statement.latency for result in results for statement in result.statements)
+    failed = [result.name for result in results if result.failed]
+    print(f"{len(results)} scenarios, {total:.2f}s of statements, {len(failed)} failed")
+    for name in failed:
+        print(f"FAILED: {name}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Return the q-th percentile (0-100) of sorted values, interpolated linearly.
+    """
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def bench_client(
+    pool: ConnectionPool,
+    database: str,
+    statements: list[tuple[int, str]],
+    warmup: int,
+    iterations: int,
+    barrier: threading.Barrier,
+) -> ClientRun:
+    """
+    Run the scenario warmup + iterations times on one connection, measure the
+    last iterations. An iteration stops at its first failed statement.
+    """
+    run = ClientRun([[] for _ in statements], [0] * len(statements))
+    try:
+        create_database(pool, database)
+        with pool.connection(database) as conn, conn.cursor() as cursor:
+            for iteration in range(warmup + iterations):
+                if pool.cancelled:
+                    # the barrier is aborted below
+                    raise RuntimeError("the benchmark was cancelled")
+                measured = iteration >= warmup
+                if iteration == warmup:
+                    # start measuring with the other clients
+                    barrier.wait()
+                    run.start_time = time.perf_counter()
+                for index, (_, statement) in enumerate(statements):
+                    start_time = time.perf_counter()
+                    try:
+                        cursor.execute(statement)
+                        if cursor.description:
+                            cursor.fetchall()
+                    except psycopg2.Error as e:
+                        if measured:
+                            run.errors[index] += 1
+                        run.error = run.error or str(e).strip()
+                        break
+                    if measured:
+                        run.latencies[index].append(time.perf_counter() - start_time)
+            run.end_time = time.perf_counter()
+    except BaseException:
+        # don't leave the other clients waiting
+        barrier.abort()
+        raise
+    return run
+
+
+def bench_scenario(
+    urls: list[str], name: str, path: str, concurrency: int, warmup: int, iterations: int
+) -> dict:
+    """
+    Benchmark a scenario with concurrent clients, return its results (see the
+    top of this file) as a JSON-serializable dict.
+    """
+    with open(path, "r") as f:
+        statements = split_statements(f.read())
+
+    print(f"{name}: {concurrency} clients x ({warmup} warmup + {iterations} iterations)")
+    pool = ConnectionPool(urls, concurrency)
+    barrier = threading.Barrier(concurrency)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(
+                    bench_client,
+                    pool,
+                    f"{scenario_database(name)}_{client}",
+                    statements,
+                    warmup,
+                    iterations,
+                    barrier,
+                )
+                for client in range(concurrency)
+            ]
+            try:
+                runs = [future.result() for future in futures]
+            except KeyboardInterrupt:
+                cancel_running(pool, futures)
+                raise
+    finally:
+        pool.close()
+
+    duration = max(run.end_time for run in runs) - min(run.start_time for run in runs)
+    completed = sum(len(run.latencies[-1]) for run in runs) if statements else 0
+    result = {
+        "scenario": name,
+        "path": path,
+        "duration": duration,
+        "iterations": completed,
+        # completed scenario iterations per second, over all the clients
+        "throughput": completed / duration if duration > 0 else 0.0,
+        "error": next((run.error for run in runs if run.error), None),
+        "statements": [],
+    }
+    for index, (line, statement) in enumerate(statements):
+        latencies = sorted(latency for run in runs for latency in run.latencies[index])
+        result["statements"].append(
+            {
+                "line": line,
+                "statement": statement,
+                "count": len(latencies),
+                "errors": sum(run.errors[index] for run in runs),
+                "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            }
+        )
+    return result
+
+
+def print_bench(results: list[dict]):
+    for result in results:
+        print(
+            f"{result['scenario']}: {result['iterations']} iterations in {result['duration']:.2f}s, "
+            f"{result['throughput']:.1f} iterations/s"
+        )
+        print(f"{'P50':>10} {'P95':>10} {'P99':>10} {'ERRORS':>6}  STATEMENT")
+        for stats in result["statements"]:
+            first_line = stats["statement"].splitlines()[0]
+            print(
+                f"{stats['p50'] * 1000:>8.2f}ms {stats['p95'] * 1000:>8.2f}ms "
+                f"{stats['p99'] * 1000:>8.2f}ms {stats['errors']:>6}  {stats['line']}: {first_line}"
+            )
+        if result["error"]:
+            print(f"ERROR: {result['error'].splitlines()[0]}")
+
+
+def compare_bench(results: list[dict], baseline: dict, settings: dict, threshold: float) -> list[str]:
+    """
+    Compare the results with a baseline, print the changes and return the
+    regressions. Settings are the concurrency, warmup and iterations of the
+    current run, threshold is in percent.
+    """
+    regressions = []
+    baseline_results = {result["scenario"]: result for result in baseline["results"]}
+    print(f"compared with the baseline of {baseline['created_at']}, threshold {threshold:g}%:")
+    for key, value in settings.items():
+        if baseline.get(key) != value:
+            print(f"WARNING: {key} is {value}, {baseline.get(key)} in the baseline, the results aren't comparable")
+    for result in results:
+        old = baseline_results.get(result["scenario"])
+        if old is None:
+            print(f"{result['scenario']}: not in the baseline")
+            continue
+
+        change = (result["throughput"] - old["throughput"]) / old["throughput"] * 100 if old["throughput"] else 0.0
+        print(
+            f"{result['scenario']}: {old['throughput']:.1f} -> {result['throughput']:.1f} iterations/s ({change:+.1f}%)"
+        )
+        if change < -threshold:
+            regressions.append(f"{result['scenario']}: throughput {change:+.1f}%")
+
+        # a statement can be repeated in a scenario
+        old_statements = {(stats["line"], stats["statement"]): stats for stats in old["statements"]}
+        for stats in result["statements"]:
+            old_stats = old_statements.get((stats["line"], stats["statement"]))
+            if old_stats is None:
+                continue
+            first_line = stats["statement"].splitlines()[0]
+            for key in ("p50", "p99"):
+                old_value, value = old_stats[key], stats[key]
+                change = (value - old_value) / old_value * 100 if old_value else 0.0
+                regressed = change > threshold and value - old_value > MIN_REGRESSION_DELTA
+                if regressed or change < -threshold:
+                    print(
+                        f"    {key} {old_value * 1000:.2f}ms -> {value * 1000:.2f}ms ({change:+.1f}%)  {stats['line']}: {first_line}"
+                    )
+                if regressed:
+                    regressions.append(f"{result['scenario']}:{stats['line']}: {key} {change:+.1f}%")
+
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return regressions
+
+
+def run_bench(urls: list[str], paths: list[str], args) -> list[dict]:
+    """
+    Benchmark the scenarios one after another, so they don't slow down each other.
+    """
+    return [
+        bench_scenario(urls, name, path, args.concurrency, args.warmup, args.iterations)
+        for name, path in zip(scenario_names(paths), paths)
+    ]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run SQL scenario files against a local cluster.")
+    parser.add_argument("scenarios", nargs="+", help="SQL files, or names of files of archive/sql")
+    parser.add_argument("--nodes", type=int, default=1, help="number of nodes to start, default: 1")
+    parser.add_argument("--url", help="run against this server instead of starting a cluster")
+    parser.add_argument("--binary", default=COCKROACH_BINARY, help=f"default: {COCKROACH_BINARY}")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="concurrent scenarios, default: 4")
+    parser.add_argument("--log-dir", default="/tmp/run-sql", help="default: /tmp/run-sql")
+    parser.add_argument("--bench", action="store_true", help="benchmark the scenarios")
+    parser.add_argument(
+        "--iterations", type=int, default=20, help="bench: measured runs per client, default: 20"
+    )
+    parser.add_argument("--warmup", type=int, default=3, help="bench: warmup runs per client, default: 3")
+    parser.add_argument("--concurrency", type=int, default=1, help="bench: clients, default: 1")
+    parser.add_argument("--output", help="bench: results file, default: <log_dir>/bench.json")
+    parser.add_argument("--baseline", help="bench: results file to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="bench: regression threshold in percent, default: 10"
+    )
+    args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error(f"invalid iterations: {args.iterations}")
+    if args.warmup < 0:
+        parser.error(f"invalid warmup: {args.warmup}")
+    if args.concurrency < 1:
+        parser.error(f"invalid concurrency: {args.concurrency}")
+
+    paths = [scenario_path(scenario) for scenario in args.scenarios]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        print(f"scenario not found: {', '.join(missing)}")
+        sys.exit(1)
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    if args.bench:
+        def run(urls):
+            return run_bench(urls, paths, args)
+    else:
+        def run(urls):
+            return run_scenarios(urls, paths, args.log_dir, args.jobs)
+
+    if args.url:
+        results = run([args.url])
+    else:
+        with start_cluster(args.nodes, args.log_dir, args.binary) as nodes:
+            results = run([node.url for node in nodes])
+
+    if not args.bench:
+        print_results(results, args.log_dir)
+        sys.exit(1 if any(result.failed for result in results) else 0)
+
+    print_bench(results)
+    output = args.output or os.path.join(args.log_dir, "bench.json")
+    settings = {"concurrency": args.concurrency, "warmup": args.warmup, "iterations": args.iterations}
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "server": args.url or f"{args.nodes} local nodes",
+                **settings,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results saved to {output}")
+
+    regressions = compare_bench(results, baseline, settings, args.threshold) if baseline else []
+    failed = any(result["error"] for result in results)
+    sys.exit(1 if regressions or failed else 0)
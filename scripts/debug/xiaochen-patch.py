@@ -1,90 +1,360 @@
 #!/usr/bin/env python3
 
 # Usage:
-#   python3 xiaochen-patch.py <on|off>
+#   python3 xiaochen-patch.py <on|off|status>
 #
 # This script is used to patch the scaffold code to the CockroachDB source code.
 #
 # Current patches:
 #   - update package "pkg/roachprod/logger" to make the debugging easier
 #   - disable enterprise license check
+#
+# The patches are applied as one transaction:
+#   - the target content of every file is computed and checked first, nothing
+#     is written if any patch can't be applied (e.g. the upstream code changed)
+#   - a file already in the target state (same content hash) isn't touched, so
+#     its mtime doesn't change and Bazel doesn't rebuild its package
+#   - the files are written to a temporary file and renamed into place, and the
+#     renamed files are restored if a later rename fails
+#
+# The content hashes of both states of every patch are saved in a manifest, so
+# "status" tells which patches are on, off or modified by hand.
+#
+# With BAZEL_OUTPUT_BASE_PER_STATE, every patch state gets its own Bazel output
+# base, selected by a managed block of ".bazelrc.user", so toggling the patches
+# switches to the output base (and the still running Bazel server) which built
+# that state last time instead of rebuilding the patched packages and their
+# dependents. All the output bases share one disk cache (unless ".bazelrc.user"
+# already sets a disk or remote cache), so building a state for the first time
+# only builds what the patches changed.
 
+import hashlib
+import json
 import os
-import shutil
+import re
 import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+
+# first, to make the modules of scripts/common importable
+import _paths  # noqa: F401
+
+from bazel_config import MANAGED_BLOCK_BEGIN, MANAGED_BLOCK_END, strip_managed_block
 
 COCKROACH_SRC_PATH = os.path.expanduser("~/code/cockroach")
 TOOLKIT_PATH = os.path.expanduser("~/code/cockroach-toolkit")
 
+MANIFEST_PATH = os.path.expanduser("~/.cache/cockroach-toolkit/xiaochen-patch.json")
+
+TARGET_HEADER = "// target location:"
+
+# Use one Bazel output base per patch state, see the top of this file. Each
+# output base has its own Bazel server, which uses a few GB of memory until it
+# idles out, so it's off by default.
+BAZEL_OUTPUT_BASE_PER_STATE = False
+BAZEL_CACHE_DIR = os.path.expanduser("~/.cache/cockroach-toolkit/bazel")
+BAZEL_CONFIG_PATH = os.path.join(COCKROACH_SRC_PATH, ".bazelrc.user")
+
+# a disk or remote cache configured by the user, which is kept
+USER_CACHE_OPTION = re.compile(r"^\s*build(:\S+)?\s.*--(disk_cache|remote_cache)=", re.MULTILINE)
+
+
+@dataclass
+class Patch(ABC):
+    """
+    A patch of a file of the source code.
+
+    The content of the file in each state is computed from its current
+    content, None meaning that the file doesn't exist.
+    """
+
+    name: str
+    # relative to COCKROACH_SRC_PATH
+    target: str
+
+    @abstractmethod
+    def content(self, current: Optional[str], mode: str) -> Optional[str]:
+        """
+        Return the content of the file in the given mode, raise ValueError if
+        the current content isn't in either state.
+        """
+
+
+@dataclass
+class FilePatch(Patch):
+    """
+    Add a file of the scaffold code to the source code.
+    """
 
-def patch_all_files(mode: str):
+    scaffold_content: str = ""
+    # the hash of the scaffold code applied last time, which may have changed since
+    applied_hash: Optional[str] = None
+
+    def content(self, current: Optional[str], mode: str) -> Optional[str]:
+        if current is not None and content_hash(current) not in (
+            content_hash(self.scaffold_content),
+            self.applied_hash,
+        ):
+            raise ValueError(f"{self.target} exists and differs from the scaffold code")
+        return self.scaffold_content if mode == "on" else None
+
+
+@dataclass
+class ReplacePatch(Patch):
+    """
+    Replace a string of a file of the source code.
+    """
+
+    origin: str = ""
+    patch: str = ""
+
+    def content(self, current: Optional[str], mode: str) -> Optional[str]:
+        if current is None:
+            raise ValueError(f"{self.target} doesn't exist")
+        if self.patch in current:
+            on_content = current
+        elif self.origin in current:
+            on_content = current.replace(self.origin, self.patch)
+        else:
+            raise ValueError(f"neither the original code nor the patch found in {self.target}")
+        return on_content if mode == "on" else on_content.replace(self.patch, self.origin)
+
+
+@dataclass
+class Change:
+    patch: Patch
+    path: str
+    old_content: Optional[str]
+    new_content: Optional[str]
+
+
+def content_hash(content: Optional[str]) -> Optional[str]:
+    if content is None:
+        return None
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def scaffold_patches(manifest: dict) -> list[Patch]:
+    """
+    Return a patch for each file of the scaffold code with a target location.
+
+    The target location is on the first line, as "// target location: <path>".
+    """
+    patches = []
     directory = os.path.join(TOOLKIT_PATH, "scaffold-code")
-    for entry in os.listdir(directory):
+    for entry in sorted(os.listdir(directory)):
         path = os.path.join(directory, entry)
-        if os.path.isfile(path):
-            patch_file(path, mode=mode)
-
-
-def patch_file(file_path, mode: str):
-    # step 1: extract target location
-    #
-    # Extract the target location from the first line.
-    # Assuming the format is "// target location: <path>"
-    target_location = None
-    with open(file_path, "r") as file:
-        # Read the first line
-        first_line = file.readline().strip()
-
-    if first_line.startswith("// target location:"):
-        target_location = first_line.split(":", 1)[1].strip()
-        print(target_location)
-    else:
-        raise ValueError("Target location not found in the first line")
-
-    # step 2: copy the file to the target location
-    target_location = os.path.join(COCKROACH_SRC_PATH, target_location)
-    match mode:
-        case "on":
-            shutil.copy(file_path, target_location)
-            print(f"File copied to {target_location}")
-        case "off":
-            if os.path.exists(target_location):
-                os.remove(target_location)
-                print(f"File removed from {target_location}")
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, "r") as file:
+            content = file.read()
+        first_line = content.split("\n", 1)[0].strip()
+        if not first_line.startswith(TARGET_HEADER):
+            print(f"skip {path}: no target location on the first line")
+            continue
 
+        target = first_line[len(TARGET_HEADER) :].strip()
+        applied_hash = manifest.get(target, {}).get("on")
+        patches.append(
+            FilePatch(
+                name=entry, target=target, scaffold_content=content, applied_hash=applied_hash
+            )
+        )
+    return patches
 
-def toggle_enterprise_license_check(mode: str):
-    target_path = os.path.join(COCKROACH_SRC_PATH, "pkg/ccl/utilccl/license_check.go")
 
+def all_patches(manifest: dict) -> list[Patch]:
     # we add special comments to the patch to make it distinguishable
-    patch = "return nil /* xiaochen-patch */"
-    origin = "return checkEnterpriseEnabledAt(st, timeutil.Now(), feature, true /* withDetails */)"
+    license_patch = ReplacePatch(
+        name="disable enterprise license check",
+        target="pkg/ccl/utilccl/license_check.go",
+        origin="return checkEnterpriseEnabledAt(st, timeutil.Now(), feature, true /* withDetails */)",
+        patch="return nil /* xiaochen-patch */",
+    )
+    return scaffold_patches(manifest) + [license_patch]
 
-    match mode:
-        case "on":
-            replace_string(target_path, origin, patch)
-            print("Enterprise license check is disabled")
-        case "off":
-            replace_string(target_path, patch, origin)
-            print("Enterprise license check is enabled")
+
+def read_file(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return file.read()
+
+
+def plan(patches: list[Patch], mode: str) -> tuple[list[Change], dict]:
+    """
+    Compute the changes needed to put every patch in the given mode, and the
+    manifest of the patches.
+
+    Raise ValueError if any patch can't be applied, before anything is written.
+    """
+    changes = []
+    manifest = {}
+    errors = []
+    for patch in patches:
+        path = os.path.join(COCKROACH_SRC_PATH, patch.target)
+        current = read_file(path)
+        try:
+            on_content = patch.content(current, "on")
+            off_content = patch.content(current, "off")
+        except ValueError as e:
+            errors.append(f"{patch.name}: {e}")
+            continue
+
+        manifest[patch.target] = {
+            "name": patch.name,
+            "on": content_hash(on_content),
+            "off": content_hash(off_content),
+        }
+        new_content = on_content if mode == "on" else off_content
+        if content_hash(new_content) != content_hash(current):
+            changes.append(Change(patch, path, current, new_content))
+
+    if errors:
+        raise ValueError("\n".join(errors))
+    return changes, manifest
+
+
+def write_atomically(path: str, content: Optional[str]):
+    """
+    Replace the content of a file, or remove it if content is None.
+    """
+    if content is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.xiaochen-patch.tmp"
+    )
+    try:
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def apply(changes: list[Change]):
+    """
+    Apply all the changes or none of them.
+    """
+    done = []
+    try:
+        for change in changes:
+            write_atomically(change.path, change.new_content)
+            done.append(change)
+    except BaseException:
+        # restore the files already changed, newest first
+        for change in reversed(done):
+            write_atomically(change.path, change.old_content)
+        raise
+
+
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r") as file:
+        return json.load(file)
 
 
-def replace_string(file_path, old_string, new_string):
-    with open(file_path, "r") as file:
-        content = file.read()
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
 
-    content = content.replace(old_string, new_string)
 
-    with open(file_path, "w") as file:
-        file.write(content)
+def patch_all(mode: str):
+    try:
+        changes, manifest = plan(all_patches(load_manifest()), mode)
+    except ValueError as e:
+        print(f"nothing patched:\n{e}")
+        sys.exit(1)
+
+    apply(changes)
+    save_manifest(manifest)
+
+    for change in changes:
+        action = "removed" if change.new_content is None else "written"
+        print(f"{change.patch.name}: {change.path} {action}")
+    print(f"{len(changes)} files changed, {len(manifest) - len(changes)} already {mode}")
+
+    select_bazel_output_base(state_key(manifest, mode) if BAZEL_OUTPUT_BASE_PER_STATE else None)
+
+
+def state_key(manifest: dict, mode: str) -> str:
+    """
+    Return the name of a patch state: "off" for the unpatched source code,
+    "on-<hash>" for the patched one, the hash changing with the patches.
+    """
+    if mode == "off":
+        return "off"
+    digest = hashlib.sha256(
+        json.dumps(sorted((target, hashes["on"]) for target, hashes in manifest.items())).encode()
+    ).hexdigest()
+    return f"on-{digest[:12]}"
+
+
+def select_bazel_output_base(key: Optional[str]):
+    """
+    Point ".bazelrc.user" at the output base of the patch state, or remove the
+    managed block if key is None. The file is only written if it changes.
+    """
+    current = read_file(BAZEL_CONFIG_PATH)
+    config = strip_managed_block(current or "")
+    if key is not None:
+        output_base = os.path.join(BAZEL_CACHE_DIR, "output-bases", key)
+        block = [MANAGED_BLOCK_BEGIN, f"startup --output_base={output_base}"]
+        if not USER_CACHE_OPTION.search(config):
+            block.append(f"build --disk_cache={os.path.join(BAZEL_CACHE_DIR, 'disk-cache')}")
+        block.append(MANAGED_BLOCK_END)
+        if config and not config.endswith("\n"):
+            config += "\n"
+        config += "\n".join(block) + "\n"
+
+    if config != (current or ""):
+        write_atomically(BAZEL_CONFIG_PATH, config)
+    if key is not None:
+        print(f"Bazel output base: {key}")
+
+
+def status():
+    manifest = load_manifest()
+    if not manifest:
+        print("no patch applied yet")
+        return
+
+    for target, hashes in manifest.items():
+        current = content_hash(read_file(os.path.join(COCKROACH_SRC_PATH, target)))
+        if current == hashes["on"]:
+            state = "on"
+        elif current == hashes["off"]:
+            state = "off"
+        else:
+            state = "modified"
+        print(f"{state:<8} {hashes['name']} ({target})")
+
+    for line in (read_file(BAZEL_CONFIG_PATH) or "").splitlines():
+        if line.startswith("startup --output_base="):
+            print(f"Bazel output base: {line.split('=', 1)[1]}")
 
 
 if __name__ == "__main__":
     # the first argument is the mode
-    if len(sys.argv) != 2:
-        print("Usage: xiaochen-patch.py <on|off>")
+    if len(sys.argv) != 2 or sys.argv[1] not in ("on", "off", "status"):
+        print("Usage: xiaochen-patch.py <on|off|status>")
         sys.exit(1)
 
     mode = sys.argv[1]
-    patch_all_files(mode)
-    toggle_enterprise_license_check(mode)
+    match mode:
+        case "status":
+            status()
+        case _:
+            patch_all(mode)